@@ -0,0 +1,434 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+import OpenImageIO as oiio
+
+import reduce_exr_channels_utils as utils
+import reduce_exr_channels_rewrite as rewrite
+from reduce_exr_channels_rules import NEAR_EMPTY_EDGES
+from reduce_exr_channels_prefetch import FramePrefetcher
+
+
+def get_peak_rss_bytes():
+    """
+    Get the peak resident memory of the current process.
+    :return:
+    :rtype: int
+    """
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(),
+                                                 ctypes.byref(counters), counters.cb)
+        return counters.PeakWorkingSetSize
+
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def write_synthetic_frame(image_path, width, height, nlayers, seed=0):
+    """
+    Write a Harmony-like layer EXR: nlayers RGBA channel groups, where a part are mattes, color overrides,
+    tonals or empty ones.
+    :param str image_path:
+    :param int width:
+    :param int height:
+    :param int nlayers:
+    :param int seed:
+    :return: channel names
+    :rtype: list[str]
+    """
+    rng = np.random.default_rng(seed)
+    kinds = ["color", "matte", "coloroverride", "empty", "tonal"]
+    channel_names = []
+    for layer_index in range(nlayers):
+        kind = kinds[layer_index % len(kinds)]
+        prefix = f"L{layer_index:03d}" if kind in ("color", "empty") else f"L{layer_index:03d}_{kind}"
+        channel_names.extend(f"{prefix}.{component}" for component in "RGBA")
+
+    pixels = np.zeros((height, width, len(channel_names)), dtype=np.float32)
+    for layer_index in range(nlayers):
+        if kinds[layer_index % len(kinds)] == "empty":
+            continue
+        y0 = rng.integers(0, height // 2)
+        x0 = rng.integers(0, width // 2)
+        pixels[y0:y0 + height // 4, x0:x0 + width // 4, layer_index * 4:layer_index * 4 + 4] = rng.random(4)
+
+    spec = oiio.ImageSpec(width, height, len(channel_names), oiio.HALF)
+    spec.channelnames = channel_names
+    spec.attribute("compression", "zip")
+    output = oiio.ImageOutput.create(image_path)
+    output.open(image_path, spec)
+    output.write_image(pixels)
+    output.close()
+    return channel_names
+
+
+def write_sequence_frame(image_path, width, height, frame_index, nframes, nlayers,
+                         kinds=("color", "late", "empty", "sparse")):
+    """
+    Write a frame of a long layer sequence, whose channel groups are live on all the frames, live only on a short
+    range near the end, empty, or live only in a few rows of a few frames, the cases of the sampled analysis.
+    The channel groups of each kind are side by side, like the passes of a render sorted by name.
+    :param str image_path:
+    :param int width:
+    :param int height:
+    :param int frame_index:
+    :param int nframes:
+    :param int nlayers:
+    :param tuple[str] kinds:
+    """
+    layer_kinds = [kinds[layer_index * len(kinds) // nlayers] for layer_index in range(nlayers)]
+    channel_names = [f"L{layer_index:03d}_{layer_kinds[layer_index]}.{component}"
+                     for layer_index in range(nlayers) for component in "RGBA"]
+    pixels = np.zeros((height, width, len(channel_names)), dtype=np.float32)
+    late_start = nframes - max(nframes // 20, 1)
+    for layer_index in range(nlayers):
+        kind = layer_kinds[layer_index]
+        channels = slice(layer_index * 4, layer_index * 4 + 4)
+        if kind == "color":
+            pixels[height // 4:height // 2, width // 4:width // 2, channels] = 0.5
+        elif kind == "late" and frame_index >= late_start:
+            pixels[:, :, channels] = 0.25
+        elif kind == "sparse" and frame_index % 97 == 13:
+            pixels[height - 1, width // 2, channels] = 1.0
+
+    spec = oiio.ImageSpec(width, height, len(channel_names), oiio.HALF)
+    spec.channelnames = channel_names
+    spec.attribute("compression", "zip")
+    output = oiio.ImageOutput.create(image_path)
+    output.open(image_path, spec)
+    output.write_image(pixels)
+    output.close()
+
+
+def legacy_rewrite_exr_frame(src_path, dst_path, empty_channels, matte_channels, coloroverride_channels):
+    """
+    The rewrite as it was before the single output buffer: full read, np.array copy, per-channel list and
+    np.stack. Only kept here as the reference of the benchmark.
+    """
+    inp = oiio.ImageInput.open(src_path)
+    spec = inp.spec()
+    pixels = inp.read_image()
+    inp.close()
+
+    np_pixels = np.array(pixels).reshape((spec.height, spec.width, spec.nchannels))
+
+    new_channels = []
+    new_data = []
+    override_alpha_layers = {}
+    for i, channel_name in enumerate(spec.channelnames):
+        base_channel = channel_name.split('.')[0]
+        if base_channel in empty_channels:
+            continue
+        if base_channel in coloroverride_channels:
+            if channel_name.endswith(".R"):
+                override_alpha_layers[base_channel] = np_pixels[:, :, i]
+            continue
+        if base_channel in matte_channels:
+            if channel_name.endswith(".A"):
+                override_alpha_layers[base_channel] = np_pixels[:, :, i]
+            continue
+        new_channels.append(channel_name)
+        new_data.append(np_pixels[:, :, i])
+
+    for base, alpha in override_alpha_layers.items():
+        new_channels.append(f"{base}.mask")
+        new_data.append(alpha)
+    final_data = np.stack(new_data, axis=-1)
+
+    out_spec = oiio.ImageSpec()
+    out_spec.width = spec.width
+    out_spec.height = spec.height
+    out_spec.nchannels = len(new_channels)
+    out_spec.channelnames = new_channels
+    out_spec.format = spec.format
+    out = oiio.ImageOutput.create(dst_path)
+    out.open(dst_path, out_spec)
+    out.write_image(final_data)
+    out.close()
+
+
+def _run_rewrite(rewrite_name, src_path, dst_path, classification, result_queue):
+    """
+    Run one rewrite in a fresh process, so its peak RSS is not polluted by the other one.
+    """
+    rewrite_frame = legacy_rewrite_exr_frame if rewrite_name == "legacy" else rewrite.rewrite_exr_frame
+    baseline = get_peak_rss_bytes()
+    start = time.perf_counter()
+    rewrite_frame(src_path, dst_path, *classification)
+    result_queue.put((time.perf_counter() - start, baseline, get_peak_rss_bytes()))
+
+
+def benchmark_rewrite(args):
+    """
+    Compare the peak RSS and the time of the legacy rewrite and of rewrite_exr_frame on a synthetic frame.
+    """
+    work_dir = tempfile.mkdtemp(prefix="reduce_benchmark_")
+    src_path = os.path.join(work_dir, "layer_v001.1001.exr")
+    write_synthetic_frame(src_path, args.width, args.height, args.layers)
+    print(f"Synthetic frame: {args.width}x{args.height}, {args.layers * 4} channels, "
+          f"{args.width * args.height * args.layers * 4 * 4 / 1024 ** 2:.0f} MB as float")
+
+    channel_stats = {}
+    channel_names, frame_channel_stats, _ = utils.analyze_exr_frame(src_path)
+    utils.merge_channel_stats(channel_stats, channel_names, frame_channel_stats)
+    classification = utils.classify_channels(channel_stats)
+
+    context = multiprocessing.get_context("spawn")
+    outputs = {}
+    for rewrite_name in ("legacy", "current"):
+        outputs[rewrite_name] = os.path.join(work_dir, f"{rewrite_name}.exr")
+        result_queue = context.Queue()
+        process = context.Process(target=_run_rewrite, args=(rewrite_name, src_path, outputs[rewrite_name],
+                                                             classification, result_queue))
+        process.start()
+        duration, baseline, peak = result_queue.get()
+        process.join()
+        print(f"{rewrite_name:>8}: {duration:6.2f}s, peak RSS {peak / 1024 ** 2:8.1f} MB "
+              f"({(peak - baseline) / 1024 ** 2:+.1f} MB over the process baseline)")
+
+    legacy = oiio.ImageBuf(outputs["legacy"])
+    current = oiio.ImageBuf(outputs["current"])
+    # Compare on the display window, the data window of the current rewrite can be cropped
+    identical = legacy.spec().channelnames == current.spec().channelnames and \
+        np.array_equal(legacy.get_pixels(oiio.FLOAT, legacy.roi_full), current.get_pixels(oiio.FLOAT, legacy.roi_full))
+    print(f"Outputs identical: {identical}")
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def benchmark_reduction(args):
+    """
+    Compare the per-channel np.max loop of the analysis with the vectorised reduce_channels, on a chunk of
+    scanlines with a realistic channel count and a Harmony-like sparse content.
+    """
+    rng = np.random.default_rng(0)
+    chunk = np.zeros((args.rows, args.width, args.channels), dtype=np.float32)
+    chunk[:, args.width // 4:args.width // 2] = rng.random((args.rows, args.width // 4, args.channels))
+    print(f"Chunk: {args.rows} rows x {args.width} pixels x {args.channels} channels, "
+          f"{chunk.nbytes / 1024 ** 2:.0f} MB")
+
+    def per_channel_loop():
+        return np.array([np.max(chunk[:, :, i]) for i in range(chunk.shape[2])])
+
+    def vectorised(**options):
+        return lambda: utils.reduce_channels(chunk, **options)["max"]
+
+    reference = per_channel_loop()
+    for name, reduction in (("loop", per_channel_loop), ("max", vectorised()),
+                            ("max+min", vectorised(with_min=True)),
+                            ("max+min+nonzero", vectorised(with_min=True, with_nonzero=True)),
+                            ("max+min+coverage", vectorised(with_min=True, coverage_edges=NEAR_EMPTY_EDGES))):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            result = reduction()
+        duration = (time.perf_counter() - start) / args.repeat
+        print(f"{name:>16}: {duration * 1000:8.2f} ms per chunk, identical: {np.array_equal(result, reference)}")
+
+
+def benchmark_prefetch(args):
+    """
+    Throughput of the sequential analysis of a layer without prefetch, with the frames read ahead to warm the
+    OS file cache, and with the frames copied on a local scratch disk. Each mode reads its own frames, so no
+    mode benefits from the file cache warmed by another one. Give frames on the network share to be
+    representative, synthetic frames on the local disk only show the overhead of the prefetcher.
+    """
+    work_dir = tempfile.mkdtemp(prefix="reduce_benchmark_")
+    frames = args.frames
+    if not frames:
+        frames = [os.path.join(work_dir, f"layer_v001.{1001 + i}.exr") for i in range(args.count)]
+        for seed, frame in enumerate(frames):
+            write_synthetic_frame(frame, args.width, args.height, args.layers, seed)
+
+    modes = ("none", "cache", "scratch")
+    print(f"{len(frames)} frames, {sum(os.path.getsize(frame) for frame in frames) / 1024 ** 2:.1f} MB, "
+          f"{len(frames) // len(modes)} per mode, prefetch depth {args.depth}")
+    for mode_index, mode in enumerate(modes):
+        mode_frames = frames[mode_index::len(modes)]
+        scratch_dir = os.path.join(work_dir, "scratch") if mode == "scratch" else None
+        prefetcher = FramePrefetcher(args.depth, scratch_dir=scratch_dir) if mode != "none" else None
+        start = time.perf_counter()
+        for i, frame in enumerate(mode_frames):
+            if prefetcher:
+                for next_frame in mode_frames[i:i + args.depth + 1]:
+                    prefetcher.request(next_frame)
+            utils.analyze_exr_frame(frame, prefetch_dir=scratch_dir)
+            if prefetcher:
+                prefetcher.release(frame)
+        duration = time.perf_counter() - start
+        if prefetcher:
+            prefetcher.close()
+        mode_bytes = sum(os.path.getsize(frame) for frame in mode_frames)
+        print(f"{mode:>8}: {duration:6.2f}s, {mode_bytes / 1024 ** 2 / duration:8.1f} MB/s")
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def benchmark_analysis(args):
+    """
+    Frames opened, bytes decoded and time of the analysis of long synthetic layers, with a full scan, with a
+    strided first pass, and with a strided and downscaled first pass. The result of each mode is compared to the
+    full scan, it has to be the same. The empty channels of a layer have to be confirmed on all its frames, the
+    sampled passes only save the reads of the channels that are live late in the sequence.
+    """
+    work_dir = tempfile.mkdtemp(prefix="reduce_benchmark_")
+    layers = {"all live": ("color", "late", "sparse"), "with empty": ("color", "late", "empty", "sparse")}
+    for layer_name, kinds in layers.items():
+        os.makedirs(os.path.join(work_dir, layer_name))
+        for frame_index in range(args.count):
+            write_sequence_frame(os.path.join(work_dir, layer_name, f"layer_v001.{1001 + frame_index}.exr"),
+                                 args.width, args.height, frame_index, args.count, args.layers, kinds)
+
+    counters = {"frames": 0, "bytes": 0}
+    get_read_path = utils.get_read_path
+    iter_exr_chunks = utils.iter_exr_chunks
+
+    def counting_get_read_path(*path_args):
+        counters["frames"] += 1
+        return get_read_path(*path_args)
+
+    def counting_iter_exr_chunks(*chunk_args, **chunk_kwargs):
+        for row_offset, chunk in iter_exr_chunks(*chunk_args, **chunk_kwargs):
+            counters["bytes"] += chunk.nbytes
+            yield row_offset, chunk
+
+    utils.get_read_path = counting_get_read_path
+    utils.iter_exr_chunks = counting_iter_exr_chunks
+    modes = {"full": (0, 0), "stride": (args.stride, 0), "stride+rows": (args.stride, args.rows)}
+    print(f"{args.count} frames of {args.width}x{args.height}, {args.layers} channel groups, "
+          f"stride {args.stride}, one row block every {args.rows}")
+    try:
+        for layer_name in layers:
+            print(f"Layer {layer_name}:")
+            reference = None
+            for mode, (sample_stride, sample_rows) in modes.items():
+                counters.update(frames=0, bytes=0)
+                start = time.perf_counter()
+                result = utils.analyze_exrs_in_version(os.path.join(work_dir, layer_name), half_tolerance=0.0,
+                                                       sample_stride=sample_stride, sample_rows=sample_rows)
+                duration = time.perf_counter() - start
+                result = result[:3] + result[5:]
+                reference = reference or result
+                print(f"{mode:>12}: {duration:6.2f}s, {counters['frames']:5d} frames read, "
+                      f"{counters['bytes'] / 1024 ** 2:8.1f} MB decoded, identical: {result == reference}")
+    finally:
+        utils.get_read_path = get_read_path
+        utils.iter_exr_chunks = iter_exr_chunks
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def benchmark_codecs(args):
+    """
+    Encode time, file size and decode time of each EXR compression, on representative layer frames (or a
+    synthetic one). The decode is done with OIIO, that uses the same OpenEXR library than the Nuke Read node.
+    """
+    work_dir = tempfile.mkdtemp(prefix="reduce_benchmark_")
+    frames = args.frames
+    if not frames:
+        frames = [os.path.join(work_dir, "layer_v001.1001.exr")]
+        write_synthetic_frame(frames[0], args.width, args.height, args.layers)
+
+    results = {codec: {"encode": 0.0, "size": 0, "decode": 0.0} for codec in args.codecs}
+    for frame in frames:
+        input_image = oiio.ImageInput.open(frame)
+        spec = input_image.spec()
+        pixels = input_image.read_image(0, 0, 0, spec.nchannels, oiio.FLOAT)
+        input_image.close()
+
+        for codec in args.codecs:
+            out_path = os.path.join(work_dir, f"{codec.replace(':', '_')}.exr")
+            out_spec = rewrite.build_output_spec(spec, list(spec.channelnames), codec)
+            start = time.perf_counter()
+            output = oiio.ImageOutput.create(out_path)
+            output.open(out_path, out_spec)
+            output.write_image(pixels)
+            output.close()
+            results[codec]["encode"] += time.perf_counter() - start
+            results[codec]["size"] += os.path.getsize(out_path)
+
+            start = time.perf_counter()
+            input_image = oiio.ImageInput.open(out_path)
+            input_image.read_image(0, 0, 0, out_spec.nchannels, oiio.FLOAT)
+            input_image.close()
+            results[codec]["decode"] += time.perf_counter() - start
+
+    print(f"{len(frames)} frames, {sum(os.path.getsize(frame) for frame in frames) / 1024 ** 2:.1f} MB as source")
+    print(f"{'codec':>10} {'encode (s)':>11} {'size (MB)':>10} {'decode (s)':>11}")
+    for codec, result in results.items():
+        print(f"{codec:>10} {result['encode']:11.2f} {result['size'] / 1024 ** 2:10.1f} {result['decode']:11.2f}")
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main():
+    """
+    Benchmarks of the reduce tool on synthetic Harmony layers, to run in the same environment as the tool:
+    python reduce_exr_channels_benchmark.py rewrite --width 3840 --height 2160 --layers 50
+    python reduce_exr_channels_benchmark.py reduction --channels 400
+    python reduce_exr_channels_benchmark.py prefetch T:/path/to/layer_v001/*.exr --depth 8
+    python reduce_exr_channels_benchmark.py analysis --count 1000 --stride 25 --rows 8
+    python reduce_exr_channels_benchmark.py codecs T:/path/to/layer_v001.1001.exr --codecs zip piz dwaa
+    """
+    parser = argparse.ArgumentParser(description="Benchmarks of the reduce channels tool.")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    rewrite_parser = subparsers.add_parser("rewrite", help="Peak RSS of the EXR rewrite, before and after.")
+    rewrite_parser.add_argument("--width", type=int, default=3840)
+    rewrite_parser.add_argument("--height", type=int, default=2160)
+    rewrite_parser.add_argument("--layers", type=int, default=50, help="Number of RGBA channel groups.")
+    rewrite_parser.set_defaults(run=benchmark_rewrite)
+
+    reduction_parser = subparsers.add_parser("reduction", help="Per-channel loop against the vectorised reduction.")
+    reduction_parser.add_argument("--rows", type=int, default=utils.ANALYSIS_CHUNK_ROWS)
+    reduction_parser.add_argument("--width", type=int, default=3840)
+    reduction_parser.add_argument("--channels", type=int, default=400)
+    reduction_parser.add_argument("--repeat", type=int, default=10)
+    reduction_parser.set_defaults(run=benchmark_reduction)
+
+    prefetch_parser = subparsers.add_parser("prefetch", help="Analysis throughput with and without prefetch.")
+    prefetch_parser.add_argument("frames", nargs="*", help="Frames of a layer, split between the modes. "
+                                                           "Synthetic ones on the local disk if not given.")
+    prefetch_parser.add_argument("--depth", type=int, default=8)
+    prefetch_parser.add_argument("--count", type=int, default=24, help="Number of synthetic frames.")
+    prefetch_parser.add_argument("--width", type=int, default=1920)
+    prefetch_parser.add_argument("--height", type=int, default=1080)
+    prefetch_parser.add_argument("--layers", type=int, default=20, help="Number of RGBA channel groups.")
+    prefetch_parser.set_defaults(run=benchmark_prefetch)
+
+    analysis_parser = subparsers.add_parser("analysis", help="Frames and bytes read by the sampled analysis.")
+    analysis_parser.add_argument("--count", type=int, default=1000, help="Number of synthetic frames.")
+    analysis_parser.add_argument("--stride", type=int, default=25)
+    analysis_parser.add_argument("--rows", type=int, default=8)
+    analysis_parser.add_argument("--width", type=int, default=256)
+    analysis_parser.add_argument("--height", type=int, default=128)
+    analysis_parser.add_argument("--layers", type=int, default=20, help="Number of RGBA channel groups.")
+    analysis_parser.set_defaults(run=benchmark_analysis)
+
+    codecs_parser = subparsers.add_parser("codecs", help="Encode time, size and decode time of the EXR compressions.")
+    codecs_parser.add_argument("frames", nargs="*", help="Representative layer EXRs. A synthetic one if not given.")
+    codecs_parser.add_argument("--codecs", nargs="+", default=["zip", "zips", "piz", "dwaa", "rle"])
+    codecs_parser.add_argument("--width", type=int, default=3840)
+    codecs_parser.add_argument("--height", type=int, default=2160)
+    codecs_parser.add_argument("--layers", type=int, default=50, help="Number of RGBA channel groups.")
+    codecs_parser.set_defaults(run=benchmark_codecs)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
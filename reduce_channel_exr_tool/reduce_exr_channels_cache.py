@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = os.path.join(os.getenv("LOCALAPPDATA", os.path.expanduser("~")),
+                                  "reduce_channel_tool", "channel_stats_cache.sqlite")
+# Size bound of the cache, the least recently used frames are evicted above it.
+CACHE_MAX_ENTRIES = 500000
+# Seconds to wait on a cache locked by another worker before giving up.
+CACHE_LOCK_TIMEOUT = 30
+
+_caches = {}
+
+
+class ChannelStatsCache:
+    """
+    On-disk cache of the per-frame, per-channel statistics of the EXRs, keyed by the file path, and only valid
+    while the size and the modification time of the file are the same.
+    It is a SQLite database in WAL mode, so all the workers of the pool (and other runs of the tool) can read
+    and write it at the same time. Any error with the cache is only logged, the frame is then analysed normally.
+    A cache that can't be opened is logged once, and then misses every frame.
+    """
+    def __init__(self, cache_path=DEFAULT_CACHE_PATH, max_entries=CACHE_MAX_ENTRIES):
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._connection = None
+        connection = None
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            connection = sqlite3.connect(cache_path, timeout=CACHE_LOCK_TIMEOUT, check_same_thread=False)
+            with connection:
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS frame_stats ("
+                    "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, stats TEXT, last_used REAL)")
+                connection.execute("CREATE INDEX IF NOT EXISTS frame_stats_last_used ON frame_stats (last_used)")
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Channel stats cache {cache_path} unavailable, the frames are analysed without it: {e}")
+            if connection is not None:
+                connection.close()
+            return
+        self._connection = connection
+
+    @staticmethod
+    def _file_identity(image_path):
+        file_stat = os.stat(image_path)
+        return os.path.normcase(os.path.abspath(image_path)), file_stat.st_size, file_stat.st_mtime_ns
+
+    def get(self, image_path):
+        """
+        Get the cached stats of the given frame, if the file didn't change since they were stored.
+        :param str image_path:
+        :return: the channel names of the frame, and {channel_name: {"max": float, "nonzero": bool,
+            "half_error": float, "fingerprint": str}} for the channels that were evaluated.
+        :rtype: tuple[tuple[str], dict[str, dict]] or None
+        """
+        if self._connection is None:
+            return None
+        try:
+            key, size, mtime_ns = self._file_identity(image_path)
+            with self._lock, self._connection:
+                row = self._connection.execute("SELECT size, mtime_ns, stats FROM frame_stats WHERE path = ?",
+                                               (key,)).fetchone()
+                if not row or row[0] != size or row[1] != mtime_ns:
+                    return None
+                self._connection.execute("UPDATE frame_stats SET last_used = ? WHERE path = ?", (time.time(), key))
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Channel stats cache unavailable for {image_path}: {e}")
+            return None
+
+        cached = json.loads(row[2])
+        return tuple(cached["channels"]), cached["stats"]
+
+    def put(self, image_path, channel_names, channel_stats):
+        """
+        Store the stats of the given frame. They are merged with the stats already cached for the same file,
+        as a frame can be analysed only on some of its channels.
+        :param str image_path:
+        :param tuple[str] channel_names:
+        :param dict[str, dict] channel_stats: {channel_name: {"max": float, "nonzero": bool, "half_error": float,
+            "fingerprint": str}}
+        """
+        if self._connection is None:
+            return
+        try:
+            key, size, mtime_ns = self._file_identity(image_path)
+            with self._lock, self._connection:
+                row = self._connection.execute("SELECT size, mtime_ns, stats FROM frame_stats WHERE path = ?",
+                                               (key,)).fetchone()
+                stats = {}
+                if row and row[0] == size and row[1] == mtime_ns:
+                    stats = json.loads(row[2])["stats"]
+                stats.update(channel_stats)
+                self._connection.execute(
+                    "INSERT OR REPLACE INTO frame_stats (path, size, mtime_ns, stats, last_used) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, size, mtime_ns, json.dumps({"channels": list(channel_names), "stats": stats}),
+                     time.time()))
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Cannot store the channel stats of {image_path} in the cache: {e}")
+
+    def evict(self):
+        """
+        Remove the least recently used frames above max_entries.
+        :return: number of evicted frames
+        :rtype: int
+        """
+        if self._connection is None:
+            return 0
+        try:
+            with self._lock, self._connection:
+                count = self._connection.execute("SELECT COUNT(*) FROM frame_stats").fetchone()[0]
+                if count <= self.max_entries:
+                    return 0
+                self._connection.execute(
+                    "DELETE FROM frame_stats WHERE path IN "
+                    "(SELECT path FROM frame_stats ORDER BY last_used LIMIT ?)", (count - self.max_entries,))
+                return count - self.max_entries
+        except sqlite3.Error as e:
+            logger.warning(f"Cannot evict the channel stats cache: {e}")
+            return 0
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+
+
+def get_channel_stats_cache(cache_path):
+    """
+    Get the cache of the current process for the given path. SQLite connections can't be shared between
+    processes, so each worker opens its own one at its first use.
+    :param str cache_path:
+    :return:
+    :rtype: ChannelStatsCache
+    """
+    if cache_path not in _caches:
+        _caches[cache_path] = ChannelStatsCache(cache_path)
+    return _caches[cache_path]
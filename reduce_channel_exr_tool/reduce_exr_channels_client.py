@@ -0,0 +1,197 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Only the standard library is imported here: the client starts in a fraction of the time of a run, the SG
+# connection, OIIO and the process pool stay warm in the daemon.
+
+DAEMON_FOLDER = os.path.join(os.getenv("LOCALAPPDATA", os.path.expanduser("~")), "reduce_channel_tool")
+DAEMON_ADDRESS = ("localhost", 47011)
+# Secret shared by the daemon and the clients of the user, the daemon writes it at its start.
+DAEMON_KEY_PATH = os.path.join(DAEMON_FOLDER, "daemon.key")
+DAEMON_LOG_PATH = os.path.join(DAEMON_FOLDER, "daemon.log")
+# Seconds to wait for a daemon started by the client to accept the jobs.
+DAEMON_START_TIMEOUT = 120
+# Seconds between two status requests of a client waiting for its job.
+STATUS_POLL_INTERVAL = 5
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+
+def read_daemon_key():
+    """
+    :return: the key of the running daemon, None if it never started.
+    :rtype: bytes or None
+    """
+    try:
+        with open(DAEMON_KEY_PATH, "rb") as key_file:
+            return key_file.read()
+    except OSError:
+        return None
+
+
+def send_request(request):
+    """
+    Send a request to the daemon and wait for its reply.
+    :param dict request: {"command": str, ...}, see ReduceDaemon.handle_request.
+    :return: {"ok": bool, "error": str, ...}
+    :rtype: dict
+    :raise ConnectionError: no daemon is running.
+    :raise AuthenticationError: the key is the one of a daemon which is not running anymore.
+    """
+    key = read_daemon_key()
+    if key is None:
+        raise ConnectionRefusedError("No reduce daemon started")
+    with Client(DAEMON_ADDRESS, authkey=key) as connection:
+        connection.send(request)
+        return connection.recv()
+
+
+def start_daemon(daemon_args=()):
+    """
+    Start the daemon in the background, detached from the console of the client, and wait until it accepts the
+    requests.
+    :param list[str] daemon_args: options of reduce_exr_channels_daemon.py.
+    :raise ConnectionError: the daemon didn't start in DAEMON_START_TIMEOUT.
+    """
+    daemon_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "reduce_exr_channels_daemon.py")
+    os.makedirs(DAEMON_FOLDER, exist_ok=True)
+    creation_flags = getattr(subprocess, "DETACHED_PROCESS", 0) | getattr(subprocess, "CREATE_NEW_PROCESS_GROUP", 0)
+    with open(DAEMON_LOG_PATH, "a") as log_file:
+        subprocess.Popen([sys.executable, daemon_script, *daemon_args], stdout=log_file, stderr=subprocess.STDOUT,
+                         stdin=subprocess.DEVNULL, creationflags=creation_flags, close_fds=True)
+    logger.info(f"Reduce daemon started, its log is {DAEMON_LOG_PATH}")
+    deadline = time.monotonic() + DAEMON_START_TIMEOUT
+    while True:
+        try:
+            send_request({"command": "status", "job_id": None})
+            return
+        except (ConnectionError, OSError, AuthenticationError):
+            # The key of a previous daemon is left until the new one replaces it.
+            if time.monotonic() > deadline:
+                raise ConnectionError(f"The reduce daemon didn't start, see {DAEMON_LOG_PATH}")
+            time.sleep(1)
+
+
+def format_job(job):
+    """
+    :param dict job: see ReduceDaemon.get_status.
+    :return:
+    :rtype: str
+    """
+    shots = " ".join(job["argv_shots"]) or "-"
+    line = f"#{job['job_id']} [{job['state']}] priority {job['priority']}, shots: {shots}"
+    if job["duration"] is not None:
+        line += f", {job['duration']:.0f}s"
+    if job["failed_shots"]:
+        line += f", failed: {', '.join(job['failed_shots'])}"
+    if job["error"]:
+        line += f", error: {job['error']}"
+    return line
+
+
+def wait_job(job_id):
+    """
+    Log the changes of state of a job until it is finished.
+    :param int job_id:
+    :return: the final status of the job.
+    :rtype: dict
+    """
+    state = None
+    while True:
+        job = send_request({"command": "status", "job_id": job_id})["jobs"][0]
+        if job["state"] != state:
+            state = job["state"]
+            logger.info(format_job(job))
+        if state in FINISHED_STATES:
+            return job
+        time.sleep(STATUS_POLL_INTERVAL)
+
+
+def main():
+    """
+    Thin client of the reduce daemon, the reduce_exr_channels_tool.py options after -- are given to the job:
+    python reduce_exr_channels_client.py submit SH010 SH020 --priority 5 --wait -- --dedup-channels report
+    python reduce_exr_channels_client.py submit --sequence SQ010
+    python reduce_exr_channels_client.py status [job_id]
+    python reduce_exr_channels_client.py cancel job_id
+    python reduce_exr_channels_client.py shutdown
+    """
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    argv = sys.argv[1:]
+    tool_args = []
+    if "--" in argv:
+        tool_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    parser = argparse.ArgumentParser(description="Submit reduce jobs to the local reduce daemon, and follow them.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    submit_parser = subparsers.add_parser("submit", help="Queue a reduce run of shots, started by the daemon when "
+                                                         "it has a free slot, the highest priority first.")
+    submit_parser.add_argument("shot_names", nargs="*")
+    submit_parser.add_argument("--sequence")
+    submit_parser.add_argument("--priority", type=int, default=0, help="Jobs with a higher priority start first.")
+    submit_parser.add_argument("--wait", action="store_true", help="Wait until the job is finished, and exit "
+                                                                   "with an error if it failed.")
+    submit_parser.add_argument("--no-start", action="store_true",
+                               help="Fail if no daemon is running, instead of starting one.")
+
+    status_parser = subparsers.add_parser("status", help="State of the jobs of the daemon, or of one job.")
+    status_parser.add_argument("job_id", type=int, nargs="?")
+
+    cancel_parser = subparsers.add_parser("cancel", help="Remove a job from the queue, it can't be stopped once "
+                                                         "it is running.")
+    cancel_parser.add_argument("job_id", type=int)
+
+    subparsers.add_parser("shutdown", help="Stop the daemon once its running jobs are finished, the queued jobs "
+                                           "are cancelled.")
+    args = parser.parse_args(argv)
+
+    if args.command == "submit":
+        tool_args = list(args.shot_names) + (["--sequence", args.sequence] if args.sequence else []) + tool_args
+        request = {"command": "submit", "argv": tool_args, "priority": args.priority}
+        try:
+            reply = send_request(request)
+        except (ConnectionError, OSError, AuthenticationError):
+            if args.no_start:
+                logger.error("No reduce daemon running")
+                sys.exit(1)
+            start_daemon()
+            reply = send_request(request)
+    else:
+        try:
+            reply = send_request({"command": args.command, "job_id": getattr(args, "job_id", None)})
+        except (ConnectionError, OSError, AuthenticationError):
+            logger.error("No reduce daemon running")
+            sys.exit(1)
+    if not reply["ok"]:
+        logger.error(reply["error"])
+        sys.exit(1)
+
+    if args.command == "submit":
+        logger.info(f"Job #{reply['job_id']} queued, {reply['queued']} jobs before it")
+        if args.wait and wait_job(reply["job_id"])["state"] != DONE:
+            sys.exit(1)
+    elif args.command == "status":
+        for job in reply["jobs"]:
+            logger.info(format_job(job))
+        if not reply["jobs"]:
+            logger.info("No job")
+    else:
+        logger.info(reply.get("message", "Done"))
+
+
+if __name__ == "__main__":
+    main()
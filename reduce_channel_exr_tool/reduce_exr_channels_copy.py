@@ -0,0 +1,307 @@
+import os
+import sys
+import stat
+import errno
+import shutil
+import threading
+import concurrent.futures
+
+import logging
+logger = logging.getLogger(__name__)
+
+from reduce_exr_channels_journal import get_partial_path
+
+REFLINK = "reflink"
+HARDLINK = "hardlink"
+COPY = "copy"
+
+# Files bigger than this are copied by chunks in parallel.
+PARALLEL_COPY_MIN_BYTES = 64 * 1024 ** 2
+PARALLEL_COPY_CHUNK_BYTES = 16 * 1024 ** 2
+COPY_THREADS = 8
+# Difference of modification time still considered in sync, the network shares round the times of the files.
+SYNC_MTIME_TOLERANCE = 2.0
+
+# Linux ioctl to clone the extents of a file (btrfs, xfs, ...).
+FICLONE = 0x40049409
+# Errors meaning the filesystem can't do this strategy at all, we don't try it again on it.
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS, errno.EPERM}
+
+_copy_engine = None
+
+
+def reflink(src_path, dst_path):
+    """
+    Clone the source file as a copy-on-write file, no data is copied.
+    Only available on Linux (FICLONE) and macOS (clonefile).
+    :param str src_path:
+    :param str dst_path:
+    """
+    if sys.platform.startswith("linux"):
+        import fcntl
+        with open(src_path, "rb") as src_file, open(dst_path, "wb") as dst_file:
+            try:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            except OSError:
+                dst_file.close()
+                os.remove(dst_path)
+                raise
+    elif sys.platform == "darwin":
+        import ctypes
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.clonefile(os.fsencode(src_path), os.fsencode(dst_path), 0):
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), dst_path)
+    else:
+        raise OSError(errno.EOPNOTSUPP, "reflink not supported on this platform", dst_path)
+    shutil.copystat(src_path, dst_path)
+
+
+class CopyEngine:
+    """
+    Copy files with the cheapest safe strategy for each pair of source and destination filesystems:
+    reflink first, then hardlink, and then a copy, by chunks in parallel for the big files.
+    A strategy that fails because the filesystems can't do it is not tried again for the same pair.
+    Hardlinks are only made on read-only sources, like the published layers, so the shared data can't be
+    edited from the workspace. The file is made under a partial name and renamed, it never has its final name
+    while it is incomplete.
+    The bytes that didn't need to be copied are reported, per strategy.
+    """
+    def __init__(self, allow_reflink=True, allow_hardlink=True, threads=COPY_THREADS):
+        self.allow_reflink = allow_reflink
+        self.allow_hardlink = allow_hardlink
+        self._unsupported = {}
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self._chunk_executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self.files = {REFLINK: 0, HARDLINK: 0, COPY: 0}
+        self.bytes = {REFLINK: 0, HARDLINK: 0, COPY: 0}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def shutdown(self):
+        self._executor.shutdown()
+        self._chunk_executor.shutdown()
+
+    def _strategies(self, src_stat, dst_path, shared=False, writable=False):
+        dst_dev = os.stat(os.path.dirname(os.path.abspath(dst_path))).st_dev
+        unsupported = self._unsupported.setdefault((src_stat.st_dev, dst_dev), set())
+        strategies = []
+        if self.allow_reflink and REFLINK not in unsupported:
+            strategies.append(REFLINK)
+        read_only = not src_stat.st_mode & stat.S_IWRITE
+        if self.allow_hardlink and (read_only or shared) and not writable and HARDLINK not in unsupported and \
+                src_stat.st_dev == dst_dev:
+            strategies.append(HARDLINK)
+        return strategies, unsupported
+
+    def copy(self, src_path, dst_path, shared=False, writable=False):
+        """
+        Copy one file, with the first strategy that works.
+        :param str src_path:
+        :param str dst_path:
+        :param bool shared: the source can be hardlinked even if it is writable, like an output of the tool
+            that is identical for several frames.
+        :param bool writable: remove the read-only flag of the copy, it is then never a hardlink of the source.
+        :return: the strategy used
+        :rtype: str
+        """
+        src_stat = os.stat(src_path)
+        strategies, unsupported = self._strategies(src_stat, dst_path, shared, writable)
+        partial_path = get_partial_path(dst_path)
+        for path in (dst_path, partial_path):
+            if os.path.lexists(path):
+                os.remove(path)
+
+        used = COPY
+        for strategy in strategies:
+            try:
+                if strategy == REFLINK:
+                    reflink(src_path, partial_path)
+                else:
+                    os.link(src_path, partial_path)
+                used = strategy
+                break
+            except OSError as e:
+                if e.errno in UNSUPPORTED_ERRNOS:
+                    with self._lock:
+                        unsupported.add(strategy)
+
+        if used == COPY:
+            if src_stat.st_size >= PARALLEL_COPY_MIN_BYTES:
+                self._parallel_copy(src_path, partial_path, src_stat.st_size)
+            else:
+                shutil.copy2(src_path, partial_path)
+        if writable:
+            make_writable(partial_path)
+        os.replace(partial_path, dst_path)
+
+        with self._lock:
+            self.files[used] += 1
+            self.bytes[used] += src_stat.st_size
+        return used
+
+    def _parallel_copy(self, src_path, dst_path, size):
+        """
+        Copy a big file by chunks, each one in its own thread with its own file handles, so several requests
+        are in flight on the network share.
+        """
+        with open(dst_path, "wb") as dst_file:
+            dst_file.truncate(size)
+
+        def copy_chunk(offset):
+            with open(src_path, "rb") as src_file, open(dst_path, "r+b") as dst_file:
+                src_file.seek(offset)
+                dst_file.seek(offset)
+                dst_file.write(src_file.read(min(PARALLEL_COPY_CHUNK_BYTES, size - offset)))
+
+        for future in [self._chunk_executor.submit(copy_chunk, offset)
+                       for offset in range(0, size, PARALLEL_COPY_CHUNK_BYTES)]:
+            future.result()
+        shutil.copystat(src_path, dst_path)
+
+    def submit(self, src_path, dst_path, writable=False):
+        """
+        Copy one file in the thread pool of the engine.
+        :param str src_path:
+        :param str dst_path:
+        :param bool writable:
+        :return:
+        :rtype: concurrent.futures.Future
+        """
+        return self._executor.submit(self.copy, src_path, dst_path, writable=writable)
+
+    @property
+    def bytes_avoided(self):
+        return self.bytes[REFLINK] + self.bytes[HARDLINK]
+
+    def report(self):
+        """
+        Log how the files were copied and how many bytes were avoided.
+        """
+        if not sum(self.files.values()):
+            return
+        details = ", ".join(f"{strategy}: {self.files[strategy]} files ({self.bytes[strategy] / 1024 ** 2:.0f} MB)"
+                            for strategy in (REFLINK, HARDLINK, COPY) if self.files[strategy])
+        logger.info(f"Unchanged files - {details}. {self.bytes_avoided / 1024 ** 2:.0f} MB not copied.")
+
+
+def make_writable(path):
+    """
+    Remove the read-only flag of a file or a folder, that creates issues during the publishing.
+    :param str path:
+    """
+    mode = os.stat(path).st_mode
+    if not mode & stat.S_IWRITE:
+        os.chmod(path, mode | stat.S_IWRITE)
+
+
+def is_synced(src_stat, dst_path):
+    """
+    :param os.stat_result src_stat:
+    :param str dst_path:
+    :return: True if the destination has the size and the modification time of the source.
+    :rtype: bool
+    """
+    try:
+        dst_stat = os.stat(dst_path)
+    except OSError:
+        return False
+    return dst_stat.st_size == src_stat.st_size and \
+        abs(dst_stat.st_mtime - src_stat.st_mtime) <= SYNC_MTIME_TOLERANCE
+
+
+def _normalize_folder(folder):
+    return os.path.join(os.path.normcase(os.path.abspath(folder)), "")
+
+
+def remove_path(path):
+    """
+    Remove a file or a folder tree, even if it is read-only.
+    :param str path:
+    """
+    def on_error(function, failed_path, _):
+        make_writable(failed_path)
+        function(failed_path)
+
+    if os.path.isdir(path) and not os.path.islink(path):
+        make_writable(path)
+        shutil.rmtree(path, onerror=on_error)
+    else:
+        make_writable(path)
+        os.remove(path)
+
+
+def sync_tree(src_folder, dst_folder, copy_engine, keep_readonly=(), remove_stale=False, keep=()):
+    """
+    Copy the files of the source folder that are missing or differ (size or modification time) in the destination
+    folder, in the threads of the copy engine. The copies are made writable as they are copied, except in the
+    keep_readonly folders.
+    With remove_stale, the files and folders of the destination that are not in the source anymore are removed,
+    except the keep_readonly and keep folders and their content. Else nothing is removed from the destination.
+    :param str src_folder:
+    :param str dst_folder:
+    :param CopyEngine copy_engine:
+    :param tuple[str] keep_readonly: destination folders whose files keep the flags of their source.
+    :param bool remove_stale:
+    :param tuple[str] keep: destination folders filled by something else than the sync, never removed.
+    :return: number of files copied, number of files already in sync, bytes copied and number of files and
+        folders removed.
+    :rtype: tuple[int, int, int, int]
+    """
+    readonly_folders = tuple(_normalize_folder(folder) for folder in keep_readonly)
+    kept_folders = readonly_folders + tuple(_normalize_folder(folder) for folder in keep)
+    futures = []
+    skipped = 0
+    copied_bytes = 0
+    removed = 0
+    for dirpath, dirnames, filenames in os.walk(src_folder):
+        dst_dirpath = os.path.join(dst_folder, os.path.relpath(dirpath, src_folder))
+        os.makedirs(dst_dirpath, exist_ok=True)
+        writable = not _normalize_folder(dst_dirpath).startswith(readonly_folders)
+        if writable:
+            make_writable(dst_dirpath)
+        if remove_stale and not _normalize_folder(dst_dirpath).startswith(kept_folders):
+            source_names = {os.path.normcase(name) for name in dirnames + filenames}
+            for entry in os.scandir(dst_dirpath):
+                # A kept folder, or a folder containing one, stays
+                if os.path.normcase(entry.name) in source_names or \
+                        any(folder.startswith(_normalize_folder(entry.path)) for folder in kept_folders):
+                    continue
+                try:
+                    remove_path(entry.path)
+                    removed += 1
+                except OSError as e:
+                    logger.warning(f"Cannot remove {entry.path}, not in {src_folder} anymore: {e}")
+        for filename in filenames:
+            src_path = os.path.join(dirpath, filename)
+            dst_path = os.path.join(dst_dirpath, filename)
+            src_stat = os.stat(src_path)
+            if is_synced(src_stat, dst_path):
+                skipped += 1
+                if writable:
+                    make_writable(dst_path)
+                continue
+            if writable and os.path.exists(dst_path):
+                make_writable(dst_path) #Staged by a previous run, it is replaced
+            copied_bytes += src_stat.st_size
+            futures.append(copy_engine.submit(src_path, dst_path, writable=writable))
+    for future in futures:
+        future.result()
+    return len(futures), skipped, copied_bytes, removed
+
+
+def get_copy_engine():
+    """
+    Get the copy engine of the current process.
+    :return:
+    :rtype: CopyEngine
+    """
+    global _copy_engine
+    if _copy_engine is None:
+        _copy_engine = CopyEngine()
+    return _copy_engine
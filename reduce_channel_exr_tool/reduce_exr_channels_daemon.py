@@ -0,0 +1,324 @@
+import os
+import io
+import sys
+import time
+import heapq
+import argparse
+import threading
+import contextlib
+import concurrent.futures
+from multiprocessing.connection import Listener
+
+import logging
+logger = logging.getLogger(__name__)
+
+from reduce_exr_channels_client import (CANCELLED, DAEMON_ADDRESS, DAEMON_FOLDER, DAEMON_KEY_PATH, DONE, FAILED,
+                                        FINISHED_STATES, QUEUED, RUNNING)
+from reduce_exr_channels_rules import load_channel_rules, set_channel_rules
+from reduce_exr_channels_scheduler import get_default_memory_budget
+from reduce_exr_channels_tool import MAX_PROCESS_WORKERS, create_process_pool, get_sg_env, parse_args, run_shots
+
+# Shots reduced at the same time by default, they share the workers of the pool and the memory budget.
+DEFAULT_MAX_JOBS = 1
+# Finished jobs kept in the status, the oldest are forgotten above it.
+MAX_FINISHED_JOBS = 200
+
+
+class ReduceJob:
+    """
+    A reduce run queued in the daemon, with the command line options of reduce_exr_channels_tool.py.
+    """
+    def __init__(self, job_id, argv, args, priority=0):
+        self.job_id = job_id
+        self.argv = argv
+        self.args = args
+        self.priority = priority
+        self.state = QUEUED
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.failed_shots = []
+        self.error = None
+
+    def get_status(self):
+        """
+        :return:
+        :rtype: dict
+        """
+        end = self.finished or time.time()
+        return {"job_id": self.job_id, "state": self.state, "priority": self.priority, "argv": self.argv,
+                "argv_shots": list(self.args.shot_names) + ([self.args.sequence] if self.args.sequence else []),
+                "submitted": self.submitted, "started": self.started, "finished": self.finished,
+                "duration": end - self.started if self.started else None, "failed_shots": self.failed_shots,
+                "error": self.error}
+
+
+class ReduceDaemon:
+    """
+    Long-running local reduce worker: the SG connection, OIIO and the process pool are started once, and the
+    reduce runs are jobs sent by reduce_exr_channels_client.py on a local socket, authenticated by the key of
+    the user in DAEMON_KEY_PATH.
+    The jobs are queued by priority, then by order of submission, and at most max_jobs of them run at the same
+    time, in threads of the daemon, on the same process pool: the workers of the pool are the cap of the frames
+    treated at the same time across all the shots, and each running job gets its part of the memory budget.
+    The channel rules are the ones of the daemon, the pool workers are initialized with them.
+    When a worker dies, killed when it runs out of memory, the pool is broken: the job running on it fails, and
+    the pool is replaced for the next jobs.
+    """
+    def __init__(self, workers=None, max_jobs=DEFAULT_MAX_JOBS, memory_budget=None):
+        self.workers = min(workers or os.cpu_count() or 1, MAX_PROCESS_WORKERS)
+        self.max_jobs = max(max_jobs, 1)
+        self.memory_budget = memory_budget or get_default_memory_budget()
+        self.jobs = {}
+        self._queue = []
+        self._next_job_id = 1
+        self._running = 0
+        self._stopping = False
+        self._condition = threading.Condition()
+        self._job_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_jobs, thread_name_prefix="job")
+        self.process_executor = self._create_pool()
+
+    def _create_pool(self):
+        return create_process_pool(self.workers)
+
+    def warm_up(self):
+        """
+        Connect to SG, and start all the workers of the pool, so the first job doesn't wait for them.
+        """
+        start = time.perf_counter()
+        get_sg_env()
+        concurrent.futures.wait([self.process_executor.submit(os.getpid) for _ in range(self.workers)])
+        logger.info(f"SG connected and {self.workers} workers started in {time.perf_counter() - start:.1f}s")
+
+    def submit(self, argv, priority=0):
+        """
+        Validate the options of a job and queue it. A job with the same options as a job not finished yet is not
+        queued twice.
+        :param list[str] argv: options of reduce_exr_channels_tool.py.
+        :param int priority:
+        :return: the reply of the request.
+        :rtype: dict
+        """
+        stderr = io.StringIO()
+        try:
+            with contextlib.redirect_stderr(stderr):
+                _, args = parse_args(argv)
+        except SystemExit:
+            return {"ok": False, "error": stderr.getvalue().strip().splitlines()[-1] if stderr.getvalue() else
+                    "Invalid options"}
+        if args.channel_rules:
+            return {"ok": False, "error": "--channel-rules is set for all the jobs, restart the daemon with it"}
+        if not any(option.startswith("--workers") for option in argv):
+            args.workers = self.workers
+        if not args.memory_budget:
+            args.memory_budget = self.memory_budget / self.max_jobs / 1024 ** 3
+        with self._condition:
+            if self._stopping:
+                return {"ok": False, "error": "The daemon is stopping"}
+            same_job = next((job for job in self.jobs.values()
+                             if job.argv == argv and job.state not in FINISHED_STATES), None)
+            if same_job:
+                job = same_job
+                if job.state == QUEUED and priority > job.priority:
+                    job.priority = priority
+                    heapq.heappush(self._queue, (-priority, job.job_id))
+            else:
+                job = ReduceJob(self._next_job_id, argv, args, priority)
+                self._next_job_id += 1
+                self.jobs[job.job_id] = job
+                heapq.heappush(self._queue, (-priority, job.job_id))
+                logger.info(f"Job #{job.job_id} queued: {' '.join(argv)}")
+            queued = sum(1 for other in self.jobs.values() if other.state == QUEUED and other is not job and
+                         (-other.priority, other.job_id) < (-job.priority, job.job_id))
+            self._condition.notify_all()
+        return {"ok": True, "job_id": job.job_id, "queued": queued}
+
+    def cancel(self, job_id):
+        """
+        :param int job_id:
+        :return: the reply of the request.
+        :rtype: dict
+        """
+        with self._condition:
+            job = self.jobs.get(job_id)
+            if not job:
+                return {"ok": False, "error": f"No job #{job_id}"}
+            if job.state != QUEUED:
+                return {"ok": False, "error": f"Job #{job_id} is {job.state}, only the queued jobs can be cancelled"}
+            job.state = CANCELLED
+            job.finished = time.time()
+        return {"ok": True, "message": f"Job #{job_id} cancelled"}
+
+    def get_status(self, job_id=None):
+        """
+        :param int job_id: None for all the jobs.
+        :return: the reply of the request.
+        :rtype: dict
+        """
+        with self._condition:
+            if job_id is not None and job_id not in self.jobs:
+                return {"ok": False, "error": f"No job #{job_id}"}
+            jobs = [self.jobs[job_id]] if job_id is not None else list(self.jobs.values())
+            return {"ok": True, "jobs": [job.get_status() for job in jobs]}
+
+    def shutdown(self):
+        """
+        Stop accepting jobs, cancel the queued ones, the running ones are finished.
+        :return: the reply of the request.
+        :rtype: dict
+        """
+        with self._condition:
+            self._stopping = True
+            for job in self.jobs.values():
+                if job.state == QUEUED:
+                    job.state = CANCELLED
+                    job.finished = time.time()
+            self._condition.notify_all()
+        return {"ok": True, "message": "The daemon stops once its running jobs are finished"}
+
+    def handle_request(self, request):
+        """
+        :param dict request: {"command": "submit", "argv": list[str], "priority": int},
+            {"command": "status" or "cancel", "job_id": int} or {"command": "shutdown"}
+        :return: {"ok": bool, "error": str, ...}
+        :rtype: dict
+        """
+        command = request.get("command")
+        if command == "submit":
+            return self.submit(list(request.get("argv", [])), int(request.get("priority", 0)))
+        if command == "status":
+            return self.get_status(request.get("job_id"))
+        if command == "cancel":
+            return self.cancel(request.get("job_id"))
+        if command == "shutdown":
+            return self.shutdown()
+        return {"ok": False, "error": f"Unknown command {command}"}
+
+    def dispatch(self):
+        """
+        Start the queued jobs, the highest priority first, while less than max_jobs are running. Returns once the
+        daemon is stopping and all the jobs are finished.
+        """
+        while True:
+            with self._condition:
+                # Skip the cancelled jobs, and the previous entries of the jobs whose priority was raised
+                while self._queue and getattr(self.jobs.get(self._queue[0][1]), "state", None) != QUEUED:
+                    heapq.heappop(self._queue)
+                if self._stopping and not self._running:
+                    return
+                if not self._queue or self._running >= self.max_jobs:
+                    self._condition.wait()
+                    continue
+                job = self.jobs[heapq.heappop(self._queue)[1]]
+                job.state = RUNNING
+                job.started = time.time()
+                self._running += 1
+            self._job_executor.submit(self._run_job, job)
+
+    def _run_job(self, job):
+        logger.info(f"Job #{job.job_id} started")
+        with self._condition:
+            process_executor = self.process_executor
+        try:
+            job.failed_shots = run_shots(job.args, process_executor=process_executor)
+            state = FAILED if job.failed_shots else DONE
+        except concurrent.futures.process.BrokenProcessPool as e:
+            logger.error(f"Job #{job.job_id} failed, a worker of the pool died: {e}")
+            job.error = f"A worker of the pool died, probably out of memory: {e}"
+            state = FAILED
+            self._replace_pool(process_executor)
+        except Exception as e:
+            logger.exception(f"Job #{job.job_id} failed")
+            job.error = str(e)
+            state = FAILED
+        with self._condition:
+            job.state = state
+            job.finished = time.time()
+            self._running -= 1
+            self._forget_finished_jobs()
+            self._condition.notify_all()
+        logger.info(f"Job #{job.job_id} {state} in {job.finished - job.started:.0f}s")
+
+    def _replace_pool(self, broken_executor):
+        """
+        Replace a broken pool, unless another job running on it already did.
+        :param concurrent.futures.ProcessPoolExecutor broken_executor:
+        """
+        with self._condition:
+            if self.process_executor is not broken_executor:
+                return
+            self.process_executor = self._create_pool()
+        broken_executor.shutdown(wait=False)
+        logger.info("Process pool replaced")
+
+    def _forget_finished_jobs(self):
+        finished = [job for job in self.jobs.values() if job.state in FINISHED_STATES]
+        for job in sorted(finished, key=lambda job: job.finished)[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            del self.jobs[job.job_id]
+
+    def serve(self):
+        """
+        Accept the requests of the clients until the daemon is stopped, then wait for the running jobs.
+        """
+        key = os.urandom(32)
+        os.makedirs(DAEMON_FOLDER, exist_ok=True)
+        with Listener(DAEMON_ADDRESS, authkey=key) as listener:
+            # The key is only written once the daemon listens, the clients wait for it. It is replaced at once so a
+            # client never reads a partial key.
+            key_tmp_path = f"{DAEMON_KEY_PATH}.{os.getpid()}.tmp"
+            with open(key_tmp_path, "wb") as key_file:
+                key_file.write(key)
+            os.replace(key_tmp_path, DAEMON_KEY_PATH)
+            dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+            dispatcher.start()
+            logger.info(f"Reduce daemon listening on {DAEMON_ADDRESS[0]}:{DAEMON_ADDRESS[1]}, "
+                        f"{self.max_jobs} jobs at a time on {self.workers} workers")
+            while not self._stopping:
+                try:
+                    with listener.accept() as connection:
+                        connection.send(self.handle_request(connection.recv()))
+                except Exception as e:
+                    logger.warning(f"Invalid request: {e}")
+            dispatcher.join()
+        with contextlib.suppress(OSError):
+            os.remove(DAEMON_KEY_PATH)
+        self._job_executor.shutdown()
+        self.process_executor.shutdown()
+        logger.info("Reduce daemon stopped")
+
+
+def main():
+    """
+    Start the reduce daemon. It is started by reduce_exr_channels_client.py when it is not running.
+    """
+    # Importing the tool already configured the logging, force the format naming the job thread of each line.
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(threadName)s %(name)s %(levelname)s %(message)s",
+                        force=True)
+    parser = argparse.ArgumentParser(description="Local reduce daemon, running the jobs of "
+                                                 "reduce_exr_channels_client.py.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Worker processes of the pool shared by all the jobs.")
+    parser.add_argument("--max-jobs", type=int, default=DEFAULT_MAX_JOBS,
+                        help="Jobs running at the same time.")
+    parser.add_argument("--memory-budget", type=float,
+                        help="Memory in GB the workers can use at the same time, shared by the running jobs.")
+    parser.add_argument("--channel-rules", help="JSON file with the channel rules of the show, for all the jobs.")
+    args = parser.parse_args()
+    if args.channel_rules:
+        try:
+            set_channel_rules(load_channel_rules(args.channel_rules))
+        except (OSError, ValueError) as e:
+            parser.error(f"Invalid channel rules {args.channel_rules}: {e}")
+    daemon = ReduceDaemon(args.workers, args.max_jobs,
+                          int(args.memory_budget * 1024 ** 3) if args.memory_budget else None)
+    try:
+        daemon.warm_up()
+    except Exception as e:
+        logger.error(f"Cannot start the reduce daemon: {e}")
+        daemon.process_executor.shutdown()
+        sys.exit(1)
+    daemon.serve()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import os
+import json
+
+import logging
+logger = logging.getLogger(__name__)
+
+from reduce_exr_channels_utils import build_channel_plan, is_half_mask
+
+REPORT = "report"
+DROP = "drop"
+DEDUP_MODES = (REPORT, DROP)
+# Written in the new Layers folder, published with the harmony project, so comp can find the removed channels.
+DUPLICATE_CHANNELS_SIDECAR = "channel_duplicates.json"
+
+
+class ChannelFingerprintRegistry:
+    """
+    Find the channels of a shot with the same content on the whole sequence, from their fingerprints (see
+    ChannelLivenessTracker.get_channel_fingerprints), inside a layer and across the layers.
+    Only the channels kept in the rewritten EXRs are compared, a `.mask` channel with the fingerprint of its
+    source channel. The layers are registered one by one: the first channel registered with a fingerprint is
+    the reference, the next ones are its duplicates. A `.mask` channel stored as half is never the reference of a
+    channel in full precision, the first channel in full precision registered after it becomes the reference.
+    In DROP mode, a layer keeps at least one channel.
+    Register the layers in the same order at each run, so the references don't move.
+    """
+    def __init__(self, mode=REPORT):
+        if mode not in DEDUP_MODES:
+            raise ValueError(f"Unknown duplicate channels mode {mode}, expected one of {DEDUP_MODES}")
+        self.mode = mode
+        self.references = {}
+        self.duplicates = {}
+
+    def register_layer(self, layer_name, channel_fingerprints, empty_channels, matte_channels,
+                       coloroverride_channels, half_masks=()):
+        """
+        Register the channels a layer keeps, and find its duplicate ones.
+        :param str layer_name:
+        :param dict[str, str] channel_fingerprints: {channel_name: fingerprint}, of all the source channels.
+        :param set empty_channels:
+        :param set matte_channels:
+        :param set coloroverride_channels:
+        :param set[str] half_masks: layers whose `.mask` channel is stored as half, see
+            ChannelLivenessTracker.get_half_masks.
+        :return: the output channels of the layer that duplicate a reference, to remove in DROP mode.
+        :rtype: set[str]
+        """
+        channel_names = tuple(channel_fingerprints)
+        new_channels, source_indices = build_channel_plan(channel_names, empty_channels, matte_channels,
+                                                          coloroverride_channels)
+        layer_duplicates = {}
+        for channel_name, source_index in zip(new_channels, source_indices):
+            fingerprint = channel_fingerprints[channel_names[source_index]]
+            if not fingerprint:
+                continue
+            stored_half = is_half_mask(channel_name, half_masks)
+            reference = self.references.get(fingerprint)
+            if reference is None or (reference[2] and not stored_half):
+                self.references[fingerprint] = (layer_name, channel_name, stored_half)
+                continue
+            layer_duplicates[channel_name] = {"layer": reference[0], "channel": reference[1]}
+        if self.mode == DROP and new_channels and len(layer_duplicates) == len(new_channels):
+            # The EXRs need at least one channel, the first one is kept even if it is a duplicate
+            del layer_duplicates[new_channels[0]]
+        if layer_duplicates:
+            self.duplicates[layer_name] = layer_duplicates
+            logger.info(f"{layer_name} - Duplicate channels: {sorted(layer_duplicates)}")
+        return set(layer_duplicates) if self.mode == DROP else set()
+
+    def write_sidecar(self, layers_folder):
+        """
+        Write the mapping of the duplicate channels to their reference, next to the layers.
+        :param str layers_folder:
+        :return: the sidecar path
+        :rtype: str
+        """
+        sidecar_path = os.path.join(layers_folder, DUPLICATE_CHANNELS_SIDECAR)
+        with open(sidecar_path, "w") as sidecar_file:
+            json.dump({"mode": self.mode, "removed": self.mode == DROP, "duplicates": self.duplicates},
+                      sidecar_file, indent=2, sort_keys=True)
+        return sidecar_path
+
+    def report(self):
+        """
+        Log how many channels are duplicates.
+        """
+        count = sum(len(layer_duplicates) for layer_duplicates in self.duplicates.values())
+        action = "removed" if self.mode == DROP else "found"
+        logger.info(f"{count} duplicate channels {action} in {len(self.duplicates)} layers")
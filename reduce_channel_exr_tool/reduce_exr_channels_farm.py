@@ -0,0 +1,341 @@
+import os
+import sys
+import json
+import argparse
+
+import logging
+logger = logging.getLogger(__name__)
+
+from reduce_exr_channels_cache import DEFAULT_CACHE_PATH
+from reduce_exr_channels_rules import get_channel_rules, set_channel_rules
+from reduce_exr_channels_rewrite import (group_identical_frames, log_deduplication, modify_and_copy_exrs,
+                                         rewrite_identical_exr_frames)
+from reduce_exr_channels_utils import (REUSE_DECODED_MAX_BYTES, analyze_exr_frame, analyze_exrs_in_version,
+                                       ChannelLivenessTracker, classify_channels, estimate_decoded_frame_bytes,
+                                       get_analysis_plan, get_new_frame_name)
+
+LAYER = "layer"
+ANALYZE = "analyze"
+REWRITE = "rewrite"
+FINALIZE = "finalize"
+
+# rez packages of the farm tasks, the finalize step also needs SG and the publish.
+FARM_REZ_PACKAGES = ["location_Bunker", "project_", "numpy", "openimageio", "python-3"]
+FINALIZE_REZ_PACKAGES = FARM_REZ_PACKAGES + ["sg", "opencolorio", "multi_publish2"]
+
+
+def write_json_atomic(json_path, data):
+    """
+    Write a JSON file under a temporary name, then rename it, so a task killed during the write never leaves
+    a truncated file that looks valid.
+    :param str json_path:
+    :param data:
+    """
+    os.makedirs(os.path.dirname(json_path), exist_ok=True)
+    tmp_path = f"{json_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as json_file:
+        json.dump(data, json_file, indent=2)
+    os.replace(tmp_path, json_path)
+
+
+def load_manifest(manifest_path):
+    """
+    :param str manifest_path:
+    :return:
+    :rtype: dict
+    """
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+
+def get_task_command(manifest_path, task_id, rez_packages):
+    """
+    Command line running one task of the manifest on any node.
+    :param str manifest_path:
+    :param str task_id:
+    :param list[str] rez_packages:
+    :return:
+    :rtype: list[str]
+    """
+    return ["rez", "env"] + rez_packages + ["--", "python", os.path.abspath(__file__), "run", manifest_path, task_id]
+
+
+def build_farm_manifest(manifest_path, shot_name, sg_task_id, harmony_folders, layer_versions, options,
+                        frames_per_task=0):
+    """
+    Split the treatment of a shot into independent tasks. Without frames_per_task, or when a layer doesn't have
+    more frames, one `layer` task analyses and rewrites the whole layer. Else the layer is split into frame
+    ranges: one `analyze` task per range stores the channel stats of its frames, and one `rewrite` task per
+    range, depending on all the analyses of its layer, merges them and rewrites its frames. The `finalize`
+    task depends on all the others, it stages the harmony project and publishes it on SG.
+    :param str manifest_path:
+    :param str shot_name:
+    :param int sg_task_id:
+    :param HarmonyFolders harmony_folders:
+    :param dict[str, str] layer_versions: {layer_name: layer_version_path}
+    :param dict options: cache, cache_path, rewrite_options, half_tolerance, sample_stride, sample_rows and
+        channel_rules of the tasks.
+    :param int frames_per_task: 0 for one task per layer.
+    :return:
+    :rtype: dict
+    """
+    manifest_path = os.path.abspath(manifest_path)
+    tasks = []
+    for layer_name, layer_version in layer_versions.items():
+        exr_files = sorted(f for f in os.listdir(layer_version) if f.lower().endswith('.exr'))
+        if not frames_per_task or len(exr_files) <= frames_per_task:
+            tasks.append({"id": layer_name, "kind": LAYER, "layer": layer_name, "layer_version": layer_version,
+                          "frames": exr_files, "depends_on": []})
+            continue
+
+        frame_ranges = [exr_files[i:i + frames_per_task] for i in range(0, len(exr_files), frames_per_task)]
+        analyze_ids = [f"{layer_name}.{ANALYZE}.{index:03d}" for index in range(len(frame_ranges))]
+        for index, frames in enumerate(frame_ranges):
+            tasks.append({"id": analyze_ids[index], "kind": ANALYZE, "layer": layer_name,
+                          "layer_version": layer_version, "frames": frames, "depends_on": []})
+        for index, frames in enumerate(frame_ranges):
+            tasks.append({"id": f"{layer_name}.{REWRITE}.{index:03d}", "kind": REWRITE, "layer": layer_name,
+                          "layer_version": layer_version, "frames": frames, "depends_on": analyze_ids})
+    tasks.append({"id": FINALIZE, "kind": FINALIZE, "depends_on": [task["id"] for task in tasks]})
+
+    for task in tasks:
+        rez_packages = FINALIZE_REZ_PACKAGES if task["kind"] == FINALIZE else FARM_REZ_PACKAGES
+        task["command"] = get_task_command(manifest_path, task["id"], rez_packages)
+
+    return {
+        "shot": shot_name,
+        "sg_task_id": sg_task_id,
+        "harmony_folders": harmony_folders._asdict(),
+        "work_dir": os.path.splitext(manifest_path)[0] + "_tasks",
+        "options": options,
+        "tasks": tasks,
+    }
+
+
+def write_farm_manifest(manifest_path, *args, **kwargs):
+    """
+    Build the manifest of a shot, see build_farm_manifest, and write it.
+    :param str manifest_path:
+    :return:
+    :rtype: dict
+    """
+    manifest = build_farm_manifest(manifest_path, *args, **kwargs)
+    write_json_atomic(os.path.abspath(manifest_path), manifest)
+    logger.info(f"Farm manifest of {manifest['shot']} written to {manifest_path}: "
+                f"{len(manifest['tasks']) - 1} tasks and the finalize step")
+    return manifest
+
+
+def get_done_path(manifest, task_id):
+    """
+    The file written when a task succeeded, with its result.
+    :param dict manifest:
+    :param str task_id:
+    :return:
+    :rtype: str
+    """
+    return os.path.join(manifest["work_dir"], "done", f"{task_id}.json")
+
+
+def get_task_result(manifest, task_id):
+    """
+    :param dict manifest:
+    :param str task_id:
+    :return: the result of a task that succeeded, None if it didn't run yet.
+    :rtype: dict or None
+    """
+    try:
+        with open(get_done_path(manifest, task_id)) as done_file:
+            return json.load(done_file)["result"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def get_task_cache_path(options):
+    """
+    The stats cache of the tasks is the default one of the node, unless the manifest gives one.
+    :param dict options:
+    :return:
+    :rtype: str or None
+    """
+    if not options.get("cache"):
+        return None
+    return options.get("cache_path") or DEFAULT_CACHE_PATH
+
+
+def get_task_destination(manifest, task):
+    """
+    Get the new version folder of the layer of a task, and its version label.
+    :param dict manifest:
+    :param dict task:
+    :return:
+    :rtype: str, str
+    """
+    new_ver_path = os.path.join(manifest["harmony_folders"]["layers_folder"], task["layer"])
+    os.makedirs(new_ver_path, exist_ok=True)
+    return new_ver_path, os.path.basename(os.path.normpath(task["layer_version"]))
+
+
+def run_layer_task(manifest, task):
+    """
+    Analyse and rewrite a whole layer, like layer_treatment of the tool. A layer without EXRs is only copied.
+    :param dict manifest:
+    :param dict task:
+    """
+    options = manifest["options"]
+    layer_version = task["layer_version"]
+    exr_files = task["frames"]
+    keep_pixels = bool(exr_files) and \
+        estimate_decoded_frame_bytes(os.path.join(layer_version, exr_files[0])) * len(exr_files) <= REUSE_DECODED_MAX_BYTES
+    empty_channels, matte_channels, coloroverride_channels, exrs, decoded_frames, half_masks = \
+        analyze_exrs_in_version(layer_version, keep_pixels=keep_pixels, cache_path=get_task_cache_path(options),
+                                half_tolerance=options.get("half_tolerance"),
+                                sample_stride=options.get("sample_stride", 0), sample_rows=options.get("sample_rows", 0))
+    new_ver_path, new_ver_label = get_task_destination(manifest, task)
+    modify_and_copy_exrs(layer_version, new_ver_path, new_ver_label, exrs,
+                         empty_channels, matte_channels, coloroverride_channels, decoded_frames,
+                         **dict(options.get("rewrite_options") or {}, half_masks=half_masks))
+
+
+def run_analyze_task(manifest, task):
+    """
+    Analyse a frame range of a layer.
+    :param dict manifest:
+    :param dict task:
+    :return: the merged channel stats of the range, and its mask source channels that failed the half check.
+    :rtype: dict
+    """
+    options = manifest["options"]
+    tracker = ChannelLivenessTracker(options.get("half_tolerance"), coverage=bool(get_channel_rules().near_empty))
+    analysis_plan = get_analysis_plan(task["frames"], options.get("sample_stride", 0),
+                                      options.get("sample_rows", 0) if tracker.can_sample_rows else 0)
+    for read_index, (fname, chunk_step) in enumerate(analysis_plan):
+        if tracker.all_decided():
+            logger.info(f"{task['id']} - All channels decided after {read_index} reads, "
+                        f"skip the {len(analysis_plan) - read_index} remaining ones")
+            break
+        frame_stats = analyze_exr_frame(os.path.join(task["layer_version"], fname),
+                                        skip_channels=tracker.decided_channels,
+                                        cache_path=get_task_cache_path(options),
+                                        half_check_channels=tracker.half_check_channels,
+                                        coverage=tracker.coverage, chunk_step=chunk_step)
+        if frame_stats:
+            channel_names, frame_channel_stats, _ = frame_stats
+            tracker.update(channel_names, frame_channel_stats)
+    return {"channel_stats": tracker.channel_stats, "half_failed_channels": sorted(tracker.half_failed_channels)}
+
+
+def run_rewrite_task(manifest, task):
+    """
+    Merge the analyses of all the frame ranges of a layer, and rewrite the frames of this range.
+    :param dict manifest:
+    :param dict task:
+    """
+    options = manifest["options"]
+    tracker = ChannelLivenessTracker(options.get("half_tolerance"))
+    for analyze_id in task["depends_on"]:
+        result = get_task_result(manifest, analyze_id)
+        if result is None:
+            raise RuntimeError(f"The analysis {analyze_id} is not done, cannot rewrite {task['id']}")
+        # The stats of a range are merged like the ones of one frame, their max and half error are kept
+        tracker.update(tuple(result["channel_stats"]), result["channel_stats"])
+        tracker.half_failed_channels.update(result["half_failed_channels"])
+    empty_channels, matte_channels, coloroverride_channels = classify_channels(tracker.channel_stats)
+    rewrite_options = dict(options.get("rewrite_options") or {}, half_masks=tracker.get_half_masks())
+
+    new_ver_path, new_ver_label = get_task_destination(manifest, task)
+    frame_groups = group_identical_frames(task["layer_version"], task["frames"])
+    log_deduplication(frame_groups, task["layer"])
+    for fname, duplicates in frame_groups.items():
+        dst_paths = [os.path.join(new_ver_path, get_new_frame_name(f, new_ver_label)) for f in [fname] + duplicates]
+        rewrite_identical_exr_frames(os.path.join(task["layer_version"], fname), dst_paths, empty_channels,
+                                     matte_channels, coloroverride_channels, **rewrite_options)
+
+
+def run_finalize_task(manifest, task):
+    """
+    Once all the tasks are done, stage the harmony project and publish it on SG.
+    :param dict manifest:
+    :param dict task:
+    """
+    missing = [task_id for task_id in task["depends_on"] if get_task_result(manifest, task_id) is None]
+    if missing:
+        raise RuntimeError(f"{len(missing)} tasks are not done: {missing}")
+
+    from reduce_exr_channels_tool import HarmonyFolders, publish_version_on_sg, stage_harmony_project
+    harmony_folders = HarmonyFolders(**manifest["harmony_folders"])
+    stage_harmony_project(harmony_folders)
+    publish_version_on_sg(harmony_folders.local_harmony_folder, manifest["sg_task_id"])
+
+
+TASK_RUNNERS = {LAYER: run_layer_task, ANALYZE: run_analyze_task, REWRITE: run_rewrite_task,
+                FINALIZE: run_finalize_task}
+
+
+def run_task(manifest_path, task_id, force=False):
+    """
+    Stand-alone entry point of a farm task. A task that already succeeded is skipped, unless forced, so the
+    farm can re-run any task. The outputs of a task are always written again from the sources, a task killed
+    in the middle only has to run again.
+    :param str manifest_path:
+    :param str task_id:
+    :param bool force: run the task even if it already succeeded.
+    """
+    manifest = load_manifest(manifest_path)
+    task = next((task for task in manifest["tasks"] if task["id"] == task_id), None)
+    if not task:
+        raise ValueError(f"No task {task_id} in {manifest_path}")
+    if not force and get_task_result(manifest, task_id) is not None:
+        logger.info(f"Task {task_id} already done, skipped")
+        return
+
+    set_channel_rules(manifest["options"].get("channel_rules"))
+    logger.info(f"Running the {task['kind']} task {task_id} of {manifest['shot']}")
+    result = TASK_RUNNERS[task["kind"]](manifest, task)
+    write_json_atomic(get_done_path(manifest, task_id), {"task": task_id, "result": result or {}})
+    logger.info(f"Task {task_id} done")
+
+
+def log_status(manifest_path):
+    """
+    Log the tasks of a manifest that are not done yet.
+    :param str manifest_path:
+    """
+    manifest = load_manifest(manifest_path)
+    pending = [task["id"] for task in manifest["tasks"] if get_task_result(manifest, task["id"]) is None]
+    logger.info(f"{len(manifest['tasks']) - len(pending)}/{len(manifest['tasks'])} tasks done")
+    for task_id in pending:
+        logger.info(f"Not done: {task_id}")
+
+
+def main():
+    """
+    Entry point of the farm nodes, for the manifests written by reduce_exr_channels_tool.py --farm-manifest:
+    python reduce_exr_channels_farm.py run X:/path/to/manifest.json layer_name
+    python reduce_exr_channels_farm.py status X:/path/to/manifest.json
+    """
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Run the farm tasks of the reduce channels tool.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run one task of a manifest.")
+    run_parser.add_argument("manifest")
+    run_parser.add_argument("task_id")
+    run_parser.add_argument("--force", action="store_true", help="Run the task even if it is already done.")
+
+    status_parser = subparsers.add_parser("status", help="List the tasks of a manifest that are not done.")
+    status_parser.add_argument("manifest")
+
+    args = parser.parse_args()
+    if args.command == "status":
+        log_status(args.manifest)
+        return
+    try:
+        run_task(args.manifest, args.task_id, force=args.force)
+    except Exception as e:
+        logger.error(f"Task {args.task_id} failed: {e}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+import os
+import time
+import sqlite3
+import argparse
+
+import logging
+logger = logging.getLogger(__name__)
+
+from reduce_exr_channels_utils import build_channel_plan
+
+DEFAULT_HISTORY_PATH = os.path.join(os.getenv("LOCALAPPDATA", os.path.expanduser("~")),
+                                    "reduce_channel_tool", "channel_history.sqlite")
+# Seconds to wait on a history locked by another run before giving up.
+HISTORY_LOCK_TIMEOUT = 30
+
+# Classes of the source channels of a layer in the rewritten EXRs.
+KEPT = "kept"
+MASK = "mask"
+MERGED = "merged" # Other components of a layer kept as a `.mask` channel
+EMPTY = "empty"
+DUPLICATE = "duplicate"
+CHANNEL_CLASSES = (KEPT, MASK, MERGED, EMPTY, DUPLICATE)
+
+
+def get_channel_classes(channel_names, empty_channels, matte_channels, coloroverride_channels,
+                        duplicate_channels=()):
+    """
+    Find what the rewrite does with each source channel of a layer, from the same plan as the rewrite.
+    :param tuple[str] channel_names:
+    :param set empty_channels:
+    :param set matte_channels:
+    :param set coloroverride_channels:
+    :param set[str] duplicate_channels: output channels removed, see ChannelFingerprintRegistry.
+    :return: {channel_name: one of CHANNEL_CLASSES}
+    :rtype: dict[str, str]
+    """
+    new_channels, source_indices = build_channel_plan(channel_names, empty_channels, matte_channels,
+                                                      coloroverride_channels)
+    outputs = dict(zip(source_indices, new_channels))
+    channel_classes = {}
+    for i, channel_name in enumerate(channel_names):
+        if i not in outputs:
+            channel_classes[channel_name] = EMPTY if channel_name.split('.')[0] in empty_channels else MERGED
+        elif outputs[i] in duplicate_channels:
+            channel_classes[channel_name] = DUPLICATE
+        else:
+            channel_classes[channel_name] = MASK if outputs[i].endswith(".mask") else KEPT
+    return channel_classes
+
+
+def get_folder_bytes(folder):
+    """
+    :param str folder:
+    :return: size of the files of the folder, 0 if it doesn't exist.
+    :rtype: int
+    """
+    if not os.path.isdir(folder):
+        return 0
+    return sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+
+
+class ChannelHistory:
+    """
+    History of the channel classification of every layer processed by the tool, for the show-wide trends and as
+    a prior of the analysis. Each run of a shot records, for each of its analysed layers, the class of each source
+    channel (see CHANNEL_CLASSES), the first frame where it was proven non-empty, and the bytes of the layer before
+    and after the rewrite. The trends only count the last run of each layer of each shot.
+    It is a SQLite database in WAL mode, shared by the runs of the machine. Any error with the history is only
+    logged, the run doesn't depend on it.
+    """
+    def __init__(self, history_path=DEFAULT_HISTORY_PATH):
+        self.history_path = history_path
+        os.makedirs(os.path.dirname(history_path), exist_ok=True)
+        self._connection = sqlite3.connect(history_path, timeout=HISTORY_LOCK_TIMEOUT)
+        try:
+            with self._connection:
+                self._connection.execute("PRAGMA journal_mode=WAL")
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, shot TEXT, version TEXT, created REAL)")
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS layers (run_id INTEGER, shot TEXT, layer TEXT, frames INTEGER, "
+                    "source_bytes INTEGER, output_bytes INTEGER, PRIMARY KEY (run_id, layer))")
+                self._connection.execute(
+                    "CREATE TABLE IF NOT EXISTS channels (run_id INTEGER, shot TEXT, layer TEXT, channel TEXT, "
+                    "class TEXT, live_frame TEXT, PRIMARY KEY (run_id, layer, channel))")
+                self._connection.execute("CREATE INDEX IF NOT EXISTS layers_shot ON layers (shot, layer)")
+                # The last run of each layer of each shot
+                self._connection.execute(
+                    "CREATE TEMP VIEW IF NOT EXISTS last_layers AS SELECT * FROM layers WHERE run_id = "
+                    "(SELECT MAX(run_id) FROM layers AS other WHERE other.shot = layers.shot AND "
+                    "other.layer = layers.layer)")
+                self._connection.execute(
+                    "CREATE TEMP VIEW IF NOT EXISTS last_channels AS SELECT channels.* FROM channels JOIN last_layers "
+                    "ON channels.run_id = last_layers.run_id AND channels.layer = last_layers.layer")
+        except sqlite3.Error:
+            self._connection.close()
+            raise
+
+    def record_run(self, shot_name, version, layers):
+        """
+        Record the layers analysed by a run of a shot, once their rewrites are done. A layer whose output is
+        missing frames is not recorded, its rewrite failed.
+        :param str shot_name:
+        :param str version:
+        :param dict[str, dict] layers: {layer_name: {"channels": {channel_name: class},
+            "live_frames": {channel_name: frame_key or None}, "source": layer_version_path, "output": path}}
+        """
+        try:
+            recorded = 0
+            with self._connection:
+                run_id = self._connection.execute("INSERT INTO runs (shot, version, created) VALUES (?, ?, ?)",
+                                                  (shot_name, version, time.time())).lastrowid
+                for layer_name, layer in layers.items():
+                    source_files = [f for f in os.listdir(layer["source"]) if f.lower().endswith('.exr')]
+                    output_files = [f for f in os.listdir(layer["output"]) if f.lower().endswith('.exr')] \
+                        if os.path.isdir(layer["output"]) else []
+                    if len(output_files) < len(source_files):
+                        logger.warning(f"{layer_name} - Output incomplete, not recorded in the channel history")
+                        continue
+                    self._connection.execute("INSERT INTO layers VALUES (?, ?, ?, ?, ?, ?)",
+                                             (run_id, shot_name, layer_name, len(source_files),
+                                              get_folder_bytes(layer["source"]), get_folder_bytes(layer["output"])))
+                    self._connection.executemany(
+                        "INSERT INTO channels VALUES (?, ?, ?, ?, ?, ?)",
+                        [(run_id, shot_name, layer_name, channel_name, channel_class,
+                          layer["live_frames"].get(channel_name))
+                         for channel_name, channel_class in layer["channels"].items()])
+                    recorded += 1
+            logger.info(f"Channel classification of {recorded} layers recorded in {self.history_path}")
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Cannot record the run of {shot_name} in the channel history: {e}")
+
+    def get_prior_frames(self, shot_name, layer_name):
+        """
+        Get the frames where the last run of this layer of the shot proved its channels non-empty. Reading them
+        first decides most of the channels with a few reads, and the analysis stops as soon as all are decided.
+        :param str shot_name:
+        :param str layer_name:
+        :return: frame keys, see get_frame_key.
+        :rtype: list[str]
+        """
+        try:
+            rows = self._connection.execute(
+                "SELECT DISTINCT live_frame FROM last_channels WHERE shot = ? AND layer = ? AND "
+                "live_frame IS NOT NULL ORDER BY live_frame", (shot_name, layer_name)).fetchall()
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Cannot read the channel history of {layer_name}: {e}")
+            return []
+        return [row[0] for row in rows]
+
+    def get_shot_summary(self, shot_name=None):
+        """
+        :param str shot_name: None for all the shots.
+        :return: for each shot, its layers, frames, channels of each class and bytes before and after the rewrite.
+        :rtype: list[dict]
+        """
+        class_counts = ", ".join(f"(SELECT COUNT(*) FROM last_channels WHERE last_channels.shot = last_layers.shot "
+                                 f"AND class = '{channel_class}') AS {channel_class}"
+                                 for channel_class in CHANNEL_CLASSES)
+        rows = self._connection.execute(
+            f"SELECT shot, COUNT(*), SUM(frames), SUM(source_bytes), SUM(output_bytes), {class_counts} "
+            f"FROM last_layers WHERE ? IS NULL OR shot = ? GROUP BY shot ORDER BY shot",
+            (shot_name, shot_name)).fetchall()
+        return [dict(zip(("shot", "layers", "frames", "source_bytes", "output_bytes") + CHANNEL_CLASSES, row))
+                for row in rows]
+
+    def get_channel_trends(self, min_layers=1):
+        """
+        How each channel name is classified across the layers of all the shots: the channels always empty are
+        candidates for the always empty rules of the show.
+        :param int min_layers: only the channels seen in at least this number of layers.
+        :return:
+        :rtype: list[dict]
+        """
+        class_counts = ", ".join(f"SUM(class = '{channel_class}')" for channel_class in CHANNEL_CLASSES)
+        rows = self._connection.execute(
+            f"SELECT channel, COUNT(*), COUNT(DISTINCT shot), {class_counts} FROM last_channels GROUP BY channel "
+            f"HAVING COUNT(*) >= ? ORDER BY SUM(class = '{EMPTY}') * 1.0 / COUNT(*) DESC, COUNT(*) DESC",
+            (min_layers,)).fetchall()
+        return [dict(zip(("channel", "layers", "shots") + CHANNEL_CLASSES, row)) for row in rows]
+
+    def get_layer_trends(self):
+        """
+        The bytes saved on each layer name across the shots.
+        :return:
+        :rtype: list[dict]
+        """
+        rows = self._connection.execute(
+            "SELECT layer, COUNT(*), SUM(frames), SUM(source_bytes), SUM(output_bytes) FROM last_layers "
+            "GROUP BY layer ORDER BY SUM(source_bytes) - SUM(output_bytes) DESC").fetchall()
+        return [dict(zip(("layer", "shots", "frames", "source_bytes", "output_bytes"), row)) for row in rows]
+
+    def close(self):
+        self._connection.close()
+
+
+def open_channel_history(history_path):
+    """
+    Open the channel history of a run. A history that can't be opened (locked, unwritable or unreachable) is
+    only logged, the run goes on without it.
+    :param str history_path:
+    :return: None if the history can't be opened.
+    :rtype: ChannelHistory or None
+    """
+    try:
+        return ChannelHistory(history_path)
+    except (OSError, sqlite3.Error) as e:
+        logger.warning(f"Channel history {history_path} unavailable, the run doesn't use nor update it: {e}")
+        return None
+
+
+def format_saved(source_bytes, output_bytes):
+    """
+    :param int source_bytes:
+    :param int output_bytes:
+    :return:
+    :rtype: str
+    """
+    saved = (source_bytes or 0) - (output_bytes or 0)
+    return f"{saved / 1024 ** 3:.2f} GB saved ({saved / source_bytes if source_bytes else 0:.0%})"
+
+
+def main():
+    """
+    Report the show-wide trends of the channel history:
+    python reduce_exr_channels_history.py shots [--shot SH010]
+    python reduce_exr_channels_history.py channels [--min-layers 10] [--limit 50]
+    python reduce_exr_channels_history.py layers [--limit 50]
+    """
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description="Query the channel history of the reduce channels tool.")
+    parser.add_argument("--history", default=DEFAULT_HISTORY_PATH, help="Location of the channel history.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    shots_parser = subparsers.add_parser("shots", help="Channels of each class and bytes saved, per shot.")
+    shots_parser.add_argument("--shot", help="Only this shot.")
+
+    channels_parser = subparsers.add_parser("channels", help="Classes of each channel name across the shots, the "
+                                                             "most often empty first.")
+    channels_parser.add_argument("--min-layers", type=int, default=1,
+                                 help="Only the channels seen in at least this number of layers.")
+    channels_parser.add_argument("--limit", type=int, default=50)
+
+    layers_parser = subparsers.add_parser("layers", help="Bytes saved per layer name across the shots.")
+    layers_parser.add_argument("--limit", type=int, default=50)
+
+    args = parser.parse_args()
+    if not os.path.exists(args.history):
+        parser.error(f"No channel history at {args.history}")
+    history = ChannelHistory(args.history)
+    try:
+        if args.command == "shots":
+            for shot in history.get_shot_summary(args.shot):
+                classes = ", ".join(f"{shot[channel_class]} {channel_class}" for channel_class in CHANNEL_CLASSES)
+                logger.info(f"{shot['shot']}: {shot['layers']} layers, {shot['frames']} frames, channels: {classes}, "
+                            f"{format_saved(shot['source_bytes'], shot['output_bytes'])}")
+        elif args.command == "channels":
+            for channel in history.get_channel_trends(args.min_layers)[:args.limit]:
+                classes = ", ".join(f"{channel[channel_class] / channel['layers']:.0%} {channel_class}"
+                                    for channel_class in CHANNEL_CLASSES if channel[channel_class])
+                logger.info(f"{channel['channel']}: {channel['layers']} layers in {channel['shots']} shots, "
+                            f"{classes}")
+        else:
+            for layer in history.get_layer_trends()[:args.limit]:
+                logger.info(f"{layer['layer']}: {layer['shots']} shots, {layer['frames']} frames, "
+                            f"{format_saved(layer['source_bytes'], layer['output_bytes'])}")
+    finally:
+        history.close()
+
+
+if __name__ == "__main__":
+    main()
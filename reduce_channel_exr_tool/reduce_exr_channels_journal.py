@@ -0,0 +1,218 @@
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Seconds to wait on a journal locked by another thread before giving up.
+JOURNAL_LOCK_TIMEOUT = 30
+# Suffix of the outputs being written, they are renamed to their final name once complete.
+PARTIAL_SUFFIX = ".partial"
+
+
+def get_journal_path(harmony_folders):
+    """
+    The journal of a run lives next to its harmony folder, in the reduce_channel_tool_folders workspace.
+    :param HarmonyFolders harmony_folders:
+    :return:
+    :rtype: str
+    """
+    return f"{harmony_folders.local_harmony_folder}.journal.sqlite"
+
+
+def get_run_signature(options):
+    """
+    Hash of everything that changes the outputs besides the source frames: an output written with other options
+    is not reused.
+    :param dict options: JSON serializable.
+    :return:
+    :rtype: str
+    """
+    return hashlib.blake2b(json.dumps(options, sort_keys=True, default=sorted).encode(), digest_size=16).hexdigest()
+
+
+def get_layer_plan(empty_channels, matte_channels, coloroverride_channels, half_masks=(), duplicate_channels=()):
+    """
+    Hash of the channel plan of a layer, decided from all its frames: an output written with another plan is not
+    reused, so all the frames of a layer always have the same channels.
+    :param set empty_channels:
+    :param set matte_channels:
+    :param set coloroverride_channels:
+    :param set[str] half_masks:
+    :param set[str] duplicate_channels:
+    :return:
+    :rtype: str
+    """
+    return get_run_signature({"empty": empty_channels, "matte": matte_channels,
+                              "coloroverride": coloroverride_channels, "half_masks": half_masks,
+                              "duplicate_channels": duplicate_channels})
+
+
+def get_partial_path(dst_path):
+    """
+    Temporary name of an output while it is written, with the same extension, so OIIO picks the same format.
+    :param str dst_path:
+    :return:
+    :rtype: str
+    """
+    root, extension = os.path.splitext(dst_path)
+    return f"{root}{PARTIAL_SUFFIX}{extension}"
+
+
+def remove_partial_outputs(folder):
+    """
+    Remove the EXR outputs left incomplete by a run that died, only the names given by get_partial_path: other
+    files of the folder can have the suffix in their name.
+    :param str folder:
+    :return: number of removed files
+    :rtype: int
+    """
+    removed = 0
+    for dirpath, _, filenames in os.walk(folder):
+        for filename in filenames:
+            root, extension = os.path.splitext(filename)
+            if extension.lower() == ".exr" and root.endswith(PARTIAL_SUFFIX):
+                try:
+                    os.remove(os.path.join(dirpath, filename))
+                    removed += 1
+                except OSError as e:
+                    logger.warning(f"Cannot remove the partial output {filename}: {e}")
+    return removed
+
+
+def _file_identity(file_path):
+    file_stat = os.stat(file_path)
+    return file_stat.st_size, file_stat.st_mtime_ns
+
+
+def _folder_identity(folder):
+    identities = [(fname, *_file_identity(os.path.join(folder, fname))) for fname in sorted(os.listdir(folder))]
+    return hashlib.blake2b(json.dumps(identities).encode(), digest_size=16).hexdigest()
+
+
+class RunJournal:
+    """
+    Journal of the outputs completed by the runs of a shot, to resume a run that died. Each output frame is
+    recorded once it is complete, with the size and modification time of its source frame and its own, and the
+    signature of the run options and the plan of its layer (see get_layer_plan). An output is only reused when its
+    source, itself, the options and the plan didn't change since it was recorded. The plan of each layer is
+    recorded with the identity of all its source frames, a layer is only skipped without its analysis when none of
+    its frames changed, was added or removed. The outputs are written under a partial name and renamed, so an
+    output with its final name is never a truncated file.
+    It is a SQLite database, the records are written by the threads of the main process.
+    """
+    def __init__(self, journal_path, signature):
+        self.journal_path = journal_path
+        self.signature = signature
+        self.skipped = 0
+        self.recorded = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(journal_path, timeout=JOURNAL_LOCK_TIMEOUT, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS outputs (dst TEXT PRIMARY KEY, src TEXT, src_size INTEGER, "
+                "src_mtime_ns INTEGER, dst_size INTEGER, dst_mtime_ns INTEGER, signature TEXT, plan TEXT)")
+            if "plan" not in {row[1] for row in self._connection.execute("PRAGMA table_info(outputs)")}:
+                # Journal of a previous version of the tool, its outputs have no plan and are never reused
+                self._connection.execute("ALTER TABLE outputs ADD COLUMN plan TEXT")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS layers (dst TEXT PRIMARY KEY, sources TEXT, plan TEXT, signature TEXT)")
+
+    @staticmethod
+    def _key(path):
+        return os.path.normcase(os.path.abspath(path))
+
+    def _is_output_done(self, src_path, dst_path, plan):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT src, src_size, src_mtime_ns, dst_size, dst_mtime_ns, signature, plan FROM outputs "
+                "WHERE dst = ?", (self._key(dst_path),)).fetchone()
+        if not row or row[0] != self._key(src_path) or row[5] != self.signature or row[6] != plan:
+            return False
+        try:
+            return (row[1], row[2]) == _file_identity(src_path) and (row[3], row[4]) == _file_identity(dst_path)
+        except OSError:
+            return False
+
+    def is_done(self, outputs, plan):
+        """
+        :param list[tuple[str, str]] outputs: (src_path, dst_path) of the outputs of one frame and its
+            identical frames.
+        :param str plan: see get_layer_plan.
+        :return: True if all the outputs are complete and up to date, they don't have to be written again.
+        :rtype: bool
+        """
+        done = all(self._is_output_done(src_path, dst_path, plan) for src_path, dst_path in outputs)
+        if done:
+            with self._lock:
+                self.skipped += len(outputs)
+        return done
+
+    def is_folder_done(self, src_folder, dst_folder, get_dst_name):
+        """
+        :param str src_folder:
+        :param str dst_folder:
+        :param callable get_dst_name: name of the output of a source file.
+        :return: True if the source frames didn't change since the plan of the layer was recorded, and all of them
+            have their output with this plan, the folder is skipped without its analysis.
+        :rtype: bool
+        """
+        fnames = os.listdir(src_folder) if os.path.isdir(src_folder) else []
+        if not fnames:
+            return False
+        with self._lock:
+            row = self._connection.execute("SELECT sources, plan, signature FROM layers WHERE dst = ?",
+                                           (self._key(dst_folder),)).fetchone()
+        try:
+            if not row or row[2] != self.signature or row[0] != _folder_identity(src_folder):
+                return False
+        except OSError:
+            return False
+        return self.is_done([(os.path.join(src_folder, fname), os.path.join(dst_folder, get_dst_name(fname)))
+                             for fname in fnames], row[1])
+
+    def record_layer(self, src_folder, dst_folder, plan):
+        """
+        Record the plan of a layer once it is decided, with the identity of all its source frames.
+        :param str src_folder:
+        :param str dst_folder:
+        :param str plan: see get_layer_plan.
+        """
+        try:
+            sources = _folder_identity(src_folder)
+            with self._lock, self._connection:
+                self._connection.execute("INSERT OR REPLACE INTO layers VALUES (?, ?, ?, ?)",
+                                         (self._key(dst_folder), sources, plan, self.signature))
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Cannot record the plan of {dst_folder} in the journal: {e}")
+
+    def record(self, outputs, plan):
+        """
+        Record complete outputs.
+        :param list[tuple[str, str]] outputs: (src_path, dst_path)
+        :param str plan: see get_layer_plan.
+        """
+        try:
+            rows = [(self._key(dst_path), self._key(src_path), *_file_identity(src_path), *_file_identity(dst_path),
+                     self.signature, plan) for src_path, dst_path in outputs]
+            with self._lock, self._connection:
+                self._connection.executemany("INSERT OR REPLACE INTO outputs (dst, src, src_size, src_mtime_ns, "
+                                             "dst_size, dst_mtime_ns, signature, plan) "
+                                             "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                self.recorded += len(rows)
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"Cannot record {len(outputs)} outputs in the journal: {e}")
+
+    def report(self):
+        """
+        Log how many outputs were reused from a previous run.
+        """
+        logger.info(f"Journal {self.journal_path}: {self.skipped} outputs reused from a previous run, "
+                    f"{self.recorded} recorded.")
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
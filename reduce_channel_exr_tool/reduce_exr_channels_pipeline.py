@@ -0,0 +1,155 @@
+import time
+import queue
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Items waiting between two stages. It bounds the frames decoded ahead of the transform and the write.
+DEFAULT_QUEUE_SIZE = 4
+# Threads of the read, transform and write stages of the rewrite of a layer. OIIO and numpy release the GIL
+# while they decode, copy and encode the pixels.
+DEFAULT_STAGE_WORKERS = (2, 2, 2)
+
+_END = object()
+
+
+class PipelineStage:
+    """
+    One stage of a StagedPipeline, and its counters.
+    """
+    def __init__(self, name, fn, workers, queue_size):
+        self.name = name
+        self.fn = fn
+        self.workers = max(workers, 1)
+        self.input_queue = queue.Queue(maxsize=queue_size)
+        self.processed = 0
+        self.busy_seconds = 0.0
+        self.wait_seconds = 0.0
+        self.depth_samples = 0
+        self.depth_sum = 0
+        self.max_depth = 0
+        self._running_workers = self.workers
+        self._lock = threading.Lock()
+
+    def sample_depth(self):
+        depth = self.input_queue.qsize()
+        with self._lock:
+            self.depth_samples += 1
+            self.depth_sum += depth
+            self.max_depth = max(self.max_depth, depth)
+
+    def worker_done(self):
+        """
+        :return: True for the last worker of the stage to stop.
+        :rtype: bool
+        """
+        with self._lock:
+            self._running_workers -= 1
+            return not self._running_workers
+
+
+class StagedPipeline:
+    """
+    Run items through a chain of stages, each one with its own threads, and a bounded queue in front of each
+    stage, so a slow stage blocks the previous ones instead of letting the items pile up in memory.
+    The reads of the next frames, the transform of the current ones and the writes of the previous ones overlap,
+    the disks and the cores are busy at the same time.
+    Each stage function takes the item of the previous stage and returns the item of the next one, None to
+    stop there. The first exception stops the pipeline, the items still queued are dropped, and run raises it.
+    """
+    def __init__(self, stages, queue_size=DEFAULT_QUEUE_SIZE):
+        """
+        :param list[tuple[str, callable, int]] stages: (name, fn, workers) of each stage, in order.
+        :param int queue_size:
+        """
+        self.stages = [PipelineStage(name, fn, workers, queue_size) for name, fn, workers in stages]
+        self.duration = 0.0
+        self._error = None
+        self._stopped = threading.Event()
+
+    def run(self, items):
+        """
+        Feed the items to the first stage, and wait until the last stage is done with all of them.
+        :param iterable items:
+        """
+        threads = [threading.Thread(target=self._work, args=(stage_index,), daemon=True)
+                   for stage_index, stage in enumerate(self.stages) for _ in range(stage.workers)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        first_stage = self.stages[0]
+        try:
+            for item in items:
+                if self._stopped.is_set():
+                    break
+                first_stage.sample_depth()
+                first_stage.input_queue.put(item)
+        finally:
+            for _ in range(first_stage.workers):
+                first_stage.input_queue.put(_END)
+            for thread in threads:
+                thread.join()
+            self.duration = time.perf_counter() - start
+        if self._error:
+            raise self._error
+
+    def _work(self, stage_index):
+        stage = self.stages[stage_index]
+        next_stage = self.stages[stage_index + 1] if stage_index + 1 < len(self.stages) else None
+        while True:
+            wait_start = time.perf_counter()
+            item = stage.input_queue.get()
+            busy_start = time.perf_counter()
+            if item is _END:
+                break
+            if self._stopped.is_set():
+                continue #Drain the queue, so the previous stages are not blocked
+            try:
+                result = stage.fn(item)
+            except Exception as e:
+                self._error = self._error or e
+                self._stopped.set()
+                continue
+            with stage._lock:
+                stage.processed += 1
+                stage.busy_seconds += time.perf_counter() - busy_start
+                stage.wait_seconds += busy_start - wait_start
+            if next_stage and result is not None:
+                next_stage.sample_depth()
+                next_stage.input_queue.put(result)
+        if stage.worker_done() and next_stage:
+            for _ in range(next_stage.workers):
+                next_stage.input_queue.put(_END)
+
+    def stats(self):
+        """
+        Get the counters of each stage: the items it processed and their throughput, the time its workers were
+        busy (utilization is busy over the duration of the run, for all its workers) or waiting for items, and the
+        depth of its input queue when items were added.
+        :return:
+        :rtype: dict[str, dict]
+        """
+        stats = {}
+        for stage in self.stages:
+            stats[stage.name] = {
+                "workers": stage.workers,
+                "processed": stage.processed,
+                "throughput": stage.processed / self.duration if self.duration else 0.0,
+                "busy_seconds": stage.busy_seconds,
+                "wait_seconds": stage.wait_seconds,
+                "utilization": stage.busy_seconds / (self.duration * stage.workers) if self.duration else 0.0,
+                "mean_queue_depth": stage.depth_sum / stage.depth_samples if stage.depth_samples else 0.0,
+                "max_queue_depth": stage.max_depth,
+            }
+        return stats
+
+    def report(self, prefix=""):
+        """
+        Log the counters of each stage, the busiest stage is the one to give more workers.
+        :param str prefix:
+        """
+        for name, stage_stats in self.stats().items():
+            logger.info(f"{prefix}{name}: {stage_stats['processed']} items, {stage_stats['throughput']:.1f}/s with "
+                        f"{stage_stats['workers']} workers, {stage_stats['utilization']:.0%} busy, queue depth "
+                        f"{stage_stats['mean_queue_depth']:.1f} mean, {stage_stats['max_queue_depth']} max")
@@ -0,0 +1,197 @@
+import os
+import shutil
+import hashlib
+import tempfile
+import threading
+import collections
+import concurrent.futures
+
+import logging
+logger = logging.getLogger(__name__)
+
+DEFAULT_SCRATCH_ROOT = os.path.join(os.getenv("LOCALAPPDATA", tempfile.gettempdir()),
+                                    "reduce_channel_tool", "prefetch")
+# Frames fetched ahead of the readers, and the bytes they can hold on the scratch disk.
+DEFAULT_PREFETCH_DEPTH = 8
+DEFAULT_PREFETCH_MAX_BYTES = 4 * 1024 ** 3
+PREFETCH_BLOCK_BYTES = 4 * 1024 ** 2
+
+
+def get_scratch_path(image_path, scratch_dir):
+    """
+    Location of the prefetched copy of a frame. It only depends on the source path, so the workers find it
+    without talking to the prefetcher.
+    :param str image_path:
+    :param str scratch_dir:
+    :return:
+    :rtype: str
+    """
+    key = hashlib.md5(os.path.normcase(os.path.abspath(image_path)).encode("utf-8")).hexdigest()
+    return os.path.join(scratch_dir, key + os.path.splitext(image_path)[1])
+
+
+def get_read_path(image_path, scratch_dir=None):
+    """
+    Get the file to decode for the given frame: its prefetched copy if it is complete, else the frame itself.
+    :param str image_path:
+    :param str scratch_dir:
+    :return:
+    :rtype: str
+    """
+    if scratch_dir:
+        scratch_path = get_scratch_path(image_path, scratch_dir)
+        if os.path.exists(scratch_path):
+            return scratch_path
+    return image_path
+
+
+class FramePrefetcher:
+    """
+    Read the next frames from the network shares in background threads, while the current ones are decoded.
+    With a scratch_dir, the frames are copied on the local disk, and get_read_path gives the copy to the
+    readers once it is complete (written under a temporary name, then renamed). OIIO can't decode from a
+    Python buffer, so without scratch_dir the frames are only read once to warm the OS file cache.
+    At most depth frames are fetched and not yet consumed, and at most max_bytes stay on the scratch disk.
+    The frames are fetched in the order of the requests, a request whose reader already started is skipped,
+    and the copy is removed when its reader is done.
+    """
+    def __init__(self, depth=DEFAULT_PREFETCH_DEPTH, max_bytes=DEFAULT_PREFETCH_MAX_BYTES, scratch_dir=None):
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.scratch_dir = scratch_dir
+        if scratch_dir:
+            os.makedirs(scratch_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(depth, 1))
+        self._queue = collections.OrderedDict()
+        self._readers = {}
+        self._active = {}
+        self.held_bytes = 0
+        self.fetched_bytes = 0
+        self.fetched = 0
+        self.skipped = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def request(self, image_path):
+        """
+        Queue the fetch of a frame that will be read soon.
+        :param str image_path:
+        """
+        with self._lock:
+            if image_path in self._queue or image_path in self._active:
+                return
+            self._queue[image_path] = None
+        self._pump()
+
+    def attach(self, image_path, reader_future):
+        """
+        Give the task that reads the frame: the fetch is skipped if the task starts first, and the copy is
+        removed when it is done.
+        :param str image_path:
+        :param concurrent.futures.Future reader_future:
+        """
+        self.request(image_path)
+        with self._lock:
+            self._readers[image_path] = reader_future
+        reader_future.add_done_callback(lambda done: self.release(image_path))
+
+    def discard(self, image_path):
+        """
+        The frame won't be read, remove it from the queue or the scratch disk.
+        :param str image_path:
+        """
+        self.release(image_path)
+
+    def _reader_started(self, image_path):
+        reader_future = self._readers.get(image_path)
+        return reader_future is not None and (reader_future.running() or reader_future.done())
+
+    def _pump(self):
+        started = []
+        with self._lock:
+            for image_path in list(self._queue):
+                if len(self._active) >= self.depth:
+                    break
+                if self._reader_started(image_path):
+                    del self._queue[image_path]
+                    self.skipped += 1
+                    continue
+                try:
+                    size = os.path.getsize(image_path)
+                except OSError:
+                    del self._queue[image_path]
+                    continue
+                if self.scratch_dir and self._active and self.held_bytes + size > self.max_bytes:
+                    break
+                del self._queue[image_path]
+                self._active[image_path] = size
+                self.held_bytes += size if self.scratch_dir else 0
+                started.append(image_path)
+        for image_path in started:
+            self._executor.submit(self._fetch, image_path)
+
+    def _fetch(self, image_path):
+        try:
+            if self.scratch_dir:
+                scratch_path = get_scratch_path(image_path, self.scratch_dir)
+                partial_path = scratch_path + ".partial"
+                with open(image_path, "rb") as src_file, open(partial_path, "wb") as dst_file:
+                    shutil.copyfileobj(src_file, dst_file, PREFETCH_BLOCK_BYTES)
+                with self._lock:
+                    released = image_path not in self._active
+                    if not released:
+                        os.replace(partial_path, scratch_path)
+                if released: #The reader finished during the copy
+                    if os.path.exists(partial_path):
+                        os.remove(partial_path)
+                    return
+            else:
+                with open(image_path, "rb") as src_file:
+                    while src_file.read(PREFETCH_BLOCK_BYTES):
+                        pass
+            with self._lock:
+                self.fetched += 1
+                self.fetched_bytes += os.path.getsize(image_path)
+        except OSError as e:
+            logger.warning(f"Cannot prefetch {image_path}: {e}")
+            self.release(image_path)
+        self._pump()
+
+    def release(self, image_path):
+        """
+        The frame was read, remove its copy from the scratch disk.
+        :param str image_path:
+        """
+        with self._lock:
+            self._queue.pop(image_path, None)
+            self._readers.pop(image_path, None)
+            size = self._active.pop(image_path, None)
+            if size is not None and self.scratch_dir:
+                self.held_bytes -= size
+        if size is not None and self.scratch_dir:
+            scratch_path = get_scratch_path(image_path, self.scratch_dir)
+            for path in (scratch_path, scratch_path + ".partial"):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        self._pump()
+
+    def report(self):
+        """
+        Log how many frames were prefetched.
+        """
+        logger.info(f"Prefetched {self.fetched} frames ({self.fetched_bytes / 1024 ** 2:.0f} MB), "
+                    f"{self.skipped} started before their prefetch.")
+
+    def close(self):
+        with self._lock:
+            self._queue.clear()
+        self._executor.shutdown()
+        if self.scratch_dir:
+            shutil.rmtree(self.scratch_dir, ignore_errors=True)
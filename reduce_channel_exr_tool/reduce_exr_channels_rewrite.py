@@ -0,0 +1,424 @@
+import os
+import hashlib
+import concurrent.futures
+import numpy as np
+import OpenImageIO as oiio
+
+import logging
+logger = logging.getLogger(__name__)
+
+from reduce_exr_channels_copy import get_copy_engine
+from reduce_exr_channels_journal import get_layer_plan, get_partial_path
+from reduce_exr_channels_pipeline import DEFAULT_STAGE_WORKERS, StagedPipeline
+from reduce_exr_channels_prefetch import get_read_path
+from reduce_exr_channels_utils import ANALYSIS_CHUNK_ROWS, build_channel_plan, get_new_frame_name, is_half_mask
+
+# Compressions we allow for the rewritten EXRs. dwaa/dwab accept a level, like "dwaa:45", and are lossy.
+EXR_COMPRESSIONS = ("none", "rle", "zips", "zip", "piz", "pxr24", "b44", "b44a", "dwaa", "dwab")
+# Attributes of the source EXR that don't describe the new file.
+SKIPPED_ATTRIBUTES = ("oiio:subimages", "compression")
+# Size of the blocks read to hash the frames, and number of frames hashed at the same time.
+HASH_BLOCK_BYTES = 4 * 1024 ** 2
+HASH_THREADS = 8
+# Options of rewrite_exr_frame used by its transform stage, the other ones are used by its read stage.
+TRANSFORM_OPTIONS = ("compression", "mask_compression", "crop_data_window")
+
+
+def is_valid_compression(compression):
+    """
+    :param str compression: EXR compression name, with an optional level, like "dwaa:45".
+    :return:
+    :rtype: bool
+    """
+    return compression.split(':')[0].lower() in EXR_COMPRESSIONS
+
+
+def get_data_window(np_pixels, channel_indices):
+    """
+    Get the bounding box of the non-zero pixels of the given channels. It is computed by blocks of rows, to not
+    allocate a copy of the frame.
+    :param np.ndarray np_pixels: (height, width, channels)
+    :param list[int] channel_indices:
+    :return: (ybegin, yend, xbegin, xend), None if all the pixels are 0.
+    :rtype: tuple[int, int, int, int] or None
+    """
+    height, width = np_pixels.shape[:2]
+    occupied_rows = np.zeros(height, dtype=bool)
+    occupied_columns = np.zeros(width, dtype=bool)
+    for ybegin in range(0, height, ANALYSIS_CHUNK_ROWS):
+        occupied = np.take(np_pixels[ybegin:ybegin + ANALYSIS_CHUNK_ROWS], channel_indices, axis=2).any(axis=2)
+        occupied_rows[ybegin:ybegin + ANALYSIS_CHUNK_ROWS] = occupied.any(axis=1)
+        occupied_columns |= occupied.any(axis=0)
+
+    rows = np.flatnonzero(occupied_rows)
+    if not rows.size:
+        return None
+    columns = np.flatnonzero(occupied_columns)
+    return int(rows[0]), int(rows[-1]) + 1, int(columns[0]), int(columns[-1]) + 1
+
+
+def get_channel_formats(spec, new_channels, source_indices, half_masks=()):
+    """
+    Get the format of each new channel: half for the `.mask` channels of the layers in half_masks, and the
+    format of the source channel for the others.
+    :param oiio.ImageSpec spec:
+    :param list[str] new_channels:
+    :param list[int] source_indices:
+    :param set[str] half_masks:
+    :return:
+    :rtype: list[oiio.TypeDesc]
+    """
+    return [oiio.TypeDesc(oiio.HALF) if is_half_mask(channel_name, half_masks) else spec.channelformat(source_index)
+            for channel_name, source_index in zip(new_channels, source_indices)]
+
+
+def build_output_spec(spec, new_channels, compression=None, data_window=None, channel_formats=None):
+    """
+    Create the spec of the rewritten EXR from the source one: same size, format and attributes, with the new
+    channels. The compression of the source is kept, unless another one is given.
+    The data window can be cropped, relative to the source one, the display window stays the same.
+    :param oiio.ImageSpec spec:
+    :param list[str] new_channels:
+    :param str compression:
+    :param tuple[int, int, int, int] data_window: (ybegin, yend, xbegin, xend)
+    :param list[oiio.TypeDesc] channel_formats: format of each new channel, if they are not all the same.
+    :return:
+    :rtype: oiio.ImageSpec
+    """
+    ybegin, yend, xbegin, xend = data_window or (0, spec.height, 0, spec.width)
+    out_spec = oiio.ImageSpec()
+    out_spec.x = spec.x + xbegin
+    out_spec.y = spec.y + ybegin
+    out_spec.width = xend - xbegin
+    out_spec.height = yend - ybegin
+    out_spec.full_x = spec.full_x
+    out_spec.full_y = spec.full_y
+    out_spec.full_width = spec.full_width
+    out_spec.full_height = spec.full_height
+    out_spec.nchannels = len(new_channels)
+    out_spec.channelnames = new_channels
+    out_spec.format = spec.format #We want to be sure we use the format of the input EXR
+    if channel_formats and any(channel_format != spec.format for channel_format in channel_formats):
+        out_spec.channelformats = tuple(channel_formats)
+    for attrib in spec.extra_attribs:
+        if attrib.name not in SKIPPED_ATTRIBUTES:
+            out_spec.attribute(attrib.name, attrib.type, attrib.value)
+    out_spec.attribute("compression", compression or spec.getattribute("compression") or "zip")
+    return out_spec
+
+
+def rewrite_exr_frame(src_path, dst_path, empty_channels, matte_channels, coloroverride_channels,
+                      decoded_frame=None, compression=None, mask_compression=None, crop_data_window=True,
+                      half_masks=(), prefetch_dir=None, duplicate_channels=()):
+    """
+    Rewrite one EXR without its empty channels and its duplicate channels, and with the mattes and color
+    overrides as `.mask` channels.
+    If there is nothing to change, the file is only copied with the CopyEngine of the process.
+    Only the range of source channels we keep is decoded, and the output buffer is allocated once and filled
+    by an indexed copy from the source buffer.
+    The source compression is kept, unless compression is given. mask_compression is used instead for the
+    EXRs that only contain `.mask` channels.
+    With crop_data_window, the data window is cropped to the non-zero pixels of the channels we keep.
+    The `.mask` channels of the layers in half_masks are stored as half, the other channels keep their source
+    format.
+    With a prefetch_dir, the frame is decoded from its copy by the FramePrefetcher, if it is ready.
+    This is the unit of work of the rewrite, it can run in a worker process. It runs its read, transform and write
+    stages one after the other, modify_and_copy_exrs runs them in a StagedPipeline.
+    :param str src_path:
+    :param str dst_path:
+    :param set empty_channels:
+    :param set matte_channels:
+    :param set coloroverride_channels:
+    :param tuple[oiio.ImageSpec, np.ndarray] decoded_frame: frame already decoded during the analysis.
+    :param str compression:
+    :param str mask_compression:
+    :param bool crop_data_window:
+    :param set[str] half_masks: layers verified by the analysis, see ChannelLivenessTracker.get_half_masks.
+    :param str prefetch_dir: scratch folder of the FramePrefetcher.
+    :param set[str] duplicate_channels: output channels removed, see ChannelFingerprintRegistry.
+    """
+    if not empty_channels and not matte_channels and not coloroverride_channels and not duplicate_channels:
+        get_copy_engine().copy(src_path, dst_path)
+        return
+
+    source = read_rewrite_source(src_path, empty_channels, matte_channels, coloroverride_channels, decoded_frame,
+                                 half_masks, prefetch_dir, duplicate_channels)
+    out_spec, final_data = transform_rewrite_source(*source, compression=compression,
+                                                    mask_compression=mask_compression,
+                                                    crop_data_window=crop_data_window)
+    write_exr_frame(dst_path, out_spec, final_data)
+
+
+def read_rewrite_source(src_path, empty_channels, matte_channels, coloroverride_channels, decoded_frame=None,
+                        half_masks=(), prefetch_dir=None, duplicate_channels=()):
+    """
+    Read stage of rewrite_exr_frame: build the channel plan of the frame, and decode the range of source channels
+    we keep, unless the frame was already decoded during the analysis.
+    :param str src_path:
+    :param set empty_channels:
+    :param set matte_channels:
+    :param set coloroverride_channels:
+    :param tuple[oiio.ImageSpec, np.ndarray] decoded_frame:
+    :param set[str] half_masks:
+    :param str prefetch_dir:
+    :param set[str] duplicate_channels:
+    :return: the source spec and pixels, the output channel names, the index of their source channel in the
+        pixels, and their formats.
+    :rtype: tuple[oiio.ImageSpec, np.ndarray or None, list[str], list[int], list[oiio.TypeDesc]]
+    """
+    if decoded_frame:
+        spec, np_pixels = decoded_frame
+        new_channels, source_indices = build_channel_plan(spec.channelnames, empty_channels, matte_channels,
+                                                          coloroverride_channels, duplicate_channels)
+        channel_formats = get_channel_formats(spec, new_channels, source_indices, half_masks)
+    else:
+        inp = oiio.ImageInput.open(get_read_path(src_path, prefetch_dir))
+        spec = inp.spec()
+        new_channels, source_indices = build_channel_plan(spec.channelnames, empty_channels, matte_channels,
+                                                          coloroverride_channels, duplicate_channels)
+        np_pixels = None
+        channel_formats = get_channel_formats(spec, new_channels, source_indices, half_masks)
+        if source_indices:
+            chbegin, chend = min(source_indices), max(source_indices) + 1
+            pixels = inp.read_image(0, 0, chbegin, chend, oiio.FLOAT)
+            np_pixels = np.asarray(pixels).reshape((spec.height, spec.width, chend - chbegin))
+            source_indices = [i - chbegin for i in source_indices]
+        inp.close()
+    return spec, np_pixels, new_channels, source_indices, channel_formats
+
+
+def transform_rewrite_source(spec, np_pixels, new_channels, source_indices, channel_formats, compression=None,
+                             mask_compression=None, crop_data_window=True):
+    """
+    Transform stage of rewrite_exr_frame: crop the data window, and copy the kept channels in the output buffer.
+    :param oiio.ImageSpec spec:
+    :param np.ndarray np_pixels:
+    :param list[str] new_channels:
+    :param list[int] source_indices:
+    :param list[oiio.TypeDesc] channel_formats:
+    :param str compression:
+    :param str mask_compression:
+    :param bool crop_data_window:
+    :return: the spec and the pixels of the output EXR.
+    :rtype: tuple[oiio.ImageSpec, np.ndarray]
+    """
+    data_window = None
+    if source_indices:
+        if crop_data_window:
+            # EXRs need at least one pixel in the data window
+            data_window = get_data_window(np_pixels, source_indices) or (0, 1, 0, 1)
+        ybegin, yend, xbegin, xend = data_window or (0, spec.height, 0, spec.width)
+        final_data = np.empty((yend - ybegin, xend - xbegin, len(source_indices)), dtype=np.float32)
+        np.take(np_pixels[ybegin:yend, xbegin:xend], source_indices, axis=2, out=final_data, mode='clip')
+    else: #If channel is empty, create an empty EXR
+        final_data = np.empty((0, 0, 0))
+
+    if mask_compression and new_channels and all(channel.endswith(".mask") for channel in new_channels):
+        compression = mask_compression
+    return build_output_spec(spec, new_channels, compression, data_window, channel_formats), final_data
+
+
+def write_exr_frame(dst_path, out_spec, final_data):
+    """
+    Write stage of rewrite_exr_frame. The EXR is written under a partial name and renamed once complete.
+    :param str dst_path:
+    :param oiio.ImageSpec out_spec:
+    :param np.ndarray final_data:
+    """
+    partial_path = get_partial_path(dst_path)
+    for path in (dst_path, partial_path):
+        if os.path.lexists(path):
+            os.remove(path) #A previous output can be hardlinked to other frames, don't write through it
+    out = oiio.ImageOutput.create(partial_path)
+    if not out or not out.open(partial_path, out_spec):
+        raise OSError(f"Cannot write {dst_path}: {oiio.geterror()}")
+    written = out.write_image(final_data)
+    out.close()
+    if not written:
+        os.remove(partial_path)
+        raise OSError(f"Cannot write {dst_path}: {out.geterror()}")
+    os.replace(partial_path, dst_path)
+
+
+def hash_file(file_path):
+    """
+    Hash the content of a file, streaming it by blocks.
+    :param str file_path:
+    :return:
+    :rtype: str
+    """
+    file_hash = hashlib.blake2b(digest_size=32)
+    with open(file_path, "rb") as file_handle:
+        for block in iter(lambda: file_handle.read(HASH_BLOCK_BYTES), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def group_identical_frames(version_path, exr_files):
+    """
+    Group the byte-identical frames of a layer, the held poses and the animation on 2s or 3s of Harmony.
+    Only the frames with the same file size as another one are hashed.
+    :param str version_path:
+    :param list[str] exr_files:
+    :return: {first_frame: [identical frames]}, with one entry for each unique frame, in the exr_files order.
+    :rtype: dict[str, list[str]]
+    """
+    by_size = {}
+    for fname in exr_files:
+        by_size.setdefault(os.path.getsize(os.path.join(version_path, fname)), []).append(fname)
+    to_hash = [fname for fnames in by_size.values() if len(fnames) > 1 for fname in fnames]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=HASH_THREADS) as executor:
+        hashes = dict(zip(to_hash, executor.map(hash_file, [os.path.join(version_path, f) for f in to_hash])))
+
+    groups = {}
+    first_frames = {}
+    for fname in exr_files:
+        key = (os.path.getsize(os.path.join(version_path, fname)), hashes.get(fname, fname))
+        first_frame = first_frames.setdefault(key, fname)
+        groups.setdefault(first_frame, [])
+        if first_frame != fname:
+            groups[first_frame].append(fname)
+    return groups
+
+
+def log_deduplication(frame_groups, layer_name=None):
+    """
+    Log the deduplication ratio of a layer.
+    :param dict[str, list[str]] frame_groups: result of group_identical_frames
+    :param str layer_name: prefix of the message, when several layers are treated at the same time.
+    """
+    frames_count = len(frame_groups) + sum(len(duplicates) for duplicates in frame_groups.values())
+    if frames_count:
+        prefix = f"{layer_name} - " if layer_name else ""
+        logger.info(f"{prefix}{len(frame_groups)} unique frames out of {frames_count}, "
+                    f"{1 - len(frame_groups) / frames_count:.0%} deduplicated")
+
+
+def rewrite_identical_exr_frames(src_path, dst_paths, empty_channels, matte_channels, coloroverride_channels,
+                                 decoded_frame=None, **rewrite_options):
+    """
+    Rewrite one frame with rewrite_exr_frame, and give its result to all the identical frames: they are
+    hardlinked to it, or copied, with the CopyEngine of the process.
+    :param str src_path:
+    :param list[str] dst_paths: output of the frame, and of its identical frames.
+    :param set empty_channels:
+    :param set matte_channels:
+    :param set coloroverride_channels:
+    :param tuple[oiio.ImageSpec, np.ndarray] decoded_frame:
+    :param rewrite_options: options of rewrite_exr_frame
+    """
+    rewrite_exr_frame(src_path, dst_paths[0], empty_channels, matte_channels, coloroverride_channels,
+                      decoded_frame, **rewrite_options)
+    for dst_path in dst_paths[1:]:
+        get_copy_engine().copy(dst_paths[0], dst_path, shared=True)
+
+
+def get_frame_outputs(src_version, dst_version, new_version_label, fnames):
+    """
+    :param str src_version:
+    :param str dst_version:
+    :param list[str] fnames: a frame and its identical frames.
+    :return: (src_path, dst_path) of each frame.
+    :rtype: list[tuple[str, str]]
+    """
+    return [(os.path.join(src_version, fname), os.path.join(dst_version, get_new_frame_name(fname, new_version_label)))
+            for fname in fnames]
+
+
+def modify_and_copy_exrs(src_version, dst_version, new_version_label, exr_files,
+                         empty_channels, matte_channels, coloroverride_channels, decoded_frames=None,
+                         prefetcher=None, stage_workers=DEFAULT_STAGE_WORKERS, journal=None, **rewrite_options):
+    """
+    Modify the given EXRs and save it to its new version folder, using empty_channel, matte_channels and
+    coloroverride_channels dicts to find which channel we need to remove, or update before copying.
+    Frames already decoded during the analysis are taken from decoded_frames instead of being read again.
+    Identical frames are only rewritten once. With a prefetcher, the next frames to decode are fetched while the
+    current one is rewritten.
+    The frames go through a StagedPipeline of the read, transform and write stages of rewrite_exr_frame, so the
+    reads of the next frames and the writes of the previous ones overlap. The counters of the stages are logged.
+    With a journal, the plan of the layer is recorded, the frames whose outputs are already done with this plan
+    are skipped, and the new outputs are recorded.
+    :param str src_version:
+    :param str dst_version:
+    :param list[str] exr_files:
+    :param dict empty_channels:
+    :param dict matte_channels:
+    :param dict coloroverride_channels:
+    :param dict decoded_frames:
+    :param FramePrefetcher prefetcher:
+    :param tuple[int, int, int] stage_workers: threads of the read, transform and write stages.
+    :param RunJournal journal:
+    :param rewrite_options: options of rewrite_exr_frame (compression, mask_compression, crop_data_window,
+        half_masks)
+    :return: the counters of the stages, see StagedPipeline.stats.
+    :rtype: dict[str, dict]
+    """
+    decoded_frames = decoded_frames or {}
+    frame_groups = group_identical_frames(src_version, exr_files)
+    log_deduplication(frame_groups)
+    # Only the frames that were not kept by the analysis are read again
+    to_read = [os.path.join(src_version, fname) for fname in frame_groups if fname not in decoded_frames]
+    read_index = {image_path: i for i, image_path in enumerate(to_read)}
+    if prefetcher:
+        rewrite_options["prefetch_dir"] = prefetcher.scratch_dir
+    transform_options = {option: rewrite_options.pop(option) for option in TRANSFORM_OPTIONS
+                         if option in rewrite_options}
+    copy_only = not empty_channels and not matte_channels and not coloroverride_channels and \
+        not rewrite_options.get("duplicate_channels")
+    plan = get_layer_plan(empty_channels, matte_channels, coloroverride_channels,
+                          rewrite_options.get("half_masks", ()), rewrite_options.get("duplicate_channels", ()))
+    if journal:
+        journal.record_layer(src_version, dst_version, plan)
+
+    def iter_frames():
+        for fname, duplicates in frame_groups.items():
+            for duplicate in duplicates:
+                decoded_frames.pop(duplicate, None)
+            src_path = os.path.join(src_version, fname)
+            outputs = get_frame_outputs(src_version, dst_version, new_version_label, [fname] + duplicates)
+            if journal and journal.is_done(outputs, plan):
+                decoded_frames.pop(fname, None)
+                if prefetcher:
+                    prefetcher.discard(src_path)
+                continue
+            if prefetcher and src_path in read_index:
+                next_index = read_index[src_path] + 1
+                for image_path in to_read[next_index:next_index + prefetcher.depth]:
+                    prefetcher.request(image_path)
+            yield src_path, outputs, decoded_frames.pop(fname, None)
+
+    def read_stage(frame):
+        src_path, outputs, decoded_frame = frame
+        try:
+            if copy_only:
+                return src_path, outputs, None
+            return src_path, outputs, read_rewrite_source(src_path, empty_channels, matte_channels,
+                                                          coloroverride_channels, decoded_frame, **rewrite_options)
+        finally:
+            if prefetcher:
+                prefetcher.release(src_path)
+
+    def transform_stage(frame):
+        src_path, outputs, source = frame
+        if source is None:
+            return frame
+        return src_path, outputs, transform_rewrite_source(*source, **transform_options)
+
+    def write_stage(frame):
+        src_path, outputs, output = frame
+        dst_paths = [dst_path for _, dst_path in outputs]
+        if output:
+            write_exr_frame(dst_paths[0], *output)
+        else:
+            get_copy_engine().copy(src_path, dst_paths[0])
+        for dst_path in dst_paths[1:]:
+            get_copy_engine().copy(dst_paths[0], dst_path, shared=True)
+        if journal:
+            journal.record(outputs, plan)
+
+    read_workers, transform_workers, write_workers = stage_workers
+    pipeline = StagedPipeline([("read", read_stage, read_workers), ("transform", transform_stage, transform_workers),
+                               ("write", write_stage, write_workers)])
+    pipeline.run(iter_frames())
+    pipeline.report(prefix="Rewrite ")
+    return pipeline.stats()
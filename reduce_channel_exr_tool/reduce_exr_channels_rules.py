@@ -0,0 +1,167 @@
+import json
+import functools
+import collections
+
+import logging
+logger = logging.getLogger(__name__)
+
+# How the Harmony layers are treated, from the names of their channels. The patterns are searched, lowercase,
+# in the whole channel name. A show can give its own rules as a JSON file with the same structure.
+DEFAULT_CHANNEL_RULES = {
+    # Layers kept only as a `.mask` channel, made from one of their components. When a layer matches several
+    # rules, the first one gives its component.
+    "mask_rules": [
+        {"name": "coloroverride", "patterns": ["coloroverride", "colour-override"], "component": "R"},
+        {"name": "matte", "patterns": ["matte"], "component": "A"},
+    ],
+    # Channels always removed, without reading their values, unless they also match an exception.
+    "always_empty": {"patterns": ["tonal"], "except": ["matte"]},
+    # A show can add "near_empty": {"noise_threshold": 1e-6, "min_coverage": 1e-5}, to also remove the channels
+    # that are only noise: in each frame, at most min_coverage of their pixels (a fraction) are above
+    # noise_threshold (absolute value). Without it, only the channels at 0 on all the frames are empty.
+}
+# The mask rules give the matte and color override groups of classify_channels.
+MASK_RULE_NAMES = ("coloroverride", "matte")
+# Thresholds of the coverage stats of the analysis, a noise_threshold is rounded down to one of them.
+NEAR_EMPTY_EDGES = (0.0, 1e-8, 1e-7, 1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0)
+
+ChannelMatch = collections.namedtuple("ChannelMatch", ["base", "always_empty", "mask_groups", "mask_source"])
+CompiledChannels = collections.namedtuple("CompiledChannels", ["matches", "always_empty", "mask_sources"])
+
+_channel_rules = None
+
+
+class ChannelRules:
+    """
+    Declarative rules of the channel classification, compiled once per channel name and once per tuple of
+    channel names: the frames of a layer almost always share the same channel list, so the string checks are
+    only done for the first one.
+    """
+    def __init__(self, config=None):
+        self.config = config or DEFAULT_CHANNEL_RULES
+        self.mask_rules = self.config.get("mask_rules", [])
+        for rule in self.mask_rules:
+            if rule.get("name") not in MASK_RULE_NAMES or not rule.get("patterns") or not rule.get("component"):
+                raise ValueError(f"Invalid mask rule {rule}, it needs a name in {MASK_RULE_NAMES}, "
+                                 f"patterns and a component")
+        always_empty = self.config.get("always_empty", {})
+        self.always_empty_patterns = [pattern.lower() for pattern in always_empty.get("patterns", [])]
+        self.always_empty_exceptions = [pattern.lower() for pattern in always_empty.get("except", [])]
+        self.near_empty = self.config.get("near_empty")
+        self.noise_edge_index = 0
+        if self.near_empty:
+            noise_threshold = self.near_empty.get("noise_threshold", 0.0)
+            min_coverage = self.near_empty.get("min_coverage", 0.0)
+            if noise_threshold < 0 or not 0 <= min_coverage < 1:
+                raise ValueError(f"Invalid near_empty {self.near_empty}, it needs a noise_threshold >= 0 and "
+                                 f"a min_coverage in [0, 1[")
+            self.noise_edge_index = max(i for i, edge in enumerate(NEAR_EMPTY_EDGES) if edge <= noise_threshold)
+        self.match = functools.lru_cache(maxsize=None)(self._match)
+        self.compile = functools.lru_cache(maxsize=None)(self._compile)
+        self.channel_plan = functools.lru_cache(maxsize=4096)(self._channel_plan)
+
+    def _match(self, channel_name):
+        """
+        Apply the rules to one channel name.
+        :param str channel_name:
+        :return:
+        :rtype: ChannelMatch
+        """
+        lower_name = channel_name.lower()
+        always_empty = any(pattern in lower_name for pattern in self.always_empty_patterns) and \
+            not any(pattern in lower_name for pattern in self.always_empty_exceptions)
+        mask_groups = tuple(rule["name"] for rule in self.mask_rules
+                            if any(pattern.lower() in lower_name for pattern in rule["patterns"]))
+        mask_source = False
+        if mask_groups:
+            first_rule = next(rule for rule in self.mask_rules if rule["name"] == mask_groups[0])
+            mask_source = channel_name.endswith(f".{first_rule['component']}")
+        return ChannelMatch(channel_name.split('.')[0], always_empty, mask_groups, mask_source)
+
+    def is_near_empty(self, channel_stat, edge_index=None, min_coverage=None):
+        """
+        Check the coverage stats of a channel against the near_empty thresholds.
+        :param dict channel_stat: with the "coverage" of the analysis, the fraction of the pixels above each of
+            the NEAR_EMPTY_EDGES, the max of all the frames.
+        :param int edge_index: noise threshold in NEAR_EMPTY_EDGES, by default the one of the rules.
+        :param float min_coverage: by default the one of the rules.
+        :return: True if the channel only has noise. Always False without near_empty rules or coverage stats.
+        :rtype: bool
+        """
+        if "coverage" not in channel_stat or (not self.near_empty and edge_index is None):
+            return False
+        if edge_index is None:
+            edge_index = self.noise_edge_index
+        if min_coverage is None:
+            min_coverage = (self.near_empty or {}).get("min_coverage", 0.0)
+        return channel_stat["coverage"][edge_index] <= min_coverage
+
+    def _compile(self, channel_names):
+        """
+        Apply the rules to a tuple of channel names.
+        :param tuple[str] channel_names:
+        :return:
+        :rtype: CompiledChannels
+        """
+        matches = tuple(self.match(channel_name) for channel_name in channel_names)
+        return CompiledChannels(matches,
+                                frozenset(i for i, match in enumerate(matches) if match.always_empty),
+                                frozenset(i for i, match in enumerate(matches) if match.mask_source))
+
+    def _channel_plan(self, channel_names, empty_channels, matte_channels, coloroverride_channels):
+        """
+        Index plan of the rewrite, see reduce_exr_channels_utils.build_channel_plan.
+        """
+        layer_groups = {"matte": matte_channels, "coloroverride": coloroverride_channels}
+        new_channels = []
+        source_indices = []
+        mask_indices = {}
+        for i, match in enumerate(self.compile(channel_names).matches):
+            if match.base in empty_channels:
+                continue # Skip completely
+            rule = next((rule for rule in self.mask_rules if match.base in layer_groups[rule["name"]]), None)
+            if rule:
+                if channel_names[i].endswith(f".{rule['component']}"):
+                    mask_indices[match.base] = i
+                continue
+            new_channels.append(channel_names[i])
+            source_indices.append(i)
+
+        # Inject the masks at the end
+        for base, mask_index in mask_indices.items():
+            new_channels.append(f"{base}.mask")
+            source_indices.append(mask_index)
+        return tuple(new_channels), tuple(source_indices)
+
+
+def load_channel_rules(rules_path):
+    """
+    Load the channel rules of a show from a JSON file.
+    :param str rules_path:
+    :return:
+    :rtype: dict
+    """
+    with open(rules_path) as rules_file:
+        config = json.load(rules_file)
+    ChannelRules(config) # Validate it before it is sent to the workers
+    return config
+
+
+def set_channel_rules(config=None):
+    """
+    Set the channel rules of the current process. It is the initializer of the workers of the pool.
+    :param dict config: None for the default rules.
+    """
+    global _channel_rules
+    _channel_rules = ChannelRules(config)
+
+
+def get_channel_rules():
+    """
+    Get the channel rules of the current process.
+    :return:
+    :rtype: ChannelRules
+    """
+    if _channel_rules is None:
+        set_channel_rules()
+    return _channel_rules
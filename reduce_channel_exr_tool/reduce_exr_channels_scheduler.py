@@ -0,0 +1,156 @@
+import os
+import sys
+import threading
+import collections
+import concurrent.futures
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Part of the memory available at start that the tasks of the pool can use, when no budget is given.
+DEFAULT_MEMORY_FRACTION = 0.75
+
+Task = collections.namedtuple("Task", ["task_bytes", "fn", "args", "kwargs", "future"])
+
+
+def get_available_memory_bytes():
+    """
+    Get the physical memory currently available on the workstation.
+    :return:
+    :rtype: int
+    """
+    if sys.platform == "win32":
+        import ctypes
+
+        class MemoryStatusEx(ctypes.Structure):
+            _fields_ = [("dwLength", ctypes.c_ulong), ("dwMemoryLoad", ctypes.c_ulong),
+                        ("ullTotalPhys", ctypes.c_ulonglong), ("ullAvailPhys", ctypes.c_ulonglong),
+                        ("ullTotalPageFile", ctypes.c_ulonglong), ("ullAvailPageFile", ctypes.c_ulonglong),
+                        ("ullTotalVirtual", ctypes.c_ulonglong), ("ullAvailVirtual", ctypes.c_ulonglong),
+                        ("ullAvailExtendedVirtual", ctypes.c_ulonglong)]
+
+        status = MemoryStatusEx()
+        status.dwLength = ctypes.sizeof(status)
+        ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status))
+        return status.ullAvailPhys
+
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def get_default_memory_budget():
+    """
+    :return: the memory budget of the pool when none is given.
+    :rtype: int
+    """
+    return int(get_available_memory_bytes() * DEFAULT_MEMORY_FRACTION)
+
+
+class AdmittedFuture(concurrent.futures.Future):
+    """
+    Future of a task of the MemoryAwareExecutor. It is set running when the task is admitted, so it can't be
+    cancelled anymore, but running() is only true once the executor started the task: an admitted task can still
+    wait for a free worker.
+    """
+    def __init__(self):
+        super().__init__()
+        self.executor_future = None
+
+    def running(self):
+        executor_future = self.executor_future
+        return not self.done() and executor_future is not None and \
+            (executor_future.running() or executor_future.done())
+
+
+class MemoryAwareExecutor:
+    """
+    Admission control in front of an executor: each task comes with an estimation of its memory, and is only
+    given to the executor while the estimations of the admitted tasks fit in the memory budget.
+    A task that doesn't fit waits, but the smaller tasks queued after it that fit are admitted, so the cores
+    stay busy. When nothing is running, the first task is always admitted, even if it is bigger than the budget.
+    submit returns its own future (see AdmittedFuture), running once the executor started the task, and resolved
+    with its result.
+    Memory is released when a task finishes, the caller runs pump() to admit the waiting tasks, usually after
+    each concurrent.futures.wait.
+    """
+    def __init__(self, executor, memory_budget, max_in_flight):
+        self.executor = executor
+        self.memory_budget = memory_budget
+        self.max_in_flight = max_in_flight
+        self.used_bytes = 0
+        self.peak_bytes = 0
+        self.in_flight = 0
+        self.deferred = 0
+        self._pending = collections.deque()
+        self._deferred_tasks = set()
+        self._lock = threading.Lock()
+
+    def submit(self, task_bytes, fn, *args, **kwargs):
+        """
+        Queue a task, and admit it right away if it fits in the budget.
+        :param int task_bytes: estimated peak memory of the task.
+        :param callable fn:
+        :return:
+        :rtype: AdmittedFuture
+        """
+        task = Task(task_bytes, fn, args, kwargs, AdmittedFuture())
+        with self._lock:
+            self._pending.append(task)
+        self.pump()
+        return task.future
+
+    def pump(self):
+        """
+        Admit the waiting tasks that fit in the budget, in their submission order.
+        :return: number of admitted tasks
+        :rtype: int
+        """
+        admitted = []
+        with self._lock:
+            waiting = collections.deque()
+            for task in self._pending:
+                if self.in_flight >= self.max_in_flight:
+                    waiting.append(task)
+                    continue
+                if self.in_flight and self.used_bytes + task.task_bytes > self.memory_budget:
+                    if id(task.future) not in self._deferred_tasks:
+                        self._deferred_tasks.add(id(task.future))
+                        self.deferred += 1
+                    waiting.append(task)
+                    continue
+                self._deferred_tasks.discard(id(task.future))
+                self.used_bytes += task.task_bytes
+                self.peak_bytes = max(self.peak_bytes, self.used_bytes)
+                self.in_flight += 1
+                admitted.append(task)
+            self._pending = waiting
+
+        for task in admitted:
+            if not task.future.set_running_or_notify_cancel():
+                self._release(task, None)
+                continue
+            executor_future = self.executor.submit(task.fn, *task.args, **task.kwargs)
+            task.future.executor_future = executor_future
+            executor_future.add_done_callback(lambda done, task=task: self._release(task, done))
+        return len(admitted)
+
+    def _release(self, task, executor_future):
+        with self._lock:
+            self.used_bytes -= task.task_bytes
+            self.in_flight -= 1
+        if executor_future is None: #Cancelled before it was admitted
+            return
+        if executor_future.exception():
+            task.future.set_exception(executor_future.exception())
+        else:
+            task.future.set_result(executor_future.result())
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def report(self):
+        """
+        Log how much of the memory budget was used.
+        """
+        logger.info(f"Memory budget {self.memory_budget / 1024 ** 3:.1f} GB, peak admitted "
+                    f"{self.peak_bytes / 1024 ** 3:.1f} GB, {self.deferred} tasks waited for memory.")
@@ -1,10 +1,11 @@
 @echo off
 setlocal EnableDelayedExpansion
 
-set "PYTHON_SCRIPT=reduce_channel_tool.py"
-set /p USER_PATH=Enter the full name of the shot you want to filter the last TA Layer Export version:
+rem The reduce runs as a job of the local reduce daemon, started by the client if it is not running
+set "PYTHON_SCRIPT=%~dp0reduce_exr_channels_client.py"
+set /p USER_PATH=Enter the full names of the shots (separated by spaces) you want to filter the last TA Layer Export version:
 CALL "O:\software\config\rez\rez_init.bat"
-CALL rez env location_Bunker project_ numpy sg openimageio opencolorio multi_publish2 python-3 -- python "%PYTHON_SCRIPT%" "%USER_PATH%"
+CALL rez env location_Bunker project_ numpy sg openimageio opencolorio multi_publish2 python-3 -- python "%PYTHON_SCRIPT%" submit %USER_PATH% --wait
 
 echo.
 echo [Done]
@@ -1,34 +1,75 @@
 import sys
 import os
 import re
-import shutil
-import stat
+import argparse
+import threading
+import contextlib
+import collections
+import multiprocessing
 import concurrent.futures
-import numpy as np
-import OpenImageIO as oiio
 
 import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 import sg
-env = sg.from_env()
-project_record = env.project.as_shotgun_record()
 
-from tk_multi_publish2_nodes import MultiPublish2
+from reduce_exr_channels_cache import DEFAULT_CACHE_PATH, get_channel_stats_cache
+from reduce_exr_channels_copy import CopyEngine, get_copy_engine, is_synced, make_writable, sync_tree
+from reduce_exr_channels_duplicates import DEDUP_MODES, ChannelFingerprintRegistry
+from reduce_exr_channels_farm import write_farm_manifest
+from reduce_exr_channels_history import DEFAULT_HISTORY_PATH, get_channel_classes, open_channel_history
+from reduce_exr_channels_journal import (RunJournal, get_journal_path, get_layer_plan, get_run_signature,
+                                         remove_partial_outputs)
+from reduce_exr_channels_pipeline import DEFAULT_STAGE_WORKERS
+from reduce_exr_channels_prefetch import DEFAULT_PREFETCH_MAX_BYTES, DEFAULT_SCRATCH_ROOT, FramePrefetcher
+from reduce_exr_channels_rules import get_channel_rules, load_channel_rules, set_channel_rules
+from reduce_exr_channels_scheduler import DEFAULT_MEMORY_FRACTION, MemoryAwareExecutor, get_default_memory_budget
+from reduce_exr_channels_rewrite import (get_frame_outputs, group_identical_frames, is_valid_compression,
+                                         log_deduplication, modify_and_copy_exrs, rewrite_identical_exr_frames)
+from reduce_exr_channels_utils import (REUSE_DECODED_MAX_BYTES, analyze_exrs_in_version, analyze_exr_frame,
+                                       ChannelLivenessTracker, classify_channels, estimate_decoded_frame_bytes,
+                                       estimate_task_memory, get_analysis_plan, get_frame_key, get_new_frame_name,
+                                       is_cached_frame, write_near_empty_report)
+
+# ProcessPoolExecutor can't use more than 61 workers on Windows.
+MAX_PROCESS_WORKERS = 61
+# The workers are always spawned: a worker forked on Linux or macOS after this process opened EXRs with OIIO can
+# deadlock on the locks OIIO held at the fork.
+PROCESS_POOL_START_METHOD = "spawn"
+
+_sg_env = None
+# The SG connection is not thread safe, the runs of the reduce daemon share it for their queries and publishes.
+_sg_lock = threading.Lock()
+
+HarmonyFolders = collections.namedtuple("HarmonyFolders", ["local_harmony_folder", "layers_folder",
+                                                           "source_layers_folder", "version",
+                                                           "source_harmony_folder", "source_clip"])
+
+
+def get_sg_env():
+    """
+    Get the SG environment and the project record. They are only created at the first call, so the
+    worker processes that import this script don't have to connect to SG.
+    :return:
+    :rtype: sg env, dict project_record
+    """
+    global _sg_env
+    if _sg_env is None:
+        env = sg.from_env()
+        _sg_env = env, env.project.as_shotgun_record()
+    return _sg_env
 
 
 def create_harmony_version_folders(version):
     """
-    Get the user X:\\ personal location, to create a folder that will contain the new harmony folder.
-    copy to this location the previous published harmony folder, the previous clip and create a Layers folder.
+    Get the user X:\\ personal location, to create a folder that will contain the new harmony folder, and
+    create its Layers folder, so the rewrites can start. The copy of the previous published harmony folder and
+    of the previous clip is done by stage_harmony_project.
 
     :param sg_version version:
     :return:
-    :rtype: Path local_harmony_folder
-    :rtype: str layers_folder
-    :rtype: str source_layers_folder
-    :rtype: str version
+    :rtype: HarmonyFolders
     """
     current_username = os.getenv("USERNAME", None)
     logger.info(f"user found: {current_username}")
@@ -59,22 +100,49 @@ def create_harmony_version_folders(version):
         return
     source_harmony_project_name = os.listdir(source_harmony_folder_version)[0]
 
-    shutil.copytree(source_harmony_folder_version, destination_path, dirs_exist_ok=True)
-
     local_harmony_folder = os.path.join(destination_path, source_harmony_project_name)
 
-    #Create layers and clips folders
+    #Create layers folder
     layers_folder = f"{local_harmony_folder}\\layers"
     os.makedirs(layers_folder, exist_ok=True)
-    clips_folder = f"{local_harmony_folder}\\clips"
-    os.makedirs(clips_folder, exist_ok=True)
 
-    #Move the .mov last clip into the clips folder
-    shutil.copy2(source_clip_version, clips_folder) #copyfile return a permission error, so used copy2 here
+    return HarmonyFolders(local_harmony_folder, layers_folder, source_layers_folder, version,
+                          source_harmony_folder_version, source_clip_version)
 
-    remove_readonly_recursive(local_harmony_folder)
 
-    return local_harmony_folder, layers_folder, source_layers_folder, version
+def stage_harmony_project(harmony_folders):
+    """
+    Copy the previous published harmony folder and the previous clip in the new harmony folder. It doesn't
+    depend on the layers, so it runs in a thread while they are analysed and rewritten: the Layers folder is
+    left to the rewrites, and is not made writable, its files can be hardlinks of the published layers.
+    The folder is synced: only the files missing or changed since a previous staging are copied, in parallel,
+    and made writable as they are copied, and the files not in the published project anymore are removed, the
+    Layers and clips folders excepted. It always runs, even when the run is resumed, so a staged project edited
+    or deleted since the previous run is restored before the publish.
+    :param HarmonyFolders harmony_folders:
+    """
+    logger.info(f"Staging the harmony project in {harmony_folders.local_harmony_folder}")
+    clips_folder = f"{harmony_folders.local_harmony_folder}\\clips"
+    with CopyEngine() as copy_engine:
+        source_project = os.path.join(harmony_folders.source_harmony_folder,
+                                      os.path.basename(harmony_folders.local_harmony_folder))
+        copied, skipped, copied_bytes, removed = sync_tree(source_project, harmony_folders.local_harmony_folder,
+                                                           copy_engine, keep_readonly=(harmony_folders.layers_folder,),
+                                                           remove_stale=True, keep=(clips_folder,))
+        os.makedirs(clips_folder, exist_ok=True)
+        #Copy the .mov last clip into the clips folder
+        clip_path = os.path.join(clips_folder, os.path.basename(harmony_folders.source_clip))
+        if is_synced(os.stat(harmony_folders.source_clip), clip_path):
+            skipped += 1
+        else:
+            if os.path.exists(clip_path):
+                make_writable(clip_path)
+            copy_engine.copy(harmony_folders.source_clip, clip_path, writable=True)
+            copied += 1
+            copied_bytes += os.path.getsize(clip_path)
+    logger.info(f"{copied} files copied ({copied_bytes / 1024 ** 2:.0f} MB), {skipped} already staged, "
+                f"{removed} files and folders not in the published project removed")
+    logger.info("Harmony project staged")
 
 def get_latest_version_path(path):
     """
@@ -88,27 +156,6 @@ def get_latest_version_path(path):
     return os.path.join(path, versions[-1]) if versions else None
 
 
-def remove_readonly_recursive(root_path):
-    """
-    Browse all the folder and files to remove the `readonly` tag, that creates issues during the publishing.
-    :param str root_path:
-    """
-    for dirpath, dirnames, filenames in os.walk(root_path):
-        for dirname in dirnames:
-            dir_full_path = os.path.join(dirpath, dirname)
-            try:
-                os.chmod(dir_full_path, stat.S_IWRITE)
-            except Exception as e:
-                logger.warning(f"Error removing readonly on: {dir_full_path}: {e}")
-
-        for filename in filenames:
-            file_full_path = os.path.join(dirpath, filename)
-            try:
-                os.chmod(file_full_path, stat.S_IWRITE)
-            except Exception as e:
-                logger.warning(f"Error removing readonly on: {file_full_path}: {e}")
-
-
 def create_new_version_path(latest_version_path, new_folders_location):
     """
     create the version for the current layer folder to save the edited EXRs in the new layers location.
@@ -123,148 +170,14 @@ def create_new_version_path(latest_version_path, new_folders_location):
     os.makedirs(new_path, exist_ok=True)
     return new_path, layer_version
 
-def analyze_exrs_in_version(version_path):
-    """
-    Analyse the EXRs files in the given version path folder, and store the datas into dict to editing them.
-    :param str version_path:
-    :return:
-    :rtype: set, set, list[str]
-    """
-    images_files = [f for f in os.listdir(version_path) if f.lower().endswith('.exr')]
-
-    channel_stats = {}
-    empty_channels = set()
-    matte_channels = set()
-    color_override_channels = set()
-
-    if not images_files:
-        images_files = [f for f in os.listdir(version_path)] #If no EXRs, we just want to copy everything
-        return empty_channels, matte_channels, color_override_channels, images_files
-
-    for fname in images_files:
-        image_path = os.path.join(version_path, fname)
-        input_image = oiio.ImageInput.open(image_path)
-        if not input_image:
-            logger.warning(f"Warning: Cannot open {image_path}")
-            continue
-
-        spec = input_image.spec()
-        pixels = input_image.read_image()
-        input_image.close()
-
-        np_pixels = np.array(pixels).reshape((spec.height, spec.width, spec.nchannels))
-        for channel_index, channel_name in enumerate(spec.channelnames):
-            values = np_pixels[:, :, channel_index]
-            max_value = np.max(values)
-
-            if channel_name not in channel_stats:
-                channel_stats[channel_name] = {"max": max_value, "count": 1}
-            else:
-                channel_stats[channel_name]["max"] = max(channel_stats[channel_name]["max"], max_value)
-                channel_stats[channel_name]["count"] += 1
-
-            # Track "coloroverride" / "colour_override" / "matte"
-            if 'coloroverride' in channel_name.lower() or 'colour-override' in channel_name.lower():
-                base_channel = channel_name.split('.')[0]
-                color_override_channels.add(base_channel)
-
-            if 'matte' in channel_name.lower():
-                base_channel = channel_name.split('.')[0]
-                matte_channels.add(base_channel)
-
-    # Determine empty channels
-    for channel, stat in channel_stats.items():
-        #Track for tonal channel here if we don't want to be removes from empty_channel group
-        if 'tonal' in channel.lower() and not 'matte' in channel.lower():
-            empty_channels.add(channel.split('.')[0])
-
-        elif stat["max"] == 0:
-            empty_channels.add(channel.split('.')[0])
-        elif channel.split('.')[0] in empty_channels:
-            empty_channels.remove(channel.split('.')[0])
-
-    return empty_channels, matte_channels, color_override_channels, images_files
-
-def modify_and_copy_exrs(src_version, dst_version, new_version_label, exr_files,
-                         empty_channels, matte_channels, coloroverride_channels):
-    """
-    Modify the given EXRs and save it to its new version folder, using empty_channel, matte_channels and
-    coloroverride_channels dicts to find which channel we need to remove, or update before copying.
-    :param str src_version:
-    :param str dst_version:
-    :param list[str] exr_files:
-    :param dict empty_channels:
-    :param dict matte_channels:
-    :param dict coloroverride_channels:
-    """
-    for fname in exr_files:
-        src_path = os.path.join(src_version, fname)
-        basename, extension = os.path.splitext(fname)
-        new_fname = re.sub(r"v\d+", new_version_label, basename) + extension
-        dst_path = os.path.join(dst_version, new_fname)
-
-        if not empty_channels and not matte_channels and not coloroverride_channels:
-            shutil.copy2(src_path, dst_path)
-            continue
-
-        inp = oiio.ImageInput.open(src_path)
-        spec = inp.spec()
-        pixels = inp.read_image()
-        inp.close()
-
-        np_pixels = np.array(pixels).reshape((spec.height, spec.width, spec.nchannels))
-
-        new_channels = []
-        new_data = []
-        override_alpha_layers = {}
-
-        for i, channel_name in enumerate(spec.channelnames):
-            base_channel = channel_name.split('.')[0]
-
-            if base_channel in empty_channels:
-                continue # Skip completely
-
-            if base_channel in coloroverride_channels:
-                if channel_name.endswith(".R"):
-                    override_alpha_layers[base_channel] = np_pixels[:, :, i]
-                continue
-
-            if base_channel in matte_channels:
-                if channel_name.endswith(".A"):
-                    override_alpha_layers[base_channel] = np_pixels[:, :, i]
-                continue
-
-            new_channels.append(channel_name)
-            new_data.append(np_pixels[:, :, i])
-
-        # Inject override alphas
-        for base, alpha in override_alpha_layers.items():
-            new_channels.append(f"{base}.mask")
-            new_data.append(alpha)
-
-        try:
-            final_data = np.stack(new_data, axis=-1)
-        except ValueError: #If channel is empty, create an empty EXR
-            final_data = np.empty((0, 0, 0))
-
-        out_spec = oiio.ImageSpec()
-        out_spec.width = spec.width
-        out_spec.height = spec.height
-        out_spec.nchannels = len(new_channels)
-        out_spec.channelnames = new_channels
-        out_spec.format = spec.format #We want to be sure we use the format of the input EXR
-
-        out = oiio.ImageOutput.create(dst_path)
-        out.open(dst_path, out_spec)
-        out.write_image(final_data)
-        out.close()
-
 def publish_version_on_sg(harmony_folder, task_id):
     """
     Local process to publish a SG version of the created Harmony Folder with updated layers, under TA Layer Export Task.
     :param str harmony_folder:
     :param int task_id:
     """
+    from tk_multi_publish2_nodes import MultiPublish2
+
     multiPublishNode = MultiPublish2()
     multiPublishNode.plug("source_path").set_value(harmony_folder)
     multiPublishNode.name = ("Publish Harmony")
@@ -277,67 +190,71 @@ def publish_version_on_sg(harmony_folder, task_id):
     multiPublishNode.run()
 
 
-def get_sg_version_info(shot_name):
+def get_sg_shots_info(shot_names=None, sequence_name=None):
     """
-    get the sg version info for given shot name.
-    :param str shot_name:
-    :return:
-    :rtype: sg_versions list
-    :rtype: sg_task_id int
+    Get the sg version info of several shots, given by name or by sequence, with one query for all the Shots,
+    one for their Tasks and one for their Versions.
+    :param list[str] shot_names:
+    :param str sequence_name: all the shots of this sequence.
+    :return: {shot_name: (sg_versions, sg_task_id)} of the shots with a TA Layer Export task and versions, in the
+        order of the shot names.
+    :rtype: dict[str, tuple[list, int]]
     """
-
-    #Get the SG shot info
-    sg_shot =  env.sg.find_one("Shot", [["project", "is", project_record], ["code", "is", shot_name]])
-    if not sg_shot:
-        return None
-    sg_shot_id = sg_shot['id']
-    #Get the task for TA Layer Export for specified shot
+    env, project_record = get_sg_env()
     task = 'TA Layer Export'
-    sg_task_id = get_sg_task_id(sg_shot_id, task)
-    if not sg_task_id:
-        return None
 
-    #Get the list of versions not in omit.
+    #Get the SG shots info
+    shot_filters = [["project", "is", project_record]]
+    if shot_names:
+        shot_filters.append(["code", "in", list(shot_names)])
+    if sequence_name:
+        shot_filters.append(["sg_sequence", "name_is", sequence_name])
+    sg_shots = env.sg.find("Shot", shot_filters, ["code"], order=[{'field_name': 'code', 'direction': 'asc'}])
+    for shot_name in set(shot_names or ()) - {sg_shot['code'] for sg_shot in sg_shots}:
+        logger.warning(f"Shot {shot_name} not found on SG")
+    if not sg_shots:
+        return {}
+    shot_entities = [{"type": "Shot", "id": sg_shot['id']} for sg_shot in sg_shots]
+
+    #Get the task for TA Layer Export of each shot
+    task_filters = [["project", "is", project_record], ["content", "is", task], ["entity", "in", shot_entities]]
+    task_ids = {sg_task['entity']['id']: sg_task['id'] for sg_task in env.sg.find("Task", task_filters, ["entity"])}
+
+    #Get the list of versions not in omit, the most recent first.
     version_filters = [
-            ['entity', 'is', {'type': 'Shot', 'id': sg_shot_id}],
+            ['entity', 'in', shot_entities],
             ['sg_task', 'name_is', task],
             ["sg_status_list", "is_not", "omt"]
         ]
-    version_fields = ['code', 'version', 'sg_path_to_movie']
-    versions = env.sg.find('Version', filters=version_filters, fields=version_fields, order=[{'field_name': 'created_at',
-                                                                                             'direction': 'desc'}])
-    if not versions:
-        return None
-    return versions, sg_task_id
-
-def get_sg_task_id(shot_id, task_name):
-    """
-    Get SG task ID for given Task name and shot ID.
-    :param int shot_id:
-    :param str task_name:
-    :return:
-    :rtype: int task id
-    """
-    filters= [["project", "is", project_record], ["content", "is", task_name],
-              ["entity", "is", {"type": "Shot", "id": shot_id}]]
-    query_fields = ["id"]
-    target_task_record = env.sg.find_one("Task", filters, query_fields)
-    return target_task_record['id']
+    version_fields = ['code', 'version', 'sg_path_to_movie', 'entity']
+    shot_versions = collections.defaultdict(list)
+    for sg_version in env.sg.find('Version', filters=version_filters, fields=version_fields,
+                                  order=[{'field_name': 'created_at', 'direction': 'desc'}]):
+        shot_versions[sg_version['entity']['id']].append(sg_version)
+
+    order = {shot_name: i for i, shot_name in enumerate(shot_names or ())}
+    shots_info = {}
+    for sg_shot in sorted(sg_shots, key=lambda sg_shot: order.get(sg_shot['code'], len(order))):
+        if sg_shot['id'] not in task_ids or not shot_versions[sg_shot['id']]:
+            logger.warning(f"No {task} version found for {sg_shot['code']}")
+            continue
+        shots_info[sg_shot['code']] = shot_versions[sg_shot['id']], task_ids[sg_shot['id']]
+    return shots_info
 
-def layer_treatment(layer_name, layers_source_path, layers_dest_path, sg_versions, version):
+def resolve_layer_version(layer_name, layers_source_path, sg_versions, version):
     """
-    function to copy the EXRs for given layer, removing empty channels and make the channels
-    with 'matte' or 'coloroverride' in the name as Alpha-Only channels.
+    Find the version folder to use for the given layer. If the layer doesn't have the same version than the
+    Harmony publish, we use the most recent one that is not in omit on SG.
     :param str layer_name:
     :param str layers_source_path:
-    :param str layers_dest_path:
     :param list sg_versions:
     :param str version:
+    :return:
+    :rtype: str or None
     """
     layer_path = os.path.join(layers_source_path, layer_name)
     if not os.path.isdir(layer_path):
-        return
-    logger.info(f"Analyzing layer: {layer_name}")
+        return None
     layer_version = f"{layer_path}\{version}"
     if not os.path.isdir(layer_version):
         layer_version = None
@@ -353,49 +270,678 @@ def layer_treatment(layer_name, layers_source_path, layers_dest_path, sg_version
 
     if not layer_version:
         logger.warning(f'no version not in omit found for {layer_name}, skipped it')
-        return
+    return layer_version
+
 
-    empty_channels, matte_channels, coloroverride_channels, exrs = analyze_exrs_in_version(layer_version)
+def layer_treatment(layer_name, layer_version, layers_dest_path, cache_path=None, rewrite_options=None,
+                    half_tolerance=None, prefetcher=None, registry=None, near_empty_stats=None,
+                    sample_stride=0, sample_rows=0, stage_workers=DEFAULT_STAGE_WORKERS, journal=None,
+                    prior_frames=(), history_layers=None):
+    """
+    function to copy the EXRs for given layer, removing empty channels and make the channels
+    with 'matte' or 'coloroverride' in the name as Alpha-Only channels.
+    The whole layer is treated in the current process, reusing the frames decoded by the analysis when they fit
+    in memory.
+    :param str layer_name:
+    :param str layer_version:
+    :param str layers_dest_path:
+    :param str cache_path: ChannelStatsCache location, None to not use the cache.
+    :param dict rewrite_options: options of rewrite_exr_frame (compression, mask_compression, crop_data_window)
+    :param float half_tolerance: max error allowed to store the `.mask` channels as half, None to keep their
+        source format.
+    :param FramePrefetcher prefetcher: fetch the next frames while the current one is decoded.
+    :param ChannelFingerprintRegistry registry: find the channels duplicating the ones of the previous layers.
+    :param dict near_empty_stats: {layer_name: channel_stats}, the coverage stats of the layer are added to it.
+    :param int sample_stride: see get_analysis_plan.
+    :param int sample_rows: see get_analysis_plan.
+    :param tuple[int, int, int] stage_workers: threads of the read, transform and write stages of the rewrite.
+    :param RunJournal journal: outputs done by a previous run, a layer whose outputs are all done is skipped,
+        unless all the layers have to be analysed (registry, near_empty_stats).
+    :param list[str] prior_frames: frames analysed first, see ChannelHistory.get_prior_frames.
+    :param dict history_layers: {layer_name: layer}, the classification of the layer is added to it, see
+        ChannelHistory.record_run.
+    """
+    if journal and not registry and near_empty_stats is None and is_layer_done(journal, layer_version,
+                                                                             layers_dest_path):
+        logger.info(f"{layer_name} - Already done by a previous run, skipped")
+        return
+    logger.info(f"Analyzing layer: {layer_name}")
+    exr_files = [f for f in os.listdir(layer_version) if f.lower().endswith('.exr')]
+    keep_pixels = bool(exr_files) and \
+        estimate_decoded_frame_bytes(os.path.join(layer_version, exr_files[0])) * len(exr_files) <= REUSE_DECODED_MAX_BYTES
+
+    channel_fingerprints = {} if registry else None
+    channel_stats = {} if near_empty_stats is not None else None
+    live_frames = {}
+    empty_channels, matte_channels, coloroverride_channels, exrs, decoded_frames, half_masks = \
+        analyze_exrs_in_version(layer_version, keep_pixels=keep_pixels, cache_path=cache_path,
+                                half_tolerance=half_tolerance, prefetcher=prefetcher,
+                                channel_fingerprints=channel_fingerprints, channel_stats=channel_stats,
+                                sample_stride=sample_stride, sample_rows=sample_rows, prior_frames=prior_frames,
+                                live_frames=live_frames)
+    if near_empty_stats is not None:
+        near_empty_stats[layer_name] = channel_stats
     logger.info(f"Empty channels: {sorted(empty_channels)}")
     logger.info(f"Matte overrides: {sorted(matte_channels)}")
     logger.info(f"ColorOverride overrides: {sorted(coloroverride_channels)}")
+    logger.info(f"Half masks: {sorted(half_masks)}")
+    duplicate_channels = set()
+    if registry:
+        duplicate_channels = registry.register_layer(layer_name, channel_fingerprints, empty_channels,
+                                                     matte_channels, coloroverride_channels, half_masks)
 
     new_ver_path, new_ver_label = create_new_version_path(layer_version, layers_dest_path)
+    if history_layers is not None and live_frames:
+        add_history_layer(history_layers, layer_name, layer_version, new_ver_path, live_frames, empty_channels,
+                          matte_channels, coloroverride_channels, duplicate_channels)
     logger.info(f"Creating new EXRs right now")
     modify_and_copy_exrs(layer_version, new_ver_path, new_ver_label, exrs,
-                         empty_channels, matte_channels, coloroverride_channels)
+                         empty_channels, matte_channels, coloroverride_channels, decoded_frames,
+                         prefetcher=prefetcher, stage_workers=stage_workers, journal=journal,
+                         **dict(rewrite_options or {}, half_masks=half_masks,
+                                                       duplicate_channels=duplicate_channels))
     logger.info(f"New version created at: {new_ver_path}")
 
-    exr_generic_label = exrs[0].replace(exrs[0].rsplit('.')[1], '@@@@')
-    layer_path = f'{new_ver_path}\{exr_generic_label}'
+
+def submit_layer_rewrites(executor, copy_engine, layer_name, layer_version, layers_dest_path, exr_files,
+                          channel_stats, rewrite_options=None, half_masks=(), rewrite_bytes=0, prefetcher=None,
+                          duplicate_channels=(), journal=None):
+    """
+    Reduce step of a layer: classify its channels from the merged stats of all its frames, and submit one
+    rewrite per unique frame to the executor, its identical frames get its result. If nothing changes in the
+    layer, its files are only copied by the copy engine, in the threads of this process.
+    With a journal, the plan of the layer is recorded, the frames whose outputs are already done with this plan
+    are skipped, the others are recorded when their task succeeds.
+    :param MemoryAwareExecutor executor:
+    :param CopyEngine copy_engine:
+    :param str layer_name:
+    :param str layer_version:
+    :param str layers_dest_path:
+    :param list[str] exr_files: if empty, all the files of the layer version are copied.
+    :param dict channel_stats:
+    :param dict rewrite_options: options of rewrite_exr_frame (compression, mask_compression, crop_data_window)
+    :param set[str] half_masks: layers whose `.mask` channel can be stored as half.
+    :param int rewrite_bytes: estimated memory of the rewrite of one frame.
+    :param FramePrefetcher prefetcher: fetch the source frames before their rewrite starts.
+    :param set[str] duplicate_channels: output channels removed, see ChannelFingerprintRegistry.
+    :param RunJournal journal:
+    :return:
+    :rtype: dict[concurrent.futures.Future, str]
+    """
+    empty_channels, matte_channels, coloroverride_channels = classify_channels(channel_stats)
+    logger.info(f"{layer_name} - Empty channels: {sorted(empty_channels)}")
+    logger.info(f"{layer_name} - Matte overrides: {sorted(matte_channels)}")
+    logger.info(f"{layer_name} - ColorOverride overrides: {sorted(coloroverride_channels)}")
+    logger.info(f"{layer_name} - Half masks: {sorted(half_masks)}")
+
+    if not exr_files:
+        exr_files = os.listdir(layer_version) #If no EXRs, we just want to copy everything
+
+    new_ver_path, new_ver_label = create_new_version_path(layer_version, layers_dest_path)
+    plan = get_layer_plan(empty_channels, matte_channels, coloroverride_channels, half_masks, duplicate_channels)
+    if journal:
+        journal.record_layer(layer_version, new_ver_path, plan)
+    futures = {}
+    if not empty_channels and not matte_channels and not coloroverride_channels and not duplicate_channels:
+        for fname in exr_files:
+            outputs = get_frame_outputs(layer_version, new_ver_path, new_ver_label, [fname])
+            if journal and journal.is_done(outputs, plan):
+                continue
+            future = copy_engine.submit(*outputs[0])
+            record_when_done(future, journal, outputs, plan)
+            futures[future] = layer_name
+        return futures
+
+    frame_groups = group_identical_frames(layer_version, exr_files)
+    log_deduplication(frame_groups, layer_name)
+    rewrite_options = dict(rewrite_options or {}, half_masks=half_masks, duplicate_channels=duplicate_channels,
+                           prefetch_dir=prefetcher.scratch_dir if prefetcher else None)
+    for fname, duplicates in frame_groups.items():
+        src_path = os.path.join(layer_version, fname)
+        outputs = get_frame_outputs(layer_version, new_ver_path, new_ver_label, [fname] + duplicates)
+        if journal and journal.is_done(outputs, plan):
+            continue
+        dst_paths = [dst_path for _, dst_path in outputs]
+        future = executor.submit(rewrite_bytes, rewrite_identical_exr_frames, src_path, dst_paths,
+                                 empty_channels, matte_channels, coloroverride_channels, **rewrite_options)
+        if prefetcher:
+            prefetcher.attach(src_path, future)
+        record_when_done(future, journal, outputs, plan)
+        futures[future] = layer_name
+    return futures
+
+
+def add_history_layer(history_layers, layer_name, layer_version, new_ver_path, live_frames, empty_channels,
+                      matte_channels, coloroverride_channels, duplicate_channels):
+    """
+    Add the classification of an analysed layer to the layers of the run recorded in the ChannelHistory.
+    :param dict history_layers: {layer_name: layer}, see ChannelHistory.record_run.
+    :param str layer_name:
+    :param str layer_version:
+    :param str new_ver_path:
+    :param dict live_frames: {channel_name: frame_key or None}, of all the source channels.
+    :param set empty_channels:
+    :param set matte_channels:
+    :param set coloroverride_channels:
+    :param set[str] duplicate_channels:
+    """
+    channel_classes = get_channel_classes(tuple(live_frames), empty_channels, matte_channels,
+                                          coloroverride_channels, duplicate_channels)
+    history_layers[layer_name] = {"channels": channel_classes, "live_frames": live_frames,
+                                  "source": layer_version, "output": new_ver_path}
+
+
+def record_when_done(future, journal, outputs, plan):
+    """
+    Record the outputs of a task in the journal when it succeeds.
+    :param concurrent.futures.Future future:
+    :param RunJournal journal:
+    :param list[tuple[str, str]] outputs: (src_path, dst_path)
+    :param str plan: see get_layer_plan.
+    """
+    if journal:
+        future.add_done_callback(lambda done: done.cancelled() or done.exception() or journal.record(outputs, plan))
+
+
+def is_layer_done(journal, layer_version, layers_dest_path):
+    """
+    :param RunJournal journal:
+    :param str layer_version:
+    :param str layers_dest_path:
+    :return: True if all the outputs of the layer are done with the plan recorded for its current source frames,
+        it doesn't need to be analysed.
+    :rtype: bool
+    """
+    new_ver_path, new_ver_label = create_new_version_path(layer_version, layers_dest_path)
+    return journal.is_folder_done(layer_version, new_ver_path, lambda fname: get_new_frame_name(fname, new_ver_label))
+
+
+def create_process_pool(max_workers):
+    """
+    Create the pool of the analysis and rewrite tasks, its workers have the channel rules of this process.
+    :param int max_workers:
+    :return:
+    :rtype: concurrent.futures.ProcessPoolExecutor
+    """
+    return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                                                  mp_context=multiprocessing.get_context(PROCESS_POOL_START_METHOD),
+                                                  initializer=set_channel_rules,
+                                                  initargs=(get_channel_rules().config,))
+
+
+def process_layers_on_process_pool(layer_versions, layers_dest_path, max_workers=None, cache_path=None,
+                                   rewrite_options=None, half_tolerance=None, memory_budget=None, prefetcher=None,
+                                   registry=None, near_empty_stats=None, sample_stride=0, sample_rows=0,
+                                   journal=None, analysis_priors=None, history_layers=None, process_executor=None):
+    """
+    Split the work of all the layers into (layer, frame) units, and run them on a process pool, so one layer
+    with thousands of frames is spread on all the cores. When all the frames of a layer are analysed, their
+    channel stats are merged and the rewrites of this layer are submitted.
+    The frames are submitted progressively, with the channels already decided by the ChannelLivenessTracker of
+    their layer: the first frame of a layer goes alone, and once all the channels of a layer are decided, its
+    remaining frames are not analysed at all.
+    The tasks go through a MemoryAwareExecutor: their memory is estimated from the header of the first frame
+    of their layer, and they only run while they fit in the memory budget.
+    With a prefetcher, the next frames of each layer are fetched while the workers decode the current ones.
+    With a registry, all the channels are fingerprinted on all the frames, and the layers are registered and
+    rewritten in their order, so the references of the duplicate channels don't depend on the pool.
+    With a sample_stride or sample_rows, the frames of each layer are submitted in the order of get_analysis_plan,
+    after the prior frames of the layer given by the ChannelHistory.
+    :param dict[str, str] layer_versions: {layer_name: layer_version_path}
+    :param str layers_dest_path:
+    :param int max_workers:
+    :param str cache_path: ChannelStatsCache location, None to not use the cache.
+    :param dict rewrite_options: options of rewrite_exr_frame (compression, mask_compression, crop_data_window)
+    :param float half_tolerance: max error allowed to store the `.mask` channels as half, None to keep their
+        source format.
+    :param int memory_budget: bytes the tasks can use at the same time, by default a part of the available memory.
+    :param FramePrefetcher prefetcher:
+    :param ChannelFingerprintRegistry registry:
+    :param dict near_empty_stats: {layer_name: channel_stats}, if given, all the frames are analysed with their
+        coverage stats, and the stats of each layer are added to it.
+    :param int sample_stride: see get_analysis_plan.
+    :param int sample_rows: see get_analysis_plan.
+    :param RunJournal journal: outputs done by a previous run, see layer_treatment.
+    :param dict[str, list[str]] analysis_priors: {layer_name: prior_frames}, see layer_treatment.
+    :param dict history_layers: see layer_treatment.
+    :param concurrent.futures.ProcessPoolExecutor process_executor: pool to use, shared by several shots, created
+        for these layers by default. Its workers must have the channel rules of this process.
+    """
+    max_workers = min(max_workers or os.cpu_count() or 1, MAX_PROCESS_WORKERS)
+    max_in_flight = 2 * max_workers
+    pool = contextlib.nullcontext(process_executor) if process_executor else create_process_pool(max_workers)
+    with pool as process_executor, CopyEngine() as copy_engine:
+        executor = MemoryAwareExecutor(process_executor, memory_budget or get_default_memory_budget(), max_in_flight)
+        layers_exrs = {}
+        task_memory = {}
+        remaining_frames = {}
+        trackers = {}
+        analyzed_layers = {}
+        in_flight = {}
+        analysis_futures = {}
+        rewrite_futures = {}
+        prefetch_requested = set()
+
+        for layer_name, layer_version in layer_versions.items():
+            if journal and not registry and near_empty_stats is None and is_layer_done(journal, layer_version,
+                                                                                     layers_dest_path):
+                logger.info(f"{layer_name} - Already done by a previous run, skipped")
+                continue
+            exr_files = [f for f in os.listdir(layer_version) if f.lower().endswith('.exr')]
+            if not exr_files:
+                rewrite_futures.update(submit_layer_rewrites(executor, copy_engine, layer_name, layer_version,
+                                                             layers_dest_path, exr_files, {}, rewrite_options,
+                                                             journal=journal))
+                continue
+            logger.info(f"Analyzing layer: {layer_name}")
+            layers_exrs[layer_name] = exr_files
+            task_memory[layer_name] = estimate_task_memory(os.path.join(layer_version, exr_files[0]))
+            trackers[layer_name] = ChannelLivenessTracker(
+                half_tolerance, fingerprint=registry is not None,
+                coverage=near_empty_stats is not None or bool(get_channel_rules().near_empty),
+                read_all_frames=near_empty_stats is not None)
+            remaining_frames[layer_name] = collections.deque(get_analysis_plan(
+                exr_files, sample_stride, sample_rows if trackers[layer_name].can_sample_rows else 0,
+                (analysis_priors or {}).get(layer_name, ())))
+            in_flight[layer_name] = 0
+        layer_order = list(layers_exrs)
+
+        while remaining_frames or rewrite_futures:
+            # Fill the pool round-robin on the layers, only one frame per layer until its first result is back.
+            submitted = True
+            while submitted and len(analysis_futures) < max_in_flight:
+                submitted = False
+                for layer_name, frames in remaining_frames.items():
+                    tracker = trackers[layer_name]
+                    layer_limit = max_workers if tracker.channel_stats else 1
+                    if not frames or in_flight[layer_name] >= layer_limit or len(analysis_futures) >= max_in_flight:
+                        continue
+                    fname, chunk_step = frames.popleft()
+                    image_path = os.path.join(layer_versions[layer_name], fname)
+                    future = executor.submit(task_memory[layer_name][0], analyze_exr_frame, image_path,
+                                             skip_channels=frozenset(tracker.decided_channels),
+                                             cache_path=cache_path,
+                                             half_check_channels=frozenset(tracker.half_check_channels),
+                                             prefetch_dir=prefetcher.scratch_dir if prefetcher else None,
+                                             fingerprint=tracker.fingerprint, coverage=tracker.coverage,
+                                             chunk_step=chunk_step)
+                    if prefetcher:
+                        prefetcher.attach(image_path, future)
+                    analysis_futures[future] = layer_name, fname
+                    in_flight[layer_name] += 1
+                    submitted = True
+
+            if prefetcher:
+                # The next frames of each layer, round-robin like their submission
+                for frame_index in range(prefetcher.depth):
+                    for layer_name, frames in remaining_frames.items():
+                        if frame_index >= len(frames):
+                            continue
+                        image_path = os.path.join(layer_versions[layer_name], frames[frame_index][0])
+                        if image_path not in prefetch_requested:
+                            prefetch_requested.add(image_path)
+                            if not is_cached_frame(image_path, cache_path):
+                                prefetcher.request(image_path)
+
+            done, _ = concurrent.futures.wait(list(analysis_futures) + list(rewrite_futures),
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future in rewrite_futures:
+                    layer_name = rewrite_futures.pop(future)
+                    try:
+                        future.result()
+                    except concurrent.futures.process.BrokenProcessPool:
+                        raise
+                    except Exception as e:
+                        logger.info(f'issue with: {layer_name}: {e}')
+                    continue
+                layer_name, fname = analysis_futures.pop(future)
+                in_flight[layer_name] -= 1
+                try:
+                    frame_stats = future.result()
+                except concurrent.futures.process.BrokenProcessPool:
+                    raise # A killed worker, the frame is not unreadable and the pool can't run the others
+                except Exception as e:
+                    logger.warning(f'issue analysing a frame of {layer_name}: {e}')
+                    frame_stats = None
+                tracker = trackers[layer_name]
+                if frame_stats:
+                    channel_names, frame_channel_stats, _ = frame_stats
+                    tracker.update(channel_names, frame_channel_stats, get_frame_key(fname))
+
+                frames = remaining_frames[layer_name]
+                if frames and tracker.all_decided():
+                    logger.info(f"{layer_name} - All channels decided after {tracker.frames_read} reads, "
+                                f"skip the {len(frames)} remaining ones")
+                    if prefetcher:
+                        for fname, _ in frames:
+                            image_path = os.path.join(layer_versions[layer_name], fname)
+                            if image_path in prefetch_requested:
+                                prefetcher.discard(image_path)
+                    frames.clear()
+                if not frames and not in_flight[layer_name]:
+                    del remaining_frames[layer_name]
+                    analyzed_layers[layer_name] = trackers.pop(layer_name)
+                    if near_empty_stats is not None:
+                        near_empty_stats[layer_name] = analyzed_layers[layer_name].channel_stats
+                    ready_layers = [layer_name] if not registry else []
+                    while registry and layer_order and layer_order[0] in analyzed_layers:
+                        ready_layers.append(layer_order.pop(0))
+                    for ready_layer in ready_layers:
+                        tracker = analyzed_layers.pop(ready_layer)
+                        duplicate_channels = set()
+                        if registry:
+                            duplicate_channels = registry.register_layer(ready_layer,
+                                                                         tracker.get_channel_fingerprints(),
+                                                                         *classify_channels(tracker.channel_stats),
+                                                                         tracker.get_half_masks())
+                        if history_layers is not None:
+                            live_frames = {channel_name: tracker.live_frames.get(channel_name)
+                                           for channel_name in tracker.channel_stats}
+                            add_history_layer(history_layers, ready_layer, layer_versions[ready_layer],
+                                              os.path.join(layers_dest_path, ready_layer), live_frames,
+                                              *classify_channels(tracker.channel_stats), duplicate_channels)
+                        rewrite_futures.update(submit_layer_rewrites(executor, copy_engine, ready_layer,
+                                                                     layer_versions[ready_layer], layers_dest_path,
+                                                                     layers_exrs[ready_layer], tracker.channel_stats,
+                                                                     rewrite_options, tracker.get_half_masks(),
+                                                                     task_memory[ready_layer][1], prefetcher,
+                                                                     duplicate_channels, journal))
+            executor.pump()
+        copy_engine.report()
+        executor.report()
 
 
 def main():
     """
     main function to get argument layers path from bat script, and run the function to
-    create the Harmony folder. will run the concurrent function to treat al layers individualy,
+    create the Harmony folder. will run the process pool to treat all the frames of all the layers,
     and them publish the new Harmony folder with reduced layers.
     """
-    shot_name = sys.argv[1]
-    sg_versions, sg_task_id = get_sg_version_info(shot_name)
-
-    if not sg_versions or not sg_task_id:
-        logger.warning("Invalid given shot")
+    parser, args = parse_args()
+    if args.channel_rules:
+        try:
+            set_channel_rules(load_channel_rules(args.channel_rules))
+        except (OSError, ValueError) as e:
+            parser.error(f"Invalid channel rules {args.channel_rules}: {e}")
+    try:
+        failed_shots = run_shots(args)
+    except ValueError as e:
+        parser.error(str(e))
+    except concurrent.futures.process.BrokenProcessPool as e:
+        logger.error(f"A worker died, probably out of memory (see --memory-budget): {e}")
+        sys.exit(1)
+    if failed_shots:
         sys.exit(1)
 
+
+def parse_args(argv=None):
+    """
+    Parse and validate the options of a run, from the command line or from a job of the reduce daemon.
+    :param list[str] argv: by default the command line.
+    :return:
+    :rtype: argparse.ArgumentParser, argparse.Namespace
+    """
+    parser = argparse.ArgumentParser(description="Reduce the channels of the Harmony layers EXRs of shots.")
+    parser.add_argument("shot_names", nargs="*", help="Names of the shots to reduce.")
+    parser.add_argument("--sequence", help="Reduce all the shots of this sequence (with the shot names, only "
+                                           "these shots of the sequence).")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="Number of worker processes. With 1, the layers are treated one by one in this "
+                             "process, reusing the frames decoded by the analysis.")
+    parser.add_argument("--memory-budget", type=float,
+                        help="Memory in GB the workers can use at the same time, estimated from the EXR headers. "
+                             f"By default {DEFAULT_MEMORY_FRACTION:.0%} of the memory available at start.")
+    parser.add_argument("--prefetch-depth", type=int, default=0,
+                        help="Number of frames fetched ahead from the network shares while the current ones are "
+                             "decoded. 0 to not prefetch.")
+    parser.add_argument("--prefetch-max-gb", type=float, default=DEFAULT_PREFETCH_MAX_BYTES / 1024 ** 3,
+                        help="Size of the prefetched frames kept on the scratch disk at the same time.")
+    parser.add_argument("--prefetch-mode", choices=("scratch", "cache"), default="scratch",
+                        help="scratch: copy the frames in a local folder. cache: only read them ahead, to have "
+                             "them in the file cache of the OS.")
+    parser.add_argument("--dedup-channels", choices=DEDUP_MODES,
+                        help="Fingerprint all the channels on the whole sequence to find the ones with the same "
+                             "content, in a layer or across the layers. report: only list them, drop: remove them "
+                             "from the EXRs. Both write channel_duplicates.json in the Layers folder.")
+    parser.add_argument("--near-empty-report",
+                        help="Analyse all the frames with the coverage stats of their channels, and write to this "
+                             "JSON file the channels removed as near empty at each noise threshold, to choose the "
+                             "near_empty thresholds of the show (see --channel-rules).")
+    parser.add_argument("--farm-manifest",
+                        help="Write a job manifest of independent tasks to run on the farm, with "
+                             "reduce_exr_channels_farm.py, instead of treating the layers here.")
+    parser.add_argument("--farm-frames-per-task", type=int, default=0,
+                        help="Split the layers with more frames into frame ranges of this size on the farm. "
+                             "0 for one task per layer.")
+    parser.add_argument("--sample-stride", type=int, default=0,
+                        help="Analyse one frame every N frames of each layer first, where most of the channels "
+                             "are proven non-empty, then only the undecided channels on the other frames. "
+                             "The result is the same as a full analysis. 0 to read the frames in order.")
+    parser.add_argument("--rewrite-threads", type=int, nargs=3, default=DEFAULT_STAGE_WORKERS,
+                        metavar=("READ", "TRANSFORM", "WRITE"),
+                        help="With --workers 1, threads of the read, transform and write stages of the rewrite "
+                             "of a layer, that run at the same time.")
+    parser.add_argument("--sample-rows", type=int, default=0,
+                        help="In the first pass of --sample-stride, only decode one block of scanlines every N "
+                             "blocks. Ignored with --dedup-channels, --near-empty-report and near_empty rules, "
+                             "which need the whole frames. 0 to decode the whole frames.")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="Process everything again, instead of skipping the outputs completed by a previous "
+                             "run of the shot, recorded in its journal in the workspace.")
+    parser.add_argument("--history", default=DEFAULT_HISTORY_PATH,
+                        help="Location of the channel history: the classification of the channels of each layer "
+                             "and the bytes saved are recorded for every shot, see "
+                             "reduce_exr_channels_history.py to query it. The frames where the channels of a layer "
+                             "were non-empty in its last run are analysed first.")
+    parser.add_argument("--no-history", action="store_true",
+                        help="Don't use nor update the channel history.")
+    parser.add_argument("--channel-rules",
+                        help="JSON file with the channel rules of the show (mask rules and always empty "
+                             "channels), see DEFAULT_CHANNEL_RULES in reduce_exr_channels_rules.py.")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH,
+                        help="Location of the per-frame channel stats cache.")
+    parser.add_argument("--no-cache", action="store_true", help="Analyse all the frames again, without the cache.")
+    parser.add_argument("--compression", help="Compression of the rewritten EXRs (zip, zips, piz, dwaa, rle...). "
+                                              "By default the compression of the source EXR is kept.")
+    parser.add_argument("--mask-compression", help="Compression of the rewritten EXRs that only contain "
+                                                   "`.mask` channels. By default the same as --compression.")
+    parser.add_argument("--no-crop", action="store_true",
+                        help="Keep the full data window, instead of cropping it to the non-zero pixels.")
+    parser.add_argument("--mask-half-tolerance", type=float, default=0.0,
+                        help="Max absolute error allowed to store a `.mask` channel as half, verified on all "
+                             "the frames of its layer. 0 only stores as half the masks that are exact in half.")
+    parser.add_argument("--no-half-masks", action="store_true",
+                        help="Keep the `.mask` channels in the format of their source channel.")
+    args = parser.parse_args(argv)
+    for compression in (args.compression, args.mask_compression):
+        if compression and not is_valid_compression(compression):
+            parser.error(f"Unknown EXR compression: {compression}")
+    for option in ("dedup_channels", "near_empty_report"):
+        if getattr(args, option) and args.farm_manifest:
+            parser.error(f"--{option.replace('_', '-')} needs the analysis of all the layers, it can't run with "
+                         f"--farm-manifest")
+    if not args.shot_names and not args.sequence:
+        parser.error("Give the shots to reduce, or --sequence")
+    return parser, args
+
+
+def run_shots(args, process_executor=None):
+    """
+    Resolve the shots of a run on SG, with one query per entity type for several shots or a whole sequence, and
+    reduce them one after the other on the same process pool.
+    :param argparse.Namespace args: see parse_args. The channel rules must already be set.
+    :param concurrent.futures.ProcessPoolExecutor process_executor: pool shared with other runs, by default one
+        is created for the shots of this run, so its workers only start once.
+    :return: the shots that failed, all of them if none was found on SG.
+    :rtype: list[str]
+    :raise concurrent.futures.process.BrokenProcessPool: a worker of the pool died, the shots left can't run on it.
+    """
+    cache_path = None if args.no_cache else args.cache
+    rewrite_options = {"compression": args.compression, "mask_compression": args.mask_compression,
+                       "crop_data_window": not args.no_crop}
+    half_tolerance = None if args.no_half_masks else args.mask_half_tolerance
+    memory_budget = int(args.memory_budget * 1024 ** 3) if args.memory_budget else None
+
+    with _sg_lock:
+        shots_info = get_sg_shots_info(shot_names=args.shot_names, sequence_name=args.sequence)
+    if not shots_info:
+        logger.warning("Invalid given shot")
+        return list(args.shot_names) or [args.sequence]
+    if len(shots_info) > 1:
+        for option in ("farm_manifest", "near_empty_report"):
+            if getattr(args, option):
+                raise ValueError(f"--{option.replace('_', '-')} only takes one shot")
+        logger.info(f"Reducing {len(shots_info)} shots: {', '.join(shots_info)}")
+
+    prefetcher = None
+    if args.prefetch_depth > 0 and not args.farm_manifest:
+        scratch_dir = os.path.join(DEFAULT_SCRATCH_ROOT, f"{os.getpid()}_{threading.get_ident()}") \
+            if args.prefetch_mode == "scratch" else None
+        prefetcher = FramePrefetcher(args.prefetch_depth, int(args.prefetch_max_gb * 1024 ** 3), scratch_dir)
+    history = None if args.no_history or args.farm_manifest else open_channel_history(args.history)
+    owned_executor = None
+    if not process_executor and args.workers != 1 and not args.farm_manifest:
+        process_executor = owned_executor = create_process_pool(min(args.workers or os.cpu_count() or 1,
+                                                                    MAX_PROCESS_WORKERS))
+
+    failed_shots = []
+    try:
+        for shot_name, (sg_versions, sg_task_id) in shots_info.items():
+            try:
+                if not reduce_shot(shot_name, sg_versions, sg_task_id, args, cache_path=cache_path,
+                                   rewrite_options=rewrite_options, half_tolerance=half_tolerance,
+                                   memory_budget=memory_budget, prefetcher=prefetcher, history=history,
+                                   process_executor=process_executor):
+                    failed_shots.append(shot_name)
+            except concurrent.futures.process.BrokenProcessPool:
+                raise
+            except Exception as e:
+                logger.warning(f"{shot_name} failed: {e}")
+                failed_shots.append(shot_name)
+    finally:
+        if owned_executor:
+            owned_executor.shutdown()
+        if prefetcher:
+            prefetcher.report()
+            prefetcher.close()
+        if history:
+            history.close()
+
+    if cache_path:
+        evicted = get_channel_stats_cache(cache_path).evict()
+        if evicted:
+            logger.info(f"Evicted {evicted} frames from the channel stats cache")
+    if len(shots_info) > 1:
+        logger.info(f"{len(shots_info) - len(failed_shots)} shots reduced"
+                    + (f", failed: {', '.join(failed_shots)}" if failed_shots else ""))
+    return failed_shots
+
+
+def reduce_shot(shot_name, sg_versions, sg_task_id, args, cache_path=None, rewrite_options=None,
+                half_tolerance=None, memory_budget=None, prefetcher=None, history=None, process_executor=None):
+    """
+    Create the Harmony folder of a shot, treat all the frames of all its layers, and publish it, or only write
+    its farm manifest.
+    :param str shot_name:
+    :param list sg_versions: see get_sg_shots_info.
+    :param int sg_task_id:
+    :param argparse.Namespace args: see parse_args.
+    :param str cache_path: ChannelStatsCache location, None to not use the cache.
+    :param dict rewrite_options: options of rewrite_exr_frame (compression, mask_compression, crop_data_window)
+    :param float half_tolerance:
+    :param int memory_budget:
+    :param FramePrefetcher prefetcher:
+    :param ChannelHistory history:
+    :param concurrent.futures.ProcessPoolExecutor process_executor: pool shared by the shots, see
+        process_layers_on_process_pool.
+    :return: False if the shot can't be reduced.
+    :rtype: bool
+    """
     latest_sg_version = sg_versions[0]
-    local_harmony_folder, layers_dest_path, layers_source_path, version = create_harmony_version_folders(latest_sg_version)
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = [executor.submit(
-                    layer_treatment,
-              layer_name, layers_source_path, layers_dest_path, sg_versions, version) for layer_name in os.listdir(layers_source_path)]
-        for future in concurrent.futures.as_completed(futures):
+    harmony_folders = create_harmony_version_folders(latest_sg_version)
+    if not harmony_folders:
+        return False
+    local_harmony_folder, layers_dest_path, layers_source_path, version = harmony_folders[:4]
+
+    layer_versions = {}
+    for layer_name in os.listdir(layers_source_path):
+        layer_version = resolve_layer_version(layer_name, layers_source_path, sg_versions, version)
+        if layer_version:
+            layer_versions[layer_name] = layer_version
+
+    if args.farm_manifest:
+        # The staging and the publish are done by the finalize task of the manifest
+        farm_options = {"cache": not args.no_cache,
+                        "cache_path": args.cache if args.cache != DEFAULT_CACHE_PATH else None,
+                        "rewrite_options": rewrite_options, "half_tolerance": half_tolerance,
+                        "sample_stride": args.sample_stride, "sample_rows": args.sample_rows,
+                        "channel_rules": get_channel_rules().config}
+        write_farm_manifest(args.farm_manifest, shot_name, sg_task_id, harmony_folders, layer_versions,
+                            farm_options, frames_per_task=args.farm_frames_per_task)
+        return True
+
+    journal_path = get_journal_path(harmony_folders)
+    if args.no_resume and os.path.exists(journal_path):
+        os.remove(journal_path)
+    journal = RunJournal(journal_path, get_run_signature({
+        "version": version, "layer_versions": layer_versions, "rewrite_options": rewrite_options,
+        "half_tolerance": half_tolerance, "dedup_channels": args.dedup_channels,
+        "channel_rules": get_channel_rules().config}))
+    removed = remove_partial_outputs(layers_dest_path)
+    if removed:
+        logger.info(f"Removed {removed} partial outputs of a previous run")
+
+    # The staging of the harmony project only has to be done before the publish
+    staging_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    staging = staging_executor.submit(stage_harmony_project, harmony_folders)
+    staging_executor.shutdown(wait=False)
+
+    registry = ChannelFingerprintRegistry(args.dedup_channels) if args.dedup_channels else None
+    near_empty_stats = {} if args.near_empty_report else None
+    history_layers = {} if history else None
+    analysis_priors = {layer_name: history.get_prior_frames(shot_name, layer_name)
+                       for layer_name in layer_versions} if history else {}
+    if args.workers == 1:
+        for layer_name, layer_version in layer_versions.items():
             try:
-                result_layer = future.result()
+                layer_treatment(layer_name, layer_version, layers_dest_path, cache_path=cache_path,
+                                rewrite_options=rewrite_options, half_tolerance=half_tolerance,
+                                prefetcher=prefetcher, registry=registry, near_empty_stats=near_empty_stats,
+                                sample_stride=args.sample_stride, sample_rows=args.sample_rows,
+                                stage_workers=args.rewrite_threads, journal=journal,
+                                prior_frames=analysis_priors.get(layer_name, ()), history_layers=history_layers)
             except Exception as e:
                 logger.info(f'issue with: {e}')
-
-    publish_version_on_sg(local_harmony_folder, sg_task_id)
+        get_copy_engine().report()
+    else:
+        process_layers_on_process_pool(layer_versions, layers_dest_path, max_workers=args.workers,
+                                       cache_path=cache_path, rewrite_options=rewrite_options,
+                                       half_tolerance=half_tolerance, memory_budget=memory_budget,
+                                       prefetcher=prefetcher, registry=registry,
+                                       near_empty_stats=near_empty_stats, sample_stride=args.sample_stride,
+                                       sample_rows=args.sample_rows, journal=journal,
+                                       analysis_priors=analysis_priors, history_layers=history_layers,
+                                       process_executor=process_executor)
+    if near_empty_stats is not None:
+        write_near_empty_report(args.near_empty_report, near_empty_stats)
+    if registry:
+        registry.report()
+        logger.info(f"Duplicate channels written to {registry.write_sidecar(layers_dest_path)}")
+    if history:
+        history.record_run(shot_name, version, history_layers)
+
+    try:
+        staging.result()
+    except Exception as e:
+        logger.warning(f"Cannot stage the harmony project in {local_harmony_folder}: {e}")
+        return False
+    finally:
+        journal.report()
+        journal.close()
+    with _sg_lock:
+        publish_version_on_sg(local_harmony_folder, sg_task_id)
+    return True
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,735 @@
+import os
+import re
+import json
+import hashlib
+import numpy as np
+import OpenImageIO as oiio
+
+import logging
+logger = logging.getLogger(__name__)
+
+from reduce_exr_channels_cache import get_channel_stats_cache
+from reduce_exr_channels_prefetch import get_read_path
+from reduce_exr_channels_rules import NEAR_EMPTY_EDGES, get_channel_rules
+
+# Number of scanlines read at once during the analysis, so we never have a full frame in memory.
+ANALYSIS_CHUNK_ROWS = 64
+# Channels skipped between two runs of evaluated channels for a second read of the frame to be cheaper: each read
+# decompresses the scanlines again, that costs about as much as converting 32 more channels.
+CHANNEL_RUN_MIN_GAP = 32
+# If the whole decoded layer fits in this size, keep it from the analysis to not read the EXRs twice.
+REUSE_DECODED_MAX_BYTES = 4 * 1024 ** 3
+# Size of the channel fingerprints, see analyze_exr_frame.
+FINGERPRINT_DIGEST_BYTES = 16
+
+
+def estimate_decoded_frame_bytes(image_path):
+    """
+    Estimate the size of the given EXR once decoded as float, only reading its header.
+    :param str image_path:
+    :return:
+    :rtype: int
+    """
+    input_image = oiio.ImageInput.open(image_path)
+    if not input_image:
+        return 0
+    spec = input_image.spec()
+    input_image.close()
+    return spec.width * spec.height * spec.nchannels * np.dtype(np.float32).itemsize
+
+
+def estimate_task_memory(image_path):
+    """
+    Estimate the peak memory of the analysis and of the rewrite of the given EXR, only reading its header.
+    Pixels are always decoded as float: the analysis holds one chunk of scanlines and its temporaries, and
+    the rewrite the source channels and the output buffer.
+    :param str image_path:
+    :return: analysis bytes, rewrite bytes
+    :rtype: tuple[int, int]
+    """
+    input_image = oiio.ImageInput.open(image_path)
+    if not input_image:
+        return 0, 0
+    spec = input_image.spec()
+    input_image.close()
+    row_bytes = spec.width * spec.nchannels * np.dtype(np.float32).itemsize
+    return 2 * min(ANALYSIS_CHUNK_ROWS, spec.height) * row_bytes, 2 * spec.height * row_bytes
+
+
+def iter_exr_chunks(input_image, spec, chunk_rows=ANALYSIS_CHUNK_ROWS, chbegin=0, chend=None, chunk_step=1):
+    """
+    Read the opened EXR by blocks of scanlines (or by rows of tiles for tiled EXRs), to never
+    have the whole frame decoded in memory. Only the channels in [chbegin, chend[ are read.
+    With a chunk_step, only one block every chunk_step blocks is read, a downscaled read of the frame.
+    :param oiio.ImageInput input_image:
+    :param oiio.ImageSpec spec:
+    :param int chunk_rows:
+    :param int chbegin:
+    :param int chend:
+    :param int chunk_step:
+    :return: the row offset of the chunk in the data window, and its pixels as (rows, width, channels)
+    :rtype: Iterator[tuple[int, np.ndarray]]
+    """
+    if chend is None:
+        chend = spec.nchannels
+    if spec.tile_height:
+        chunk_rows = max(spec.tile_height, chunk_rows - chunk_rows % spec.tile_height)
+
+    for ybegin in range(spec.y, spec.y + spec.height, chunk_rows * chunk_step):
+        yend = min(ybegin + chunk_rows, spec.y + spec.height)
+        if spec.tile_height:
+            chunk = input_image.read_tiles(0, 0, spec.x, spec.x + spec.width, ybegin, yend,
+                                           spec.z, spec.z + max(spec.depth, 1), chbegin, chend, oiio.FLOAT)
+        else:
+            chunk = input_image.read_scanlines(0, 0, ybegin, yend, spec.z, chbegin, chend, oiio.FLOAT)
+        if chunk is None:
+            raise IOError(f"Cannot read scanlines {ybegin}-{yend}: {input_image.geterror()}")
+        yield ybegin - spec.y, np.asarray(chunk).reshape((yend - ybegin, spec.width, chend - chbegin))
+
+
+def get_occupied_region(pixels):
+    """
+    Get the tight bounding box of the non-zero pixels of the given buffer, on all its channels.
+    :param np.ndarray pixels: (rows, width, channels)
+    :return: (ybegin, yend, xbegin, xend) in the buffer, None if all the pixels are 0.
+    :rtype: tuple[int, int, int, int] or None
+    """
+    occupied = pixels.any(axis=2)
+    rows = np.flatnonzero(occupied.any(axis=1))
+    if not rows.size:
+        return None
+    columns = np.flatnonzero(occupied.any(axis=0))
+    return int(rows[0]), int(rows[-1]) + 1, int(columns[0]), int(columns[-1]) + 1
+
+
+def reduce_channels(pixels, with_min=False, with_nonzero=False, coverage_edges=None):
+    """
+    Reduce all the channels of the given buffer in one vectorised pass over the pixel axes, instead of one
+    strided np.max per channel.
+    :param np.ndarray pixels: (rows, width, channels)
+    :param bool with_min: also get the minimum of each channel.
+    :param bool with_nonzero: also get the number of non-zero pixels of each channel.
+    :param tuple[float] coverage_edges: also get the number of pixels above each of these absolute values.
+    :return: {"max": array, "min": array, "nonzero": array, "above": (edges, channels) array}, one value per
+        channel.
+    :rtype: dict[str, np.ndarray]
+    """
+    # Channels are the contiguous axis, numpy reduces the pixels with all the channels side by side
+    reduction = {"max": pixels.max(axis=(0, 1))}
+    if with_min:
+        reduction["min"] = pixels.min(axis=(0, 1))
+    if with_nonzero:
+        reduction["nonzero"] = (pixels != 0).sum(axis=(0, 1))
+    if coverage_edges:
+        # One comparison buffer reused for all the edges, summed as bytes along the pixels
+        magnitudes = np.abs(pixels).reshape(-1, pixels.shape[2])
+        above = np.empty(magnitudes.shape, dtype=bool)
+        counts = []
+        for edge in coverage_edges:
+            np.greater(magnitudes, edge, out=above)
+            counts.append(above.view(np.uint8).sum(axis=0, dtype=np.int64))
+        reduction["above"] = np.stack(counts)
+    return reduction
+
+
+def is_always_empty_channel(channel_name):
+    """
+    Tonal channels are always removed, unless they are mattes, so we never need to read their values.
+    See the always_empty part of the ChannelRules.
+    :param str channel_name:
+    :return:
+    :rtype: bool
+    """
+    return get_channel_rules().match(channel_name).always_empty
+
+
+def is_mask_source_channel(channel_name):
+    """
+    The `.R` of the color overrides and the `.A` of the mattes are kept as the `.mask` channel of their layer.
+    See the mask rules of the ChannelRules.
+    :param str channel_name:
+    :return:
+    :rtype: bool
+    """
+    return get_channel_rules().match(channel_name).mask_source
+
+
+def get_undecided_channel_indices(channel_names, skip_channels):
+    """
+    Get the indices of the channels we still need to evaluate.
+    :param tuple[str] channel_names:
+    :param set[str] skip_channels:
+    :return:
+    :rtype: list[int]
+    """
+    always_empty = get_channel_rules().compile(tuple(channel_names)).always_empty
+    return [i for i, channel_name in enumerate(channel_names)
+            if i not in always_empty and channel_name not in skip_channels]
+
+
+def get_channel_runs(channel_indices, min_gap=CHANNEL_RUN_MIN_GAP):
+    """
+    Group the sorted channel indices into [chbegin, chend[ ranges read separately, split where at least min_gap
+    channels are not needed.
+    :param list[int] channel_indices:
+    :param int min_gap:
+    :return:
+    :rtype: list[tuple[int, int]]
+    """
+    runs = []
+    for channel_index in channel_indices:
+        if runs and channel_index - runs[-1][1] < min_gap:
+            runs[-1][1] = channel_index + 1
+        else:
+            runs.append([channel_index, channel_index + 1])
+    return [tuple(run) for run in runs]
+
+
+def analyze_exr_frame(image_path, keep_pixels=False, skip_channels=(), cache_path=None, half_check_channels=(),
+                      prefetch_dir=None, fingerprint=False, coverage=False, chunk_step=1):
+    """
+    Stream the given EXR by chunks of scanlines, and get the stats of each of its channels: its maximum value,
+    and for the channels in half_check_channels, the max error if they are stored as half.
+    Harmony layers are mostly empty, so the stats are only computed inside the occupied region of each chunk,
+    where all the channels are reduced at once by reduce_channels.
+    The channels in skip_channels (already decided by a ChannelLivenessTracker), and the always empty ones,
+    are not evaluated, and only the ranges of channels that contain the remaining ones are read, see
+    get_channel_runs.
+    With a cache_path, the stats are taken from the ChannelStatsCache when the file didn't change, and the
+    new ones are stored in it.
+    With a prefetch_dir, the frame is decoded from its copy by the FramePrefetcher, if it is ready.
+    With fingerprint, the values of each evaluated channel are also hashed, chunk by chunk, with the data window,
+    to find the channels with the same content.
+    With coverage, the fraction of the pixels above each of the NEAR_EMPTY_EDGES, and the max absolute value, are
+    also computed, to find the channels that are only noise.
+    With a chunk_step, only one chunk every chunk_step chunks is read: the stats of this sampled read can prove
+    that a channel is live, never that it is empty, they are not stored in the cache.
+    This is the unit of work of the analysis, it can run in a worker process.
+    :param str image_path:
+    :param bool keep_pixels: also return the decoded frame, to be reused by the rewrite.
+    :param set[str] skip_channels:
+    :param str cache_path:
+    :param set[str] half_check_channels:
+    :param str prefetch_dir: scratch folder of the FramePrefetcher.
+    :param bool fingerprint:
+    :param bool coverage:
+    :param int chunk_step: see iter_exr_chunks, incompatible with keep_pixels, fingerprint and coverage.
+    :return: the channel names of the EXR, {channel_name: {"max": float, "nonzero": bool, "half_error": float,
+        "fingerprint": str, "abs_max": float, "coverage": list[float]}} for each evaluated channel and the
+        decoded frame if kept. None if the EXR can't be opened.
+    :rtype: tuple[tuple[str], dict[str, dict], tuple[oiio.ImageSpec, np.ndarray] or None] or None
+    """
+    cache = get_channel_stats_cache(cache_path) if cache_path else None
+    if cache and not keep_pixels:
+        cached = cache.get(image_path)
+        if cached:
+            channel_names, cached_stats = cached
+            evaluated = [channel_names[i] for i in get_undecided_channel_indices(channel_names, skip_channels)]
+            if all(channel_name in cached_stats and (channel_name not in half_check_channels or
+                                                     "half_error" in cached_stats[channel_name]) and
+                   (not fingerprint or "fingerprint" in cached_stats[channel_name]) and
+                   (not coverage or "coverage" in cached_stats[channel_name])
+                   for channel_name in evaluated):
+                return channel_names, {channel_name: cached_stats[channel_name] for channel_name in evaluated}, None
+
+    input_image = oiio.ImageInput.open(get_read_path(image_path, prefetch_dir))
+    if not input_image:
+        logger.warning(f"Warning: Cannot open {image_path}")
+        return None
+
+    spec = input_image.spec()
+    channel_names = tuple(spec.channelnames)
+    undecided = get_undecided_channel_indices(channel_names, skip_channels)
+    if not undecided and not keep_pixels:
+        input_image.close()
+        return channel_names, {}, None
+
+    # Channels already stored as half don't lose anything
+    half_check = [i for i in undecided
+                  if channel_names[i] in half_check_channels and spec.channelformat(i) != oiio.TypeDesc(oiio.HALF)]
+    channel_runs = [(0, spec.nchannels)] if keep_pixels else get_channel_runs(undecided)
+    frame_max = np.full(spec.nchannels, -np.inf, dtype=np.float32)
+    frame_min = np.full(spec.nchannels, np.inf, dtype=np.float32)
+    half_error = np.zeros(spec.nchannels, dtype=np.float32)
+    above = np.zeros((len(NEAR_EMPTY_EDGES), spec.nchannels), dtype=np.int64)
+    np_pixels = None
+    if keep_pixels:
+        np_pixels = np.empty((spec.height, spec.width, spec.nchannels), dtype=np.float32)
+    fingerprints = {}
+    if fingerprint:
+        data_window = f"{spec.x},{spec.y},{spec.width},{spec.height}".encode()
+        fingerprints = {i: hashlib.blake2b(data_window, digest_size=FINGERPRINT_DIGEST_BYTES) for i in undecided}
+
+    try:
+        for chbegin, chend in channel_runs:
+            run_undecided = [i for i in undecided if chbegin <= i < chend]
+            run_half_check = [i for i in half_check if chbegin <= i < chend]
+            half_indices = [i - chbegin for i in run_half_check]
+            fingerprint_indices = [i - chbegin for i in run_undecided]
+            for row_offset, chunk in iter_exr_chunks(input_image, spec, chbegin=chbegin, chend=chend,
+                                                     chunk_step=chunk_step):
+                region = get_occupied_region(chunk)
+                if region != (0, chunk.shape[0], 0, chunk.shape[1]):
+                    # There are zero pixels outside of the occupied region
+                    frame_max[run_undecided] = np.maximum(frame_max[run_undecided], 0)
+                    frame_min[run_undecided] = np.minimum(frame_min[run_undecided], 0)
+                if region:
+                    ybegin, yend, xbegin, xend = region
+                    occupied = chunk[ybegin:yend, xbegin:xend]
+                    reduction = reduce_channels(occupied, with_min=True,
+                                                coverage_edges=NEAR_EMPTY_EDGES if coverage else None)
+                    frame_max[chbegin:chend] = np.maximum(frame_max[chbegin:chend], reduction["max"])
+                    frame_min[chbegin:chend] = np.minimum(frame_min[chbegin:chend], reduction["min"])
+                    if coverage:
+                        above[:, chbegin:chend] += reduction["above"]
+                    if run_half_check:
+                        values = occupied[:, :, half_indices]
+                        half_error[run_half_check] = np.maximum(
+                            half_error[run_half_check], np.abs(values - values.astype(np.float16)).max(axis=(0, 1)))
+                if fingerprints:
+                    # One contiguous plane per channel, the whole chunk and not only its occupied region
+                    planes = np.ascontiguousarray(np.moveaxis(chunk[:, :, fingerprint_indices], 2, 0))
+                    for channel_index, plane in zip(run_undecided, planes):
+                        fingerprints[channel_index].update(plane)
+                if np_pixels is not None:
+                    np_pixels[row_offset:row_offset + chunk.shape[0]] = chunk
+    finally:
+        input_image.close()
+
+    frame_channel_stats = {}
+    for channel_index in undecided:
+        max_value = float(frame_max[channel_index])
+        nonzero = max_value != 0 or float(frame_min[channel_index]) not in (0, np.inf)
+        frame_channel_stats[channel_names[channel_index]] = {"max": max_value, "nonzero": nonzero}
+        if channel_names[channel_index] in half_check_channels:
+            frame_channel_stats[channel_names[channel_index]]["half_error"] = float(half_error[channel_index])
+        if fingerprints:
+            frame_channel_stats[channel_names[channel_index]]["fingerprint"] = fingerprints[channel_index].hexdigest()
+        if coverage:
+            frame_channel_stats[channel_names[channel_index]].update(
+                abs_max=max(max_value, -float(frame_min[channel_index])),
+                coverage=(above[:, channel_index] / (spec.width * spec.height)).tolist())
+    if cache and frame_channel_stats and chunk_step == 1:
+        cache.put(image_path, channel_names, frame_channel_stats)
+    decoded_frame = (spec, np_pixels) if np_pixels is not None else None
+    return channel_names, frame_channel_stats, decoded_frame
+
+
+def merge_channel_stats(channel_stats, channel_names, frame_channel_stats):
+    """
+    Merge the stats of one frame into the channel stats of its layer.
+    Channels without stats in this frame (not evaluated) are only registered.
+    The coverage of the layer is the max of the frames, and coverage_sum their sum, for the mean.
+    :param dict channel_stats: {channel_name: {"max": float, "half_error": float, "count": int, "abs_max": float,
+        "coverage": list[float], "coverage_sum": list[float]}}, updated in place.
+    :param tuple[str] channel_names:
+    :param dict[str, dict] frame_channel_stats:
+    """
+    for channel_name in channel_names:
+        stat = channel_stats.setdefault(channel_name, {"max": -np.inf, "half_error": 0.0, "count": 0})
+        if channel_name in frame_channel_stats:
+            frame_stat = frame_channel_stats[channel_name]
+            stat["max"] = max(stat["max"], frame_stat["max"])
+            stat["half_error"] = max(stat["half_error"], frame_stat.get("half_error", 0.0))
+            stat["count"] += 1
+            if "coverage" in frame_stat:
+                stat["abs_max"] = max(stat.get("abs_max", 0.0), frame_stat["abs_max"])
+                stat["coverage"] = np.maximum(stat.get("coverage", 0.0), frame_stat["coverage"]).tolist()
+                stat["coverage_sum"] = np.add(stat.get("coverage_sum", 0.0),
+                                              frame_stat.get("coverage_sum", frame_stat["coverage"])).tolist()
+
+
+class ChannelLivenessTracker:
+    """
+    Track the channels of a layer across its frames. A channel only needs to be proven non-zero once:
+    after that, or if it is always removed, it is decided and we don't evaluate it anymore.
+    Only the channels that stay at 0 need all the frames to be read.
+    With a half_tolerance, the mask source channels also need all the frames, to verify that they can be
+    stored as half, until one frame has a bigger error.
+    With fingerprint, all the channels need all the frames, to get the fingerprint of their whole sequence.
+    With coverage, the coverage stats are collected, and with the near_empty thresholds of the ChannelRules, a
+    channel is only proven non-zero by a frame that has more than noise. With read_all_frames, no channel is
+    decided before the last frame.
+    The first frame read where each channel is non-zero is kept in live_frames, for the ChannelHistory.
+    """
+    def __init__(self, half_tolerance=None, fingerprint=False, coverage=False, read_all_frames=False):
+        self.half_tolerance = half_tolerance
+        self.fingerprint = fingerprint
+        self.coverage = coverage
+        self.read_all_frames = read_all_frames or fingerprint
+        self.channel_stats = {}
+        self.decided_channels = set()
+        self.half_failed_channels = set()
+        self.frame_fingerprints = {}
+        self.live_frames = {}
+        self.frames_read = 0
+
+    def needs_half_check(self, channel_name):
+        """
+        :param str channel_name:
+        :return: True if we still need to verify the half precision of this channel.
+        :rtype: bool
+        """
+        return self.half_tolerance is not None and is_mask_source_channel(channel_name) and \
+            channel_name not in self.half_failed_channels
+
+    def is_proven_non_empty(self, channel_name):
+        """
+        :param str channel_name:
+        :return: True if the merged stats of the channel already prove it is kept, whatever the next frames are.
+        :rtype: bool
+        """
+        channel_stat = self.channel_stats[channel_name]
+        channel_rules = get_channel_rules()
+        if self.coverage and channel_rules.near_empty:
+            return "coverage" in channel_stat and not channel_rules.is_near_empty(channel_stat)
+        return channel_stat["max"] > 0
+
+    @property
+    def can_sample_rows(self):
+        """
+        :return: True if a downscaled read of a frame is useful: its stats can only prove a channel live, and the
+            fingerprints and the coverage need the whole frames.
+        :rtype: bool
+        """
+        return not self.read_all_frames and not self.coverage
+
+    @property
+    def half_check_channels(self):
+        return {channel_name for channel_name in self.channel_stats if self.needs_half_check(channel_name)}
+
+    def update(self, channel_names, frame_channel_stats, frame_key=None):
+        """
+        Add the result of analyze_exr_frame for one frame.
+        :param tuple[str] channel_names:
+        :param dict[str, dict] frame_channel_stats:
+        :param str frame_key: frame number, see get_frame_key. The frames can be added in any order.
+        """
+        merge_channel_stats(self.channel_stats, channel_names, frame_channel_stats)
+        if frame_channel_stats:
+            self.frames_read += 1
+        for channel_name in channel_names:
+            if frame_channel_stats.get(channel_name, {}).get("half_error", 0.0) > (self.half_tolerance or 0.0):
+                self.half_failed_channels.add(channel_name)
+            if self.fingerprint and "fingerprint" in frame_channel_stats.get(channel_name, {}):
+                self.frame_fingerprints.setdefault(channel_name, {})[frame_key] = \
+                    frame_channel_stats[channel_name]["fingerprint"]
+            if channel_name not in self.live_frames and frame_channel_stats.get(channel_name, {}).get("max", 0) > 0:
+                self.live_frames[channel_name] = frame_key
+            if is_always_empty_channel(channel_name):
+                self.decided_channels.add(channel_name)
+            elif not self.read_all_frames and not self.needs_half_check(channel_name) and \
+                    self.is_proven_non_empty(channel_name):
+                self.decided_channels.add(channel_name)
+
+    def all_decided(self):
+        """
+        :return: True if all the known channels are decided, no need to read the next frames.
+        :rtype: bool
+        """
+        return bool(self.channel_stats) and self.decided_channels.issuperset(self.channel_stats)
+
+    def get_half_masks(self):
+        """
+        Get the layers whose `.mask` channel can be stored as half: their mask source channel was verified on
+        all the frames.
+        :return:
+        :rtype: set[str]
+        """
+        return {channel_name.split('.')[0] for channel_name in self.half_check_channels}
+
+    def get_channel_fingerprints(self):
+        """
+        Get the fingerprint of each channel on the whole sequence, from the fingerprints of its frames in the order
+        of their frame numbers. A channel that wasn't fingerprinted on all the frames has none.
+        :return:
+        :rtype: dict[str, str or None]
+        """
+        channel_fingerprints = {}
+        for channel_name in self.channel_stats:
+            frame_fingerprints = self.frame_fingerprints.get(channel_name, {})
+            if not frame_fingerprints or len(frame_fingerprints) != self.frames_read:
+                channel_fingerprints[channel_name] = None
+                continue
+            sequence = hashlib.blake2b(digest_size=FINGERPRINT_DIGEST_BYTES)
+            for frame_key in sorted(frame_fingerprints):
+                sequence.update(f"{frame_key}:{frame_fingerprints[frame_key]};".encode())
+            channel_fingerprints[channel_name] = sequence.hexdigest()
+        return channel_fingerprints
+
+
+def classify_channels(channel_stats):
+    """
+    From the merged channel stats of a layer, find which channels are empty, and which ones are mattes or
+    color overrides that we want to keep only as a `.mask` channel.
+    The names are matched by the ChannelRules of the process, compiled once per channel list. With near_empty
+    rules, the channels that are only noise count as empty.
+    :param dict channel_stats:
+    :return:
+    :rtype: set, set, set
+    """
+    empty_channels = set()
+    matte_channels = set()
+    color_override_channels = set()
+
+    channel_rules = get_channel_rules()
+    compiled = channel_rules.compile(tuple(channel_stats))
+    for match in compiled.matches:
+        # Track "coloroverride" / "colour_override" / "matte"
+        if "coloroverride" in match.mask_groups:
+            color_override_channels.add(match.base)
+
+        if "matte" in match.mask_groups:
+            matte_channels.add(match.base)
+
+    # Determine empty channels
+    for match, stat in zip(compiled.matches, channel_stats.values()):
+        #Track for tonal channel here if we don't want to be removes from empty_channel group
+        if match.always_empty:
+            empty_channels.add(match.base)
+
+        elif stat["max"] == 0 or channel_rules.is_near_empty(stat):
+            empty_channels.add(match.base)
+        elif match.base in empty_channels:
+            empty_channels.remove(match.base)
+
+    return empty_channels, matte_channels, color_override_channels
+
+
+def is_cached_frame(image_path, cache_path):
+    """
+    :param str image_path:
+    :param str cache_path:
+    :return: True if the ChannelStatsCache has stats for this version of the frame, it may not need to be read.
+    :rtype: bool
+    """
+    return bool(cache_path) and get_channel_stats_cache(cache_path).get(image_path) is not None
+
+
+def get_analysis_plan(exr_files, sample_stride=0, sample_rows=0, prior_frames=()):
+    """
+    Order the reads of the analysis of a layer by frame number, in two phases. Phase one reads a strided sample
+    of the frames, where most of the channels are proven live. Phase two reads the other frames, and the
+    ChannelLivenessTracker only evaluates the channels still undecided, so the result is the same as a full scan.
+    With sample_rows, phase one only reads one chunk of scanlines every sample_rows chunks of the sampled frames,
+    so phase two reads all the frames again, for the undecided channels.
+    The prior_frames are read first, whole: the frames where the channels of the layer were proven live by the
+    previous runs, see ChannelHistory.get_prior_frames. They are not read again in phase two.
+    :param list[str] exr_files:
+    :param int sample_stride: 0 or 1 to read the frames in their order, without a sample.
+    :param int sample_rows: 0 or 1 for full reads in phase one.
+    :param iterable[str] prior_frames: frame keys, see get_frame_key.
+    :return: (fname, chunk_step) of each read, see analyze_exr_frame.
+    :rtype: list[tuple[str, int]]
+    """
+    exr_files = sorted(exr_files)
+    prior_frames = set(prior_frames)
+    prior = [fname for fname in exr_files if get_frame_key(fname) in prior_frames]
+    if prior:
+        prior_files = set(prior)
+        plan = get_analysis_plan([fname for fname in exr_files if fname not in prior_files], sample_stride,
+                                 sample_rows)
+        return [(fname, 1) for fname in prior] + plan
+    if sample_stride <= 1 and sample_rows <= 1:
+        return [(fname, 1) for fname in exr_files]
+    sampled = exr_files[::max(sample_stride, 1)]
+    if sample_rows > 1:
+        return [(fname, sample_rows) for fname in sampled] + [(fname, 1) for fname in exr_files]
+    sampled_files = set(sampled)
+    return [(fname, 1) for fname in sampled] + [(fname, 1) for fname in exr_files if fname not in sampled_files]
+
+
+def analyze_exrs_in_version(version_path, keep_pixels=False, cache_path=None, half_tolerance=None,
+                            prefetcher=None, channel_fingerprints=None, channel_stats=None, sample_stride=0,
+                            sample_rows=0, prior_frames=(), live_frames=None):
+    """
+    Analyse the EXRs files in the given version path folder, and store the datas into dict to editing them.
+    The EXRs are streamed by chunks of scanlines, only the per-channel maximum is kept from each chunk.
+    A ChannelLivenessTracker stops evaluating the channels proven non-zero, and once all the channels are
+    decided, the next frames are not read at all.
+    If keep_pixels is True, the decoded frames are kept to be reused by modify_and_copy_exrs.
+    With a cache_path, only the frames that changed since they were cached are decoded.
+    With a half_tolerance, the mask source channels are verified on all the frames, to find the `.mask`
+    channels that can be stored as half.
+    With a prefetcher, the next frames are fetched while the current one is decoded.
+    With channel_fingerprints, all the channels are read on all the frames, and it is filled with the
+    fingerprint of each channel on the whole sequence.
+    With channel_stats, the coverage stats are collected on all the frames, and it is filled with the merged
+    stats of the layer, for the near empty report.
+    With a sample_stride or sample_rows, the frames are read in the two phases of get_analysis_plan, to decide most
+    channels early. The row sampling is ignored when the tracker needs the whole frames. The prior_frames are
+    read first.
+    With live_frames, it is filled with the first frame read where each channel is non-zero.
+    :param str version_path:
+    :param bool keep_pixels:
+    :param str cache_path:
+    :param float half_tolerance: max error allowed to store a mask as half, None to keep its source format.
+    :param FramePrefetcher prefetcher:
+    :param dict channel_fingerprints: {channel_name: fingerprint}, updated in place.
+    :param dict channel_stats: {channel_name: stats}, updated in place.
+    :param int sample_stride:
+    :param int sample_rows:
+    :param iterable[str] prior_frames: frame keys, see get_analysis_plan.
+    :param dict live_frames: {channel_name: frame_key or None}, of all the channels, updated in place.
+    :return:
+    :rtype: set, set, set, list[str], dict[str, tuple[oiio.ImageSpec, np.ndarray]], set
+    """
+    images_files = [f for f in os.listdir(version_path) if f.lower().endswith('.exr')]
+
+    tracker = ChannelLivenessTracker(half_tolerance, fingerprint=channel_fingerprints is not None,
+                                     coverage=channel_stats is not None or bool(get_channel_rules().near_empty),
+                                     read_all_frames=channel_stats is not None)
+    decoded_frames = {}
+
+    if not images_files:
+        images_files = [f for f in os.listdir(version_path)] #If no EXRs, we just want to copy everything
+        return set(), set(), set(), images_files, decoded_frames, set()
+
+    analysis_plan = get_analysis_plan(images_files, sample_stride,
+                                      sample_rows if tracker.can_sample_rows else 0, prior_frames)
+    image_paths = [os.path.join(version_path, fname) for fname, _ in analysis_plan]
+    for read_index, (fname, chunk_step) in enumerate(analysis_plan):
+        if tracker.all_decided():
+            logger.info(f"All channels decided after {read_index} reads, "
+                        f"skip the {len(analysis_plan) - read_index} remaining ones")
+            if prefetcher:
+                for image_path in image_paths[read_index:]:
+                    prefetcher.discard(image_path)
+            break
+        if prefetcher:
+            for image_path in image_paths[read_index + 1:read_index + 1 + prefetcher.depth]:
+                if not is_cached_frame(image_path, cache_path):
+                    prefetcher.request(image_path)
+        frame_stats = analyze_exr_frame(image_paths[read_index], keep_pixels=keep_pixels and chunk_step == 1,
+                                        skip_channels=tracker.decided_channels, cache_path=cache_path,
+                                        half_check_channels=tracker.half_check_channels,
+                                        prefetch_dir=prefetcher.scratch_dir if prefetcher else None,
+                                        fingerprint=tracker.fingerprint, coverage=tracker.coverage,
+                                        chunk_step=chunk_step)
+        if prefetcher:
+            prefetcher.release(image_paths[read_index])
+        if not frame_stats:
+            continue
+        channel_names, frame_channel_stats, decoded_frame = frame_stats
+        tracker.update(channel_names, frame_channel_stats, get_frame_key(fname))
+        if decoded_frame:
+            decoded_frames[fname] = decoded_frame
+
+    if channel_fingerprints is not None:
+        channel_fingerprints.update(tracker.get_channel_fingerprints())
+    if channel_stats is not None:
+        channel_stats.update(tracker.channel_stats)
+    if live_frames is not None:
+        live_frames.update({channel_name: tracker.live_frames.get(channel_name)
+                            for channel_name in tracker.channel_stats})
+
+    empty_channels, matte_channels, color_override_channels = classify_channels(tracker.channel_stats)
+    return empty_channels, matte_channels, color_override_channels, images_files, decoded_frames, \
+        tracker.get_half_masks()
+
+
+def get_near_empty_report(layers_channel_stats, min_coverage=None):
+    """
+    For each noise threshold of NEAR_EMPTY_EDGES, find the channels that would be removed as near empty, with
+    the coverage stats of all the channels: their max absolute value, their max coverage above each threshold,
+    and the histogram of their absolute values, the mean of the frames.
+    :param dict[str, dict] layers_channel_stats: {layer_name: channel_stats}, of layers analysed with coverage.
+    :param float min_coverage: by default the one of the near_empty rules.
+    :return:
+    :rtype: dict
+    """
+    channel_rules = get_channel_rules()
+    if min_coverage is None:
+        min_coverage = (channel_rules.near_empty or {}).get("min_coverage", 0.0)
+    report = {"edges": list(NEAR_EMPTY_EDGES), "min_coverage": min_coverage, "near_empty": channel_rules.near_empty,
+              "layers": {}}
+    for layer_name, channel_stats in layers_channel_stats.items():
+        removed = {str(edge): [] for edge in NEAR_EMPTY_EDGES}
+        channels = {}
+        for channel_name, stat in channel_stats.items():
+            if "coverage" not in stat:
+                continue
+            mean_coverage = np.divide(stat["coverage_sum"], stat["count"])
+            # Fraction of the pixels at 0, between each threshold and the next one, and above the last one
+            cumulative = np.concatenate(([1.0], mean_coverage, [0.0]))
+            histogram = cumulative[:-1] - cumulative[1:]
+            channels[channel_name] = {"abs_max": stat["abs_max"], "coverage": stat["coverage"],
+                                      "histogram": histogram.tolist()}
+            for edge_index, edge in enumerate(NEAR_EMPTY_EDGES):
+                if channel_rules.is_near_empty(stat, edge_index, min_coverage):
+                    removed[str(edge)].append(channel_name)
+        report["layers"][layer_name] = {"removed": removed, "channels": channels}
+    return report
+
+
+def write_near_empty_report(report_path, layers_channel_stats):
+    """
+    Write the near empty report of the analysed layers, see get_near_empty_report, and log how many channels
+    each noise threshold removes.
+    :param str report_path:
+    :param dict[str, dict] layers_channel_stats: {layer_name: channel_stats}
+    """
+    report = get_near_empty_report(layers_channel_stats)
+    with open(report_path, "w") as report_file:
+        json.dump(report, report_file, indent=2)
+    for edge in NEAR_EMPTY_EDGES:
+        removed = sum(len(layer["removed"][str(edge)]) for layer in report["layers"].values())
+        logger.info(f"Noise threshold {edge:g}: {removed} channels removed as near empty "
+                    f"(coverage <= {report['min_coverage']:g})")
+    logger.info(f"Near empty report written to {report_path}")
+
+
+def get_frame_key(fname):
+    """
+    Get the frame number of the given frame, to match the frames of different layers.
+    :param str fname:
+    :return:
+    :rtype: str
+    """
+    match = re.search(r"(\d+)\.[^.]+$", fname)
+    return match.group(1) if match else fname
+
+
+def get_new_frame_name(fname, new_version_label):
+    """
+    Get the name of the given frame for the new version.
+    :param str fname:
+    :param str new_version_label:
+    :return:
+    :rtype: str
+    """
+    basename, extension = os.path.splitext(fname)
+    return re.sub(r"v\d+", new_version_label, basename) + extension
+
+
+def build_channel_plan(channel_names, empty_channels, matte_channels, coloroverride_channels,
+                       duplicate_channels=()):
+    """
+    Find which source channel goes in each channel of the rewritten EXR: the empty channels are removed, and
+    the mattes and color overrides become a `.mask` channel from the component given by the ChannelRules,
+    added at the end. The plan is cached by channel names and classification, so the frames of a layer share it.
+    The output channels in duplicate_channels are removed too.
+    :param tuple[str] channel_names:
+    :param set empty_channels:
+    :param set matte_channels:
+    :param set coloroverride_channels:
+    :param set[str] duplicate_channels: output channels with the same content as another kept channel.
+    :return: the output channel names, and the index of their source channel.
+    :rtype: list[str], list[int]
+    """
+    new_channels, source_indices = get_channel_rules().channel_plan(
+        tuple(channel_names), frozenset(empty_channels), frozenset(matte_channels), frozenset(coloroverride_channels))
+    if duplicate_channels:
+        kept = [i for i, channel_name in enumerate(new_channels) if channel_name not in duplicate_channels]
+        return [new_channels[i] for i in kept], [source_indices[i] for i in kept]
+    return list(new_channels), list(source_indices)
+
+
+def is_half_mask(channel_name, half_masks):
+    """
+    :param str channel_name: output channel.
+    :param set[str] half_masks: see ChannelLivenessTracker.get_half_masks.
+    :return: True if the channel is stored as half in the rewritten EXRs.
+    :rtype: bool
+    """
+    return channel_name.endswith(".mask") and channel_name.split('.')[0] in half_masks